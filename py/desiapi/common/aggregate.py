@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ..convert import hdf5
+from .build_spectra import select_zcatalog
+from .categorical import CategoricalZcatalog
+from .errors import MalformedRequestException
+from .models import *
+from .utils import log
+
+# Aggregates summarise the rows a zcat request would return, without sending them. The request is the same as for
+# zcat (endpoint, params and filters), with these query params saying what to compute:
+#   group_by=SURVEY,PROGRAM            number of rows for each combination of values of the columns
+#   stats=Z,FLUX_G                     count (of non-NaN values), min and max of each column
+#   hist=Z:0:4:40                      histogram of COLUMN:LOW:HIGH:BINS, several separated by commas
+#   hist2d=TARGET_RA:0:360:72,TARGET_DEC:-90:90:36   2D histogram of two columns, e.g. sky density
+# With none of them, the response is just the number of matching rows.
+#
+# Only the columns involved are read, a whole column at a time. Encoded columns (see categorical.py) are grouped by
+# their codes with `np.bincount`, so no strings are compared or decoded except the labels of the groups.
+
+HistogramSpec = Tuple[str, float, float, int]  # column, low, high, bins
+DENSE_GROUPS = 1 << 20  # Combinations of group values counted with a single bincount, more than this are found with np.unique
+
+
+def split_param(filters: Filter, name: str) -> List[str]:
+    value = filters.get(name)
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def parse_histogram(text: str) -> HistogramSpec:
+    """Parse COLUMN:LOW:HIGH:BINS"""
+    parts = text.split(":")
+    if len(parts) != 4:
+        raise MalformedRequestException(f"histograms are COLUMN:LOW:HIGH:BINS, not {text}")
+    column, low, high, bins = parts
+    try:
+        low, high, bins = float(low), float(high), int(bins)
+    except ValueError:
+        raise MalformedRequestException(f"histograms are COLUMN:LOW:HIGH:BINS, not {text}")
+    if not low < high or bins < 1:
+        raise MalformedRequestException(f"histogram {text} needs LOW < HIGH and at least one bin")
+    return column.upper(), low, high, bins
+
+
+def histogram_specs(filters: Filter) -> Tuple[List[HistogramSpec], Optional[List[HistogramSpec]]]:
+    """The 1D histograms asked for with `hist`, and the axes of the 2D histogram asked for with `hist2d` (None if there isn't one)"""
+    histograms = [parse_histogram(text) for text in split_param(filters, "hist")]
+    for column, low, high, bins in histograms:
+        if bins > MAX_HISTOGRAM_BINS:
+            raise MalformedRequestException(f"histograms can have at most {MAX_HISTOGRAM_BINS} bins")
+    axes = [parse_histogram(text) for text in split_param(filters, "hist2d")]
+    if not axes:
+        return histograms, None
+    if len(axes) != 2:
+        raise MalformedRequestException("hist2d takes exactly two COLUMN:LOW:HIGH:BINS axes")
+    if axes[0][3] * axes[1][3] > MAX_HISTOGRAM_BINS:
+        raise MalformedRequestException(f"histograms can have at most {MAX_HISTOGRAM_BINS} bins")
+    return histograms, axes
+
+
+def aggregate_columns(filters: Filter) -> List[str]:
+    """Every column the aggregates in FILTERS read"""
+    histograms, axes = histogram_specs(filters)
+    columns = split_param(filters, "group_by") + split_param(filters, "stats")
+    columns += [spec[0] for spec in histograms + (axes or [])]
+    return list(dict.fromkeys(column.upper() for column in columns))
+
+
+def stored_column(zcatalog: Zcatalog, column: str, rows: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """ROWS of COLUMN as stored, along with the values the codes stand for if it is an encoded column (None otherwise)"""
+    if isinstance(zcatalog, CategoricalZcatalog) and column in zcatalog.categories:
+        return np.asarray(zcatalog[column])[rows], np.asarray(zcatalog.categories[column]["values"])
+    if isinstance(zcatalog, hdf5.Hdf5Zcatalog):
+        values, category = zcatalog.stored(column, rows)
+        return values, None if category is None else np.asarray(category["values"])
+    return np.asarray(zcatalog[column])[rows], None
+
+
+def numeric_column(zcatalog: Zcatalog, column: str, rows: np.ndarray) -> np.ndarray:
+    values, labels = stored_column(zcatalog, column, rows)
+    if labels is not None or values.dtype.kind not in "iufb" or values.ndim != 1:
+        raise MalformedRequestException(f"{column} isn't a numeric column, it can only be grouped by")
+    return values
+
+
+def json_label(value):
+    """A group's value of a column, as something JSON can hold"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "replace")
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def group_counts(zcatalog: Zcatalog, columns: List[str], rows: np.ndarray) -> List[dict]:
+    """The number of ROWS with each combination of values of COLUMNS that occurs"""
+    codes, labels = [], []
+    for column in columns:
+        values, column_labels = stored_column(zcatalog, column, rows)
+        if values.ndim != 1:
+            raise MalformedRequestException(f"can't group by {column}, it has more than one value per row")
+        if column_labels is None:
+            column_labels, values = np.unique(values, return_inverse=True)
+        codes.append(values.astype(np.int64))
+        labels.append(column_labels)
+    dims = [len(column_labels) for column_labels in labels]
+    if math.prod(dims) <= DENSE_GROUPS:
+        counts = np.bincount(np.ravel_multi_index(codes, dims), minlength=math.prod(dims)) if len(rows) else np.zeros(0, dtype=np.int64)
+        present = np.flatnonzero(counts)
+        group_codes, counts = np.unravel_index(present, dims), counts[present]
+    else:
+        keys, counts = np.unique(np.stack(codes, axis=1), axis=0, return_counts=True)
+        group_codes = keys.T
+    if len(counts) > MAX_AGGREGATE_GROUPS:
+        raise MalformedRequestException(
+            f"grouping by {','.join(columns)} gives {len(counts)} groups, more than the {MAX_AGGREGATE_GROUPS} allowed"
+        )
+    groups = [
+        {column: json_label(column_labels[code]) for column, column_labels, code in zip(columns, labels, group)}
+        for group in zip(*group_codes)
+    ]
+    for group, count in zip(groups, counts.tolist()):
+        group["count"] = count
+    return groups
+
+
+def column_stats(values: np.ndarray) -> dict:
+    if values.dtype.kind == "f":
+        values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {"count": 0, "min": None, "max": None}
+    return {"count": len(values), "min": values.min().item(), "max": values.max().item()}
+
+
+def finite(*columns: np.ndarray) -> np.ndarray:
+    keep = np.ones(len(columns[0]), dtype=bool)
+    for values in columns:
+        if values.dtype.kind == "f":
+            keep &= np.isfinite(values)
+    return keep
+
+
+def aggregate_rows(zcatalog: Zcatalog, rows: np.ndarray, filters: Filter) -> dict:
+    """Compute the aggregates asked for in FILTERS over ROWS of ZCATALOG
+
+    :param zcatalog: The zcatalog the rows were selected from
+    :param rows: Positions of the matching rows in ZCATALOG
+    :param filters: The request's query params, see the top of this module for the ones that define aggregates
+    :returns: A JSON-serialisable dict with the row count, and `groups`, `stats`, `histograms` and `hist2d` for the aggregates asked for
+    """
+    result: Dict[str, object] = {"count": len(rows)}
+    group_by = [column.upper() for column in split_param(filters, "group_by")]
+    if group_by:
+        result["groups"] = group_counts(zcatalog, group_by, rows)
+    stats = [column.upper() for column in split_param(filters, "stats")]
+    if stats:
+        result["stats"] = {column: column_stats(numeric_column(zcatalog, column, rows)) for column in stats}
+    histograms, axes = histogram_specs(filters)
+    if histograms:
+        result["histograms"] = dict()
+        for column, low, high, bins in histograms:
+            values = numeric_column(zcatalog, column, rows)
+            counts, edges = np.histogram(values[finite(values)], bins=bins, range=(low, high))
+            result["histograms"][column] = {"edges": edges.tolist(), "counts": counts.tolist()}
+    if axes:
+        x = numeric_column(zcatalog, axes[0][0], rows)
+        y = numeric_column(zcatalog, axes[1][0], rows)
+        keep = finite(x, y)
+        counts, x_edges, y_edges = np.histogram2d(
+            x[keep],
+            y[keep],
+            bins=[axes[0][3], axes[1][3]],
+            range=[axes[0][1:3], axes[1][1:3]],
+        )
+        result["hist2d"] = {
+            "columns": [axes[0][0], axes[1][0]],
+            "edges": [x_edges.tolist(), y_edges.tolist()],
+            "counts": counts.astype(np.int64).tolist(),
+        }
+    return result
+
+
+def handle_aggregate(req: ApiRequest, release: Optional[DataRelease] = None) -> dict:
+    """
+    Interpret an aggregate API Request: select the rows the same request for zcat data would return, and summarise them.
+
+    :param req: A parsed/structured API Request constructing from a network request
+    :param release: The version of the release to read, as for `handle_spectra`
+    :returns: The aggregates, see `aggregate_rows`
+    """
+    if req.endpoint == Endpoint.XMATCH:
+        raise MalformedRequestException("cross-matches can't be aggregated")
+    release = release or get_release(req.release)
+    # Read only the columns the aggregates need, as if they had been asked for with `columns`
+    columns = aggregate_columns(req.filters) or ["TARGETID"]
+    filters = dict(req.filters, columns=",".join(columns))
+    zcatalog, rows = select_zcatalog(release, req.endpoint, req.params, filters)
+    log(f"aggregating {len(rows)} rows over", columns)
+    return aggregate_rows(zcatalog, rows, req.filters)
@@ -1,69 +1,171 @@
 #!/usr/bin/env ipython3
-import operator
-import os
-from typing import List, Tuple, Dict
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Optional, Union
 
-from functools import lru_cache
-
-import desispec.io
-import desispec.spectra
 import fitsio
 import numpy as np
-from astropy import units as u
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, vstack
+from numpy.lib.recfunctions import repack_fields
 
 from ..convert import hdf5, memmap
+from .categorical import CategoricalZcatalog
+from .cost import check_cost, cost_limits, over_limits, target_spectra_cost, tile_spectra_cost, zcat_cost
 from .errors import DataNotFoundException, MalformedRequestException
+from .filters import AllOf, compile_filters, filter_columns
+from .fragments import read_target_spectra
 from .models import *
+from .paging import ROW_INDEX_CACHE, encode_cursor, page_bounds, query_key
+from .preload import get_preloaded, get_unit_vectors, preload_fits
+from .sky import DEC_INDEXES, SKY_TREES, DecIndex, SkyTree, cone_search, cone_search_vectors, region_search, sky_region
+from .tile_index import latest_tile_night
 from .utils import invert, log
 
-def handle_spectra(req: ApiRequest) -> Spectra:
+def handle_spectra(req: ApiRequest, release: Optional[DataRelease] = None) -> Spectra:
     """
     Interpret an API Request, construct and return the relevant spectra. Basic entry point of this module.
 
     :param req: A parsed/structured API Request constructing from a network request
+    :param release: The version of the release to read, if the caller has already resolved it. Otherwise the current version of the one REQ names
     :returns: Spectra object from which to construct a response
     """
 
-    canonised = canonise_release_name(req.release)
-    release = DataRelease(canonised)
+    release = release or get_release(req.release)
     params = req.params
+    # Spectra need the default metadata columns, `columns` only applies to zcat responses
+    req = dataclasses.replace(req, filters={k: v for k, v in req.filters.items() if k != "columns"})
+    if req.endpoint in (Endpoint.TILE, Endpoint.TILES) and cost_limits() is not None:
+        check_cost(tile_spectra_cost(release, requested_tiles(req)))
     if req.endpoint == Endpoint.TILE:
         return get_tile_spectra(release, params.tile, params.fibers, req.filters)
+    elif req.endpoint == Endpoint.TILES:
+        return get_multi_tile_spectra(release, params.tiles, req.filters)
     elif req.endpoint == Endpoint.TARGETS:
         return get_target_spectra(release, params.target_ids, req.filters)
     elif req.endpoint == Endpoint.RADEC:
         return get_radec_spectra(
             release, params.ra, params.dec, params.radius, req.filters
         )
+    elif req.endpoint in (Endpoint.BOX, Endpoint.POLYGON):
+        return get_region_spectra(release, params, req.filters)
+    elif req.endpoint == Endpoint.XMATCH:
+        raise MalformedRequestException("cross-matches only return zcat data")
     else:
         raise MalformedRequestException("Invalid Endpoint")
 
 
-def handle_zcatalog(req: ApiRequest) -> Zcatalog:
+def handle_zcatalog(req: ApiRequest, release: Optional[DataRelease] = None) -> Zcatalog:
     """
     Interpret an API Request, construct and return the relevant Zcatalog (metadata). Basic entry point of this module.
 
     :param req: A parsed/structured API Request constructing from a network request
+    :param release: The version of the release to read, as for `handle_spectra`
     :returns: Zcatalog object from which to construct a response
     """
 
-    canonised = canonise_release_name(req.release)
-    release = DataRelease(canonised)
+    release = release or get_release(req.release)
     params = req.params
     if req.endpoint == Endpoint.TILE:
         return get_tile_zcatalog(release, params.tile, params.fibers, req.filters)
+    elif req.endpoint == Endpoint.TILES:
+        return get_multi_tile_zcatalog(release, params.tiles, req.filters)
     elif req.endpoint == Endpoint.TARGETS:
         return get_target_zcatalog(release, params.target_ids, req.filters)
     elif req.endpoint == Endpoint.RADEC:
         return get_radec_zcatalog(
             release, params.ra, params.dec, params.radius, req.filters
         )
+    elif req.endpoint in (Endpoint.BOX, Endpoint.POLYGON):
+        return get_region_zcatalog(release, params, req.filters)
+    elif req.endpoint == Endpoint.XMATCH:
+        return get_xmatch_zcatalog(
+            release, params.ra, params.dec, params.radius, req.filters
+        )
     else:
         raise MalformedRequestException("Invalid Endpoint")
 
 
+def handle_zcatalog_page(req: ApiRequest, release: Optional[DataRelease] = None) -> Tuple[Zcatalog, Optional[str], int]:
+    """
+    Like `handle_zcatalog`, but honours the `limit` and `cursor` query params by returning a single page of the result.
+
+    :param req: A parsed/structured API Request constructing from a network request
+    :param release: The version of the release to read, as for `handle_spectra`
+    :returns: The Zcatalog rows in this page, a cursor for the next page (None if this is the last one), and the total number of rows the query matches
+    """
+    release = release or get_release(req.release)
+    bounds = page_bounds(req, release)
+    if bounds is None:
+        zcatalog = handle_zcatalog(req, release)
+        return zcatalog, None, len(zcatalog)
+    if req.endpoint == Endpoint.XMATCH:
+        raise MalformedRequestException("cross-matches can't be paged, split the positions up instead")
+    offset, limit = bounds
+    key = query_key(req, release)
+    rows = ROW_INDEX_CACHE.get(key)
+    if rows is None:
+        zcatalog, rows = select_zcatalog(release, req.endpoint, req.params, req.filters)
+        ROW_INDEX_CACHE.put(key, rows)
+    else:
+        log("reusing cached rows for", key)
+        zcatalog = zcatalog_source(release, req.endpoint, req.filters)
+    end = offset + limit
+    next_cursor = encode_cursor(key, end) if end < len(rows) else None
+    return take_rows(zcatalog, rows[offset:end], req.filters), next_cursor, len(rows)
+
+
+def handle_plan(req: ApiRequest) -> dict:
+    """
+    Work out what REQ would cost without building its response: only the zcat rows are selected (or for tile spectra, the tile's latest night looked up), no spectra are read.
+
+    :param req: A parsed/structured API Request constructing from a network request, with any requested_data
+    :returns: A JSON-serialisable dict describing the request, its cost (see `cost.py`), the server's limits and whether the request is within them
+    """
+    if req.endpoint == Endpoint.XMATCH:
+        raise MalformedRequestException("cross-matches can't be planned")
+    release = get_release(req.release)
+    if req.requested_data == RequestedData.SPECTRA:
+        filters = {k: v for k, v in req.filters.items() if k != "columns"}
+        if req.endpoint in (Endpoint.TILE, Endpoint.TILES):
+            cost = tile_spectra_cost(release, requested_tiles(req))
+        else:
+            zcatalog, rows = select_zcatalog(release, req.endpoint, req.params, filters)
+            cost = target_spectra_cost(release, zcatalog[rows])
+    elif req.requested_data == RequestedData.AGGREGATE:
+        from .aggregate import aggregate_columns
+
+        columns = aggregate_columns(req.filters) or ["TARGETID"]
+        filters = dict(req.filters, columns=",".join(columns))
+        zcatalog, rows = select_zcatalog(release, req.endpoint, req.params, filters)
+        cost = zcat_cost(zcatalog, rows, columns, len(rows))
+        cost.pop("bytes_returned")  # A few counts, whatever the number of rows
+    else:
+        zcatalog, rows = select_zcatalog(release, req.endpoint, req.params, req.filters)
+        returned = len(rows)
+        bounds = page_bounds(req, release)
+        if bounds is not None:
+            offset, limit = bounds
+            returned = max(0, min(limit, len(rows) - offset))
+        cost = zcat_cost(zcatalog, rows, response_columns(req.filters), returned)
+    limits = cost_limits() if req.requested_data == RequestedData.SPECTRA else None
+    log("planned", cost)
+    return {
+        "requested_data": req.requested_data.name.lower(),
+        "release": release.name,
+        "release_version": release.version,
+        "endpoint": req.endpoint.name.lower(),
+        "cost": cost,
+        "limits": limits,
+        "within_limits": not over_limits(cost, limits),
+    }
+
+
+def requested_tiles(req: ApiRequest) -> Dict[int, List[int]]:
+    """The fibers of each tile a TILE or TILES request asks for"""
+    if req.endpoint == Endpoint.TILE:
+        return {req.params.tile: req.params.fibers}
+    return req.params.tiles
+
+
 def get_radec_spectra(
     release: DataRelease, ra: float, dec: float, radius: float, filters: Filter
 ) -> Spectra:
@@ -73,7 +175,7 @@ def get_radec_spectra(
     :param release: The data release to use as a data source
     :param ra: Right Ascension of the target point
     :param dec: Declination of the target point
-    :param radius: Radius (in arcseconds) around the target point to search. Capped at 60 arcsec for now
+    :param radius: Radius (in degrees) around the target point to search. Capped at 60 degrees for spectra requests
     :param filters: A dictionary of filters to restrict the objects retrieved
     :returns: A combined Spectra of all such objects in the data release
     """
@@ -82,6 +184,22 @@ def get_radec_spectra(
     return get_target_spectra_from_metadata(release, relevant_targets)
 
 
+def get_region_spectra(
+    release: DataRelease, params: Union[BoxParameters, PolygonParameters], filters: Filter
+) -> Spectra:
+    """
+    Find all objects inside a box or polygon on the sky, combine and return their spectra
+
+    :param release: The data release to use as a data source
+    :param params: The box or polygon to search
+    :param filters: A dictionary of filters to restrict the objects retrieved
+    :returns: A combined Spectra of all such objects in the data release
+    """
+    relevant_targets = get_region_zcatalog(release, params, filters)
+    log(f"Retrieving {len(relevant_targets)} targets")
+    return get_target_spectra_from_metadata(release, relevant_targets)
+
+
 def get_tile_spectra(
     release: DataRelease, tile: int, fibers: List[int], filters: Filter
 ) -> Spectra:
@@ -94,9 +212,10 @@ def get_tile_spectra(
     :param filter: Currently ignored
     :returns: A combined Spectra containing the spectra of all specified fibers
     """
-    folder = f"{release.tile_dir}/{tile}"
-    log("reading tile info from: ", folder)
-    latest = max(os.listdir(folder))
+    import desispec.io
+
+    log("reading tile info from: ", f"{release.tile_dir}/{tile}")
+    latest = latest_tile_night(release, tile)
 
     try:
         spectra = desispec.io.read_tile_spectra(
@@ -120,6 +239,30 @@ def get_tile_spectra(
         return spectra
 
 
+def get_multi_tile_spectra(
+    release: DataRelease, tiles: Dict[int, List[int]], filters: Filter
+) -> Spectra:
+    """
+    Read the specified fibers from each of several TILES concurrently, and combine them into one Spectra
+
+    :param release: The data release to use as a data source
+    :param tiles: A mapping of tile IDs to the fibers to read from that tile
+    :param filters: Currently ignored
+    :returns: A combined Spectra containing the spectra of all specified fibers, grouped by tile in the order given
+    """
+    from desispec.spectra import stack
+
+    with ThreadPoolExecutor(max_workers=min(TILE_READ_WORKERS, len(tiles))) as pool:
+        per_tile = list(
+            pool.map(
+                lambda tile: get_tile_spectra(release, tile, tiles[tile], filters),
+                tiles.keys(),
+            )
+        )
+    log(f"read spectra from {len(per_tile)} tiles")
+    return stack(per_tile)
+
+
 def get_target_spectra(
     release: DataRelease, target_ids: List[int], filters: Filter
 ) -> Spectra:
@@ -140,58 +283,102 @@ def get_radec_zcatalog(
     release: DataRelease, ra: float, dec: float, radius: float, filters: Filter
 ) -> Zcatalog:
     """
-    :param release:
-    :param ra:
-    :param dec:
-    :param radius:
-    :param filters:
-    :returns:
+    Find all (primary) objects within RADIUS of the point (RA, DEC) and return their metadata
+
+    :param release: The data release to use as a data source
+    :param ra: Right Ascension of the target point
+    :param dec: Declination of the target point
+    :param radius: Radius around the target point to search
+    :param filters: A dictionary of filters to restrict the objects retrieved
+    :returns: The zcatalog entries of every such object
     """
-    # TODO doc
-    targets = get_target_zcatalog(release, filters=filters)
-    ctargets = SkyCoord(
-        targets["TARGET_RA"] * u.degree, targets["TARGET_DEC"] * u.degree
-    )
+    zcatalog, rows = select_radec_rows(release, ra, dec, radius, filters)
+    return take_rows(zcatalog, rows, filters)
 
-    log("computing filter index")
-    center = SkyCoord(ra * u.degree, dec * u.degree)
 
-    ii = center.separation(ctargets) <= radius * u.degree
+def get_region_zcatalog(
+    release: DataRelease, params: Union[BoxParameters, PolygonParameters], filters: Filter
+) -> Zcatalog:
+    """
+    Find all (primary) objects inside a box or polygon on the sky and return their metadata
 
-    log("applying filter index")
-    filtered = targets[ii]
-    log("applied filter")
-    return filtered
+    :param release: The data release to use as a data source
+    :param params: The box or polygon to search
+    :param filters: A dictionary of filters to restrict the objects retrieved
+    :returns: The zcatalog entries of every such object
+    """
+    zcatalog, rows = select_region_rows(release, params, filters)
+    return take_rows(zcatalog, rows, filters)
 
 
 def get_tile_zcatalog(
-    # TODO doc
     release: DataRelease,
     tile: int,
     fibers: List[int],
     filters: Filter,
-):
-    desired_columns = DESIRED_COLUMNS_TILE[:]
-    for k in filters.keys():
-        desired_columns.append(k)
-    try:
-        zcatalog = unfiltered_zcatalog(
-            desired_columns,
-            release.tile_hdf5,
-            release.tile_memmap,
-            release.tile_dtype,
-            release.tile_fits,
-        )
-    except Exception as e:
-        raise DataNotFoundException("unable to read tile information")
-    log("read unfiltered zcatalog")
-    keep = (zcatalog["TILEID"] == tile) & np.isin(zcatalog["FIBER"], fibers)
-    zcatalog = zcatalog[keep]
-    return filter_zcatalog(zcatalog, filters)
+) -> Zcatalog:
+    """
+    Read the zcatalog entries for the specified FIBERS on a TILE
+
+    :param release: The data release to use as a data source
+    :param tile: Tile ID
+    :param fibers: Fibers within the tile being requested
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The zcatalog entries for every fiber requested
+    """
+    zcatalog, rows = select_tile_rows(release, {tile: fibers}, filters)
+    return take_rows(zcatalog, rows, filters)
+
+
+def get_multi_tile_zcatalog(
+    release: DataRelease, tiles: Dict[int, List[int]], filters: Filter
+) -> Zcatalog:
+    """
+    Read the zcatalog entries for the specified fibers on each of several TILES
+
+    :param release: The data release to use as a data source
+    :param tiles: A mapping of tile IDs to the fibers to read from that tile
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The zcatalog entries for every (tile, fiber) pair requested
+    """
+    zcatalog, rows = select_tile_rows(release, tiles, filters)
+    return take_rows(zcatalog, rows, filters)
+
+
+def get_xmatch_zcatalog(
+    release: DataRelease,
+    ra: List[float],
+    dec: List[float],
+    radius: List[float],
+    filters: Filter,
+) -> Zcatalog:
+    """
+    Find the (primary) objects within RADIUS[i] of each position (RA[i], DEC[i]), all in one pass over a spatial tree of the catalog
+
+    :param release: The data release to use as a data source
+    :param ra: Right Ascension of each position
+    :param dec: Declination of each position
+    :param radius: Radius around each position to search, in degrees like the radec endpoint
+    :param filters: A dictionary of filters to restrict the objects retrieved
+    :returns: The zcatalog entry of every match, with the index of the position it matched (INPUT_ROW) and its separation from it in degrees (SEPARATION). Ordered by position
+    """
+    zcatalog = healpix_source(release, filters)
+    tree = SKY_TREES.get(sky_index_key(release, zcatalog), lambda: build_sky_tree(zcatalog))
+    positions, rows, separation = tree.cross_match(
+        np.asarray(ra, dtype=np.float64),
+        np.asarray(dec, dtype=np.float64),
+        np.asarray(radius, dtype=np.float64),
+    )
+    log(f"cross-matched {len(ra)} positions to {len(rows)} rows")
+    # Each matched row only has to be filtered once, however many positions it matched
+    keep = np.isin(rows, filter_rows(zcatalog, np.unique(rows), filters))
+    return with_columns(
+        take_rows(zcatalog, rows[keep], filters),
+        {"INPUT_ROW": positions[keep], "SEPARATION": separation[keep]},
+    )
 
 
 def get_target_zcatalog(
-    # TODO doc
     release: DataRelease,
     target_ids: List[int] = [],
     filters: Filter = dict(),
@@ -201,45 +388,273 @@ def get_target_zcatalog(
 
     :param release: The data release to use as a data source
     :param target_ids: The list of target identifiers to build objects for. If this list is empty, blindly reads all targets
+    :param filters: The set of filters that restricts which targets are selected
     :returns: A list of target objects, each containing metadata for a target with a specified target_id
     """
-    desired_columns = DESIRED_COLUMNS_TARGET[:]
+    zcatalog, rows = select_target_rows(release, target_ids, filters)
+    return take_rows(zcatalog, rows, filters)
+
 
-    # Also read in metadata we want to filter on
+# Row selection. Each endpoint works out the positions of the matching rows in the unfiltered zcatalog, so that
+# callers can either take all of them or (for paging) just a slice, without copying the rest
+
+
+def desired_columns_for(default_columns: List[str], filters: Filter) -> List[str]:
+    """The columns to read: the defaults, plus any columns we want to filter on or were asked for with `columns`"""
+    desired_columns = default_columns[:]
     for k in filters.keys():
         if k not in SPECIAL_QUERY_PARAMS:
             desired_columns.append(k)
+    # Alternatives can test other columns than the one they're a filter on
+    requested = {column.upper() for column in desired_columns}
+    for column in filter_columns(filters) + (requested_columns(filters) or []):
+        if column not in requested:
+            desired_columns.append(column)
+            requested.add(column)
+    return desired_columns
+
+
+def requested_columns(filters: Filter) -> Optional[List[str]]:
+    """The columns asked for with the `columns` param: a comma-separated string, or a list from the Python client. None if it wasn't given"""
+    columns = filters.get("columns")
+    if columns is None:
+        return None
+    if isinstance(columns, str):
+        columns = columns.split(",")
+    columns = unique_columns([str(column).strip() for column in columns if str(column).strip()])
+    if not columns:
+        raise MalformedRequestException("columns must name at least one column")
+    return columns
+
+
+def response_columns(filters: Filter) -> Optional[List[str]]:
+    """The columns a zcat response carries: those asked for, then any that are filtered on. None (every column read) if `columns` wasn't given"""
+    columns = requested_columns(filters)
+    if columns is None:
+        return None
+    return unique_columns(columns + filter_columns(filters))
+
+
+def unique_columns(columns: List[str]) -> List[str]:
+    """COLUMNS in upper case, without repeats, in their original order"""
+    return list(dict.fromkeys(column.upper() for column in columns))
+
+
+def take_rows(zcatalog: Zcatalog, rows: np.ndarray, filters: Filter) -> Zcatalog:
+    """ZCATALOG[ROWS], with only the columns in `response_columns`. Only those columns are copied out of the source"""
+    columns = response_columns(filters)
+    if columns is None:
+        return zcatalog[rows]
+    if isinstance(zcatalog, CategoricalZcatalog):
+        return zcatalog.select(columns)[rows]
+    if isinstance(zcatalog, hdf5.Hdf5Zcatalog):
+        return zcatalog.take(rows, columns)
+    if isinstance(zcatalog, np.ndarray):
+        return repack_fields(zcatalog[columns][rows])
+    return zcatalog[columns][rows]
+
+
+def tile_source(release: DataRelease, filters: Filter) -> Zcatalog:
+    """The unfiltered zall-tilecumulative zcatalog for RELEASE"""
+    try:
+        return unfiltered_zcatalog(
+            desired_columns_for(DESIRED_COLUMNS_TILE, filters),
+            release.tile_hdf5,
+            release.tile_memmap,
+            release.tile_dtype,
+            release.tile_fits,
+            projected=requested_columns(filters) is not None,
+            version=release.fits_version,
+        )
+    except MalformedRequestException:
+        raise
+    except Exception as e:
+        log(e)
+        raise DataNotFoundException(f"unable to read tile information: {e}")
+
 
+def healpix_source(release: DataRelease, filters: Filter) -> Zcatalog:
+    """The unfiltered zall-pix zcatalog for RELEASE"""
     try:
-        zcatalog = unfiltered_zcatalog(
-            desired_columns,
+        return unfiltered_zcatalog(
+            desired_columns_for(DESIRED_COLUMNS_TARGET, filters),
             release.healpix_hdf5,
             release.healpix_memmap,
             release.healpix_dtype,
             release.healpix_fits,
+            projected=requested_columns(filters) is not None,
+            version=release.fits_version,
         )
-
+    except MalformedRequestException:
+        raise
     except Exception as e:
         log(e)
-        raise DataNotFoundException("unable to read target information")
-    log("computing keep indices")
-    keep = (
-        ((zcatalog["ZCAT_PRIMARY"] == True) & np.isin(zcatalog["TARGETID"], target_ids))
-        if len(target_ids)
-        else (zcatalog["ZCAT_PRIMARY"] == True)
-    )
+        raise DataNotFoundException(f"unable to read target information: {e}")
+
+
+def zcatalog_source(release: DataRelease, endpoint: Endpoint, filters: Filter) -> Zcatalog:
+    """The unfiltered zcatalog that ENDPOINT selects rows from"""
+    if endpoint in (Endpoint.TILE, Endpoint.TILES):
+        return tile_source(release, filters)
+    return healpix_source(release, filters)
+
+
+def filter_rows(zcatalog: Zcatalog, rows: np.ndarray, filters: Filter) -> np.ndarray:
+    """Narrow ROWS (positions in ZCATALOG) down to those satisfying FILTERS. Filters an HDF5 index can answer are looked up, the rest are only evaluated on the candidate rows"""
+    predicate = compile_filters(filters)
+    if predicate is None:
+        return rows
+    if isinstance(zcatalog, hdf5.Hdf5Zcatalog):
+        remaining = []
+        for part in predicate.parts:
+            matched = part.index_rows(zcatalog)
+            if matched is None:
+                remaining.append(part)
+            else:
+                rows = rows[np.isin(rows, matched)]
+        if not remaining:
+            return rows
+        predicate = AllOf(remaining)
+    # Keep encoded columns as codes, so filters on them compare integers and nothing is decoded
+    candidates = zcatalog.encoded(rows) if isinstance(zcatalog, CategoricalZcatalog) else zcatalog[rows]
+    return rows[predicate.evaluate(candidates)]
+
+
+def rows_matching(zcatalog: Zcatalog, column: str, values: List) -> np.ndarray:
+    """Positions (ascending) of the rows of ZCATALOG where COLUMN is one of VALUES. HDF5 zcatalogs answer this from their index, without reading the column"""
+    if isinstance(zcatalog, hdf5.Hdf5Zcatalog):
+        return zcatalog.lookup(column, values)
+    return np.flatnonzero(np.isin(zcatalog[column], values))
+
+
+def select_tile_rows(
+    release: DataRelease, tiles: Dict[int, List[int]], filters: Filter
+) -> Tuple[Zcatalog, np.ndarray]:
+    """Positions of the rows for the requested (tile, fiber) pairs that satisfy FILTERS
 
-    zcatalog = zcatalog[keep]
-    log("computed keep indices")
+    :param release: The data release to use as a data source
+    :param tiles: A mapping of tile IDs to the fibers to read from that tile
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The unfiltered tile zcatalog, and the positions of the selected rows in it
+    """
+    zcatalog = tile_source(release, filters)
+    log("read unfiltered zcatalog")
+    rows = rows_matching(zcatalog, "TILEID", list(tiles))
+    candidates = zcatalog[rows]
+    # Fibers are < 10000, so (tile, fiber) pairs can be matched in one pass as single integers
+    wanted = [tile * 10000 + fiber for tile, fibers in tiles.items() for fiber in fibers]
+    keys = np.asarray(candidates["TILEID"], dtype=np.int64) * 10000 + candidates["FIBER"]
+    keep = np.isin(keys, wanted)
+    return zcatalog, filter_rows(zcatalog, rows[keep], filters)
+
+
+def select_target_rows(
+    release: DataRelease, target_ids: List[int], filters: Filter
+) -> Tuple[Zcatalog, np.ndarray]:
+    """Positions of the primary rows for TARGET_IDS (or all primary rows, if TARGET_IDS is empty) that satisfy FILTERS
 
-    # Check for missing IDs
-    missing_ids = []
+    :param release: The data release to use as a data source
+    :param target_ids: The list of target identifiers to select
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The unfiltered healpix zcatalog, and the positions of the selected rows in it
+    """
+    zcatalog = healpix_source(release, filters)
+    log("computing keep indices")
     if len(target_ids):
-        found_ids = set(zcatalog["TARGETID"])
+        rows = rows_matching(zcatalog, "TARGETID", target_ids)
+        candidates = zcatalog[rows]
+        keep = np.asarray(candidates["ZCAT_PRIMARY"]) == True
+        rows = rows[keep]
+
+        # Check for missing IDs
+        found_ids = set(np.asarray(candidates["TARGETID"])[keep])
         missing_ids = [i for i in target_ids if i not in found_ids]
-    if len(missing_ids):
-        raise DataNotFoundException("unable to find targets:", target_ids)
-    return filter_zcatalog(zcatalog, filters)
+        if len(missing_ids):
+            raise DataNotFoundException("unable to find targets:", target_ids)
+    else:
+        rows = np.flatnonzero(zcatalog["ZCAT_PRIMARY"] == True)
+    log("computed keep indices")
+    return zcatalog, filter_rows(zcatalog, rows, filters)
+
+
+def select_radec_rows(
+    release: DataRelease, ra: float, dec: float, radius: float, filters: Filter
+) -> Tuple[Zcatalog, np.ndarray]:
+    """Positions of the primary rows within RADIUS of (RA, DEC) that satisfy FILTERS
+
+    :param release: The data release to use as a data source
+    :param ra: Right Ascension of the target point
+    :param dec: Declination of the target point
+    :param radius: Radius around the target point to search
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The unfiltered healpix zcatalog, and the positions of the selected rows in it
+    """
+    zcatalog = healpix_source(release, filters)
+    log("computing cone")
+    xyz = None
+    if zcatalog is get_preloaded(release.healpix_fits, release.fits_version):
+        xyz = get_unit_vectors(release.healpix_fits, release.fits_version)
+    if xyz is not None:
+        rows = cone_search_vectors(xyz, ra, dec, radius)
+    else:
+        rows = cone_search(zcatalog["TARGET_RA"], zcatalog["TARGET_DEC"], ra, dec, radius)
+    rows = rows[np.asarray(zcatalog["ZCAT_PRIMARY"])[rows] == True]
+    log("applying filter index")
+    return zcatalog, filter_rows(zcatalog, rows, filters)
+
+
+def select_region_rows(
+    release: DataRelease, params: Union[BoxParameters, PolygonParameters], filters: Filter
+) -> Tuple[Zcatalog, np.ndarray]:
+    """Positions of the primary rows inside a box or polygon that satisfy FILTERS. Only the rows in the region's declination range are tested, see `sky.DecIndex`
+
+    :param release: The data release to use as a data source
+    :param params: The box or polygon to search
+    :param filters: The set of filters that restricts which targets are selected
+    :returns: The unfiltered healpix zcatalog, and the positions of the selected rows in it
+    """
+    region = sky_region(params)
+    zcatalog = healpix_source(release, filters)
+    index = DEC_INDEXES.get(sky_index_key(release, zcatalog), lambda: build_dec_index(zcatalog))
+    log("searching region")
+    rows = region_search(region, index, zcatalog["TARGET_RA"], zcatalog["TARGET_DEC"])
+    log("applying filter index")
+    return zcatalog, filter_rows(zcatalog, rows, filters)
+
+
+def sky_index_key(release: DataRelease, zcatalog: Zcatalog) -> Tuple:
+    """Identifies the rows of the healpix catalog, whichever source they were read from. They all change with the release's version"""
+    return (release.healpix_fits, release.version, len(zcatalog))
+
+
+def build_sky_tree(zcatalog: Zcatalog) -> SkyTree:
+    log("building sky tree")
+    primary = np.flatnonzero(np.asarray(zcatalog["ZCAT_PRIMARY"]) == True)
+    return SkyTree(np.asarray(zcatalog["TARGET_RA"]), np.asarray(zcatalog["TARGET_DEC"]), primary)
+
+
+def build_dec_index(zcatalog: Zcatalog) -> DecIndex:
+    log("building declination index")
+    primary = np.flatnonzero(np.asarray(zcatalog["ZCAT_PRIMARY"]) == True)
+    return DecIndex(np.asarray(zcatalog["TARGET_DEC"]), primary)
+
+
+def select_zcatalog(
+    release: DataRelease, endpoint: Endpoint, params: Parameters, filters: Filter
+) -> Tuple[Zcatalog, np.ndarray]:
+    """Dispatch to the row selection for ENDPOINT, see the `select_*_rows` functions"""
+    if endpoint == Endpoint.TILE:
+        return select_tile_rows(release, {params.tile: params.fibers}, filters)
+    elif endpoint == Endpoint.TILES:
+        return select_tile_rows(release, params.tiles, filters)
+    elif endpoint == Endpoint.TARGETS:
+        return select_target_rows(release, params.target_ids, filters)
+    elif endpoint == Endpoint.RADEC:
+        return select_radec_rows(release, params.ra, params.dec, params.radius, filters)
+    elif endpoint in (Endpoint.BOX, Endpoint.POLYGON):
+        return select_region_rows(release, params, filters)
+    else:
+        raise MalformedRequestException("Invalid Endpoint")
 
 
 def unfiltered_zcatalog(
@@ -248,41 +663,49 @@ def unfiltered_zcatalog(
     numpy_file: str,
     dtype_file: str,
     fits_file: str,
+    projected: bool = False,
+    version: Optional[str] = None,
 ) -> Zcatalog:
     """Attempt to read zcat info from several sources, starting with the most performant and falling back to other methods if necessary.
     Order is:
-    1. Preloaded/cached data (contains a limited set of columns)
+    1. Preloaded/cached data (contains a limited set of columns, skipped while the release is still loading)
     2. Numpy memmapped file (contains the full set of columns)
-    3. FITS file (if the other methods fail)
+    3. HDF5 file, read lazily (see `hdf5.Hdf5Zcatalog`)
+    4. FITS file (if the other methods fail)
 
     :param desired_columns: List of columns to read from the file
     :param numpy_file: Data file from which to read a thing
     :param dtype_file: File containing the pickled datatype for the numpy array
     :param fits_file: Original fits file where the data is stored
-    :param hdf5_file: TODO
+    :param hdf5_file: HDF5 file with one dataset per column
+    :param version: Version of the release's FITS files (`DataRelease.fits_version`), preloaded data read from any other version isn't used
+    :param projected: Whether only DESIRED_COLUMNS are wanted (the request has a `columns` param). The memmap is then cut down to those columns, and the preload is used whenever it has them all. Otherwise the memmap comes with every column
     :returns:
     """
 
+    if projected:
+        desired_columns = unique_columns(desired_columns)
     if (
         desired_columns == DESIRED_COLUMNS_TARGET
         or desired_columns == DESIRED_COLUMNS_TILE
+        or projected
     ):
         log("checking preloaded fits")
-        preloaded_fits = preload_fits(PRELOAD_RELEASES)
-        log("preload accessed")
-        if fits_file in preloaded_fits.keys():
+        preloaded = get_preloaded(fits_file, version)
+        if preloaded is not None and set(desired_columns) <= set(zcatalog_columns(preloaded)):
             log("used preloaded fits")
-            return preloaded_fits.get(fits_file)
+            return preloaded
 
     try:
         log("reading zcatalog info from", numpy_file)
-        return memmap.read_memmap(numpy_file, dtype_file)
+        return memmap.read_memmap(numpy_file, dtype_file, desired_columns if projected else None)
     except Exception as e:
         log(e)
 
     try:
         log("reading zcatalog info from", hdf5_file)
-        return hdf5.from_hdf5_datasets(hdf5_file, desired_columns)
+        # Rows are only read from the file once we know which ones we need
+        return hdf5.Hdf5Zcatalog(hdf5_file, desired_columns)
     except Exception as e:
         log(e)
 
@@ -294,17 +717,29 @@ def unfiltered_zcatalog(
     )
 
 
+def zcatalog_columns(zcatalog: Zcatalog) -> List[str]:
+    if isinstance(zcatalog, CategoricalZcatalog):
+        return list(zcatalog.data.dtype.names)
+    return list(zcatalog.dtype.names)
+
+
 def get_target_spectra_from_metadata(
     release: DataRelease, targets: Zcatalog
 ) -> Spectra:
     """
-    Given a list of TARGETS with populated metadata, retrieve each of their spectra as a list. Uses some trickery to ensure that the constructed Zcatalog has the target IDs in the original order specified
+    Given a list of TARGETS with populated metadata, retrieve each of their spectra as a list. Uses some trickery to ensure that the constructed Zcatalog has the target IDs in the original order specified.
+    Spectra of recently requested targets come from the fragment cache (see `fragments.py`), only the rest are read from disk.
 
     :param release: The data release to use as a data source
     :param targets: A list of Target objects
     :returns: A list of Spectra objects, one for each target passed in
     """
-    target_spectra = desispec.io.read_spectra_parallel(targets, specprod=release.name)
+    import desispec.io
+    from astropy.table import Table, vstack
+
+    if cost_limits() is not None:
+        check_cost(target_spectra_cost(release, targets))
+    target_spectra = read_target_spectra(release, targets)
     redrock_to_targets = dict()
     for target in targets:
         redrock_file = desispec.io.findfile(
@@ -332,40 +767,24 @@ def get_target_spectra_from_metadata(
     return target_spectra
 
 
-def clause_from_filter(key: str, value: str, targets: Zcatalog) -> Clause:
-    """Given a column name KEY and a filter string VALUE of the form '<operation><value>' and a ZCATALOG of target metadata, create a boolean array where Arr[i] is true iff the i^th record satisfies the filter.
-
-    :param key: The name of the column to filter on
-    :param value: The value of the filter, a string containing a comparison (one of >,<,=) and a value to compare against
-    :param targets: The Zcatalog data from which to filter out targets
-    :returns: A boolean mask that can be applied to the Zcatalog to remove anything that doesn't apply the filter
-    """
-    operator_fns = {
-        ">": operator.gt,
-        "=": operator.eq,
-        "<": operator.lt,
-        "*": lambda x, y: True,
-    }
-    key = key.upper()
-    op = value[0]
-    if op not in operator_fns.keys():
-        func = operator_fns["="]
-        return func(targets[key], value)
-
-    func = operator_fns[op]
-    if op == "*":
-        value = ""
-    else:
-        value = value[1:]
-        try:
-            value = float(value)
-        except ValueError:
-            pass
-
-    return func(targets[key], value)
-
-
-def table_shape(table: np.ndarray | Table):
+def with_columns(zcat: Zcatalog, columns: Dict[str, np.ndarray]) -> Zcatalog:
+    """A copy of ZCAT (an ndarray or astropy Table) with COLUMNS added on the end"""
+    if not isinstance(zcat, np.ndarray):
+        zcat = zcat.copy(copy_data=False)
+        for name, values in columns.items():
+            zcat[name] = values
+        return zcat
+    dtype = [(name, zcat.dtype.fields[name][0]) for name in zcat.dtype.names]
+    dtype += [(name, values.dtype) for name, values in columns.items()]
+    out = np.empty(len(zcat), dtype=dtype)
+    for name in zcat.dtype.names:
+        out[name] = zcat[name]
+    for name, values in columns.items():
+        out[name] = values
+    return out
+
+
+def table_shape(table: Union[np.ndarray, Zcatalog]):
     """A generalisation of array.shape that also works on astropy tables. Returns a tuple (rows, columns)
 
     :param table:
@@ -375,16 +794,29 @@ def table_shape(table: np.ndarray | Table):
 
     if isinstance(table, np.ndarray):
         return table.shape
-    elif isinstance(table, Table):
+    else:
         return (len(table), len(table.columns))
 
 
+def filter_clause(zcatalog: Zcatalog, filters: Filter) -> Clause:
+    """Combine every (non-special) filter in FILTERS into a single boolean mask over the rows of ZCATALOG
+
+    :param zcatalog: The Zcatalog data to evaluate the filters on
+    :param filters: A dictionary of filters of the form {column_name: "<expression>"}, see filters.py for the expressions
+    :returns: A boolean mask, true for every record satisfying all of the filters
+    """
+    predicate = compile_filters(filters)
+    if predicate is None:
+        return np.full(len(zcatalog), True, dtype=bool)
+    return predicate.evaluate(zcatalog)
+
+
 def filter_zcatalog(zcatalog: Zcatalog, filters: Filter) -> Zcatalog:
     """Given a collection of FILTERS of the form {column_name: "<test><value>"}, filter the ZCAT to only include records which satisfy all of those filters and return that filtered copy.
 
-    :param zcatalog: TODO
-    :param filters: TODO
-    :returns:
+    :param zcatalog: The Zcatalog data to filter
+    :param filters: A dictionary of filters of the form {column_name: "<expression>"}, see filters.py for the expressions
+    :returns: The records of ZCATALOG satisfying every filter
 
     """
     # Speed trick for when there are no filters
@@ -392,14 +824,7 @@ def filter_zcatalog(zcatalog: Zcatalog, filters: Filter) -> Zcatalog:
     if len(filters)==0:
         log("skipped filter")
         return zcatalog
-    filtered_keep = np.full(table_shape(zcatalog), True, dtype=bool)
-    for k, v in filters.items():
-        if k in SPECIAL_QUERY_PARAMS:
-            pass
-        else:
-            clause = clause_from_filter(k, v, zcatalog)
-            filtered_keep = np.logical_and(filtered_keep, clause)
-    return zcatalog[filtered_keep]
+    return zcatalog[filter_clause(zcatalog, filters)]
 
 
 # Permutation Functions
@@ -414,29 +839,3 @@ def sort_zcat(zcat: Zcatalog, target_ids: Zcatalog) -> Zcatalog:
     sorted_input = np.argsort(target_ids)
     # zcat->sorted, and then reverse input->sorted, so we end up with zcat->sorted->input
     return zcat[sorted_zcat][invert(sorted_input)]
-
-
-@lru_cache(maxsize=1)
-def preload_fits(release_names: Tuple[str]) -> Dict:
-    """Find the Zcatalog fits files for each release, read them into numpy arrays, and reutrn a mapping of filenames to arrays. Intended to be called once on startup, and future calls use the cache instead of reading the files each time.
-
-    :param release_names: A list of releases to read Zcat metadata for
-    :returns: A dict mapping fits file names to ndarrays
-
-    """
-    preloads = dict()
-    for r in release_names:
-        log("reading fits for:", r)
-        try:
-            release = DataRelease(r)
-            log(release.healpix_fits)
-            log(release.tile_fits)
-            preloads[release.healpix_fits] = fitsio.read(
-                release.healpix_fits, "ZCATALOG", columns=DESIRED_COLUMNS_TARGET
-            )
-            preloads[release.tile_fits] = fitsio.read(
-                release.tile_fits, "ZCATALOG", columns=DESIRED_COLUMNS_TILE
-            )
-        except Exception as e:
-            log(e)
-    return preloads
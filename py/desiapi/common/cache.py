@@ -21,7 +21,10 @@ def check_cache(
     cache_path = f"{cache_path}/{req.get_cache_path()}"
     print(cache_path)
     if os.path.isdir(cache_path):
-        cached_responses = os.listdir(cache_path)
+        # Sidecar files (paging information, table data) accompany a response, they aren't responses themselves
+        cached_responses = [
+            f for f in os.listdir(cache_path) if not f.endswith(CACHE_SIDECAR_SUFFIXES)
+        ]
         most_recent = (
             max(cached_responses, key=basename) if len(cached_responses) else None
         )
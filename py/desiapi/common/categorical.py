@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import json
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from .models import CATEGORICAL_COLUMNS
+
+# SURVEY and PROGRAM only take a handful of values, but as fixed-width unicode they cost 4 bytes per character per row,
+# and filtering on them compares strings over every row. In the preload and the intermediate files they are stored as
+# one-byte codes instead, along with the list of values the codes stand for (the "categories" of each column).
+#
+# A CategoricalZcatalog wraps such an array. Columns come back as codes, so filters can compare integers (see
+# `filters.InList`), while rows come back decoded, so only the rows that end up in a response are turned back into
+# strings.
+
+CODE_TYPE = np.uint8
+MAX_CATEGORIES = np.iinfo(CODE_TYPE).max + 1
+
+Categories = Dict[str, dict]  # column -> {"dtype": original dtype string, "values": [value of each code]}
+
+
+def categorical_columns(dtype: np.dtype, columns: List[str] = CATEGORICAL_COLUMNS) -> List[str]:
+    """The COLUMNS of DTYPE that can be encoded: scalar unicode fields"""
+    return [
+        name
+        for name in columns
+        if name in (dtype.names or ()) and dtype[name].kind == "U" and dtype[name].shape == ()
+    ]
+
+
+class CategoryEncoder:
+    """Encodes the categorical columns of a structured array, a block of rows at a time. Codes are given out in the order values are first seen, so every block shares one set of categories"""
+
+    def __init__(self, dtype: np.dtype, columns: List[str] = CATEGORICAL_COLUMNS) -> None:
+        self.source_dtype = dtype
+        self.columns = categorical_columns(dtype, columns)
+        self.dtype = np.dtype(
+            [
+                (name, CODE_TYPE if name in self.columns else dtype.fields[name][0])
+                for name in dtype.names
+            ]
+        )
+        self._codes: Dict[str, Dict[str, int]] = {name: dict() for name in self.columns}
+
+    def encode(self, rows: np.ndarray) -> np.ndarray:
+        """ROWS (of the source dtype), with the categorical columns replaced by codes"""
+        if not self.columns:
+            return rows
+        out = np.empty(len(rows), dtype=self.dtype)
+        for name in rows.dtype.names:
+            if name in self._codes:
+                distinct, inverse = np.unique(rows[name], return_inverse=True)
+                lookup = np.array([self._code(name, str(value)) for value in distinct], dtype=CODE_TYPE)
+                out[name] = lookup[inverse]
+            else:
+                out[name] = rows[name]
+        return out
+
+    def _code(self, column: str, value: str) -> int:
+        codes = self._codes[column]
+        if value not in codes:
+            if len(codes) == MAX_CATEGORIES:
+                raise ValueError(f"{column} has more than {MAX_CATEGORIES} distinct values, too many to encode")
+            codes[value] = len(codes)
+        return codes[value]
+
+    def categories(self) -> Categories:
+        return {
+            name: {"dtype": self.source_dtype[name].str, "values": list(self._codes[name])}
+            for name in self.columns
+        }
+
+
+def decode_column(codes: np.ndarray, category: dict) -> np.ndarray:
+    return np.asarray(category["values"], dtype=category["dtype"])[codes]
+
+
+def decode_rows(rows: np.ndarray, categories: Categories) -> np.ndarray:
+    """ROWS of an encoded array, with the categorical columns turned back into strings"""
+    dtype = np.dtype(
+        [
+            (name, np.dtype(categories[name]["dtype"]) if name in categories else rows.dtype.fields[name][0])
+            for name in rows.dtype.names
+        ]
+    )
+    out = np.empty(rows.shape, dtype=dtype)
+    for name in rows.dtype.names:
+        out[name] = decode_column(rows[name], categories[name]) if name in categories else rows[name]
+    return out
+
+
+def read_categories(path: str) -> Categories:
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_categories(path: str, categories: Categories):
+    with open(path, "w") as f:
+        json.dump(categories, f)
+
+
+class CategoricalZcatalog:
+    """A zcatalog array with its categorical columns encoded. Indexing with a column name gives the stored column (codes, for categorical columns), indexing with rows gives those rows decoded"""
+
+    def __init__(self, data: np.ndarray, categories: Categories) -> None:
+        self.data = data
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return decode_rows(self.data[key], self.categories)
+
+    def encoded(self, rows) -> "CategoricalZcatalog":
+        """ROWS, still encoded. For evaluating filters over a subset of rows without decoding it"""
+        return CategoricalZcatalog(self.data[rows], self.categories)
+
+    def select(self, columns: List[str]) -> "CategoricalZcatalog":
+        """Just COLUMNS, as a view, so taking rows from it only copies those columns"""
+        return CategoricalZcatalog(self.data[columns], self.categories)
+
+    def code_for(self, column: str, value: str) -> Optional[int]:
+        """The code for VALUE in COLUMN, or None if no row has that value"""
+        values = self.categories[column]["values"]
+        return values.index(value) if value in values else None
+
+    def decode(self, column: str) -> np.ndarray:
+        return decode_column(self.data[column], self.categories[column])
+
+
+def encode_zcatalog(data: np.ndarray, columns: List[str] = CATEGORICAL_COLUMNS) -> Union[np.ndarray, CategoricalZcatalog]:
+    """Encode the categorical COLUMNS of DATA, already in memory. Arrays without any are returned as they are"""
+    encoder = CategoryEncoder(data.dtype, columns)
+    if not encoder.columns:
+        return data
+    return CategoricalZcatalog(encoder.encode(data), encoder.categories())
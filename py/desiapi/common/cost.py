@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import os
+from typing import Dict, List, Mapping, Optional
+
+import numpy as np
+
+from .errors import RequestTooLargeException
+from .fragments import FRAGMENT_CACHE, fragment_key
+from .models import *
+from .tile_index import latest_tile_night
+from .utils import log
+
+# What a request will cost, worked out from the zcat rows it selects before any spectra are read:
+#   rows            zcat rows the request matches
+#   spectra         spectra it returns, of which cached_spectra are already in the fragment cache
+#   coadd_files     coadd files that have to be opened, i.e those holding a spectrum that isn't cached
+#   redrock_files   redrock files that have to be opened
+#   missing_files   files the request needs that don't exist, so it would fail
+#   bytes_read      estimated bytes read from disk
+#   bytes_returned  estimated size of the response
+# Files are only stat'd, never opened. Spectra are read a row at a time, so a coadd file costs its size or the size
+# of the spectra wanted from it, whichever is smaller, while redrock files are read whole.
+# The server rejects spectra requests over its COST_LIMITS (the [cost_limits] section of the config). The limits on
+# the number of IDs a request may list (see `validate` in server.py) only bound what a request names, these bound what
+# it selects, such as the spectra in a cone. Local reads through the Python API aren't limited.
+
+Cost = Dict[str, int]
+
+_limits: Optional[Dict[str, int]] = None
+
+
+def configure_cost_limits(limits: Optional[Mapping[str, int]]):
+    """Reject spectra requests costing more than LIMITS (keys as in COST_LIMITS) from now on. None removes the limits"""
+    global _limits
+    _limits = None if limits is None else {key: int(value) for key, value in limits.items()}
+
+
+def cost_limits() -> Optional[Dict[str, int]]:
+    return None if _limits is None else dict(_limits)
+
+
+def wants_plan(req: ApiRequest) -> bool:
+    """Whether REQ asks for its plan (`plan=1`) rather than its data"""
+    return str(req.filters.get("plan", "")).lower() in ("1", "true", "yes")
+
+
+def spectrum_bytes() -> int:
+    """Size of one spectrum, the average of those in the fragment cache once there are some"""
+    stats = FRAGMENT_CACHE.stats()
+    if stats["fragments"]:
+        return stats["bytes"] // stats["fragments"]
+    return SPECTRUM_BYTES
+
+
+def file_size(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def files_cost(coadds: Dict[str, int], redrocks: List[str]) -> Cost:
+    """The cost of reading spectra from COADDS (file -> spectra read from it) and reading REDROCKS whole"""
+    size = spectrum_bytes()
+    cost = {"coadd_files": len(coadds), "redrock_files": len(redrocks), "missing_files": 0, "bytes_read": 0}
+    for path, spectra in coadds.items():
+        on_disk = file_size(path)
+        if on_disk is None:
+            cost["missing_files"] += 1
+        else:
+            cost["bytes_read"] += min(on_disk, spectra * size)
+    for path in redrocks:
+        on_disk = file_size(path)
+        if on_disk is None:
+            cost["missing_files"] += 1
+        else:
+            cost["bytes_read"] += on_disk
+    return cost
+
+
+def row_bytes(zcatalog: Zcatalog, rows: np.ndarray, columns: Optional[List[str]]) -> int:
+    """Size of one of ROWS of ZCATALOG, with only COLUMNS if given. Found by reading one row, decoded as a response would be"""
+    if len(rows) == 0:
+        return 0
+    sample = zcatalog[rows[:1]]
+    if columns is not None:
+        sample = np.asarray(sample)[columns]
+    return np.asarray(sample).dtype.itemsize
+
+
+def zcat_cost(zcatalog: Zcatalog, rows: np.ndarray, columns: Optional[List[str]], returned: int) -> Cost:
+    """The cost of a zcat request selecting ROWS of ZCATALOG and returning RETURNED of them (fewer when paged), with COLUMNS"""
+    size = row_bytes(zcatalog, rows, columns)
+    return {
+        "rows": len(rows),
+        "bytes_read": returned * size,
+        "bytes_returned": returned * size,
+    }
+
+
+def target_spectra_cost(release: DataRelease, targets: Zcatalog) -> Cost:
+    """The cost of reading the spectra of TARGETS (zcat rows with TARGETID, SURVEY, PROGRAM and HEALPIX) from the healpix coadds, see `get_target_spectra_from_metadata`"""
+    import desispec.io
+
+    cost = {"rows": len(targets), "spectra": len(targets), "cached_spectra": 0}
+    if len(targets) == 0:
+        return dict(cost, **files_cost(dict(), []), bytes_returned=0)
+    groups = np.rec.fromarrays(
+        [np.asarray(targets["SURVEY"]), np.asarray(targets["PROGRAM"]), np.asarray(targets["HEALPIX"])],
+        names=["SURVEY", "PROGRAM", "HEALPIX"],
+    )
+    keys, inverse = np.unique(groups, return_inverse=True)
+    cached = np.array([fragment_key(release, t) in FRAGMENT_CACHE for t in targets["TARGETID"]])
+    cost["cached_spectra"] = int(cached.sum())
+    to_read = np.bincount(inverse.ravel()[~cached], minlength=len(keys))
+    coadds, redrocks = dict(), []
+    for (survey, program, healpix), spectra in zip(keys.tolist(), to_read.tolist()):
+        location = dict(survey=survey, faprogram=program, groupname="healpix", healpix=healpix, specprod_dir=release.directory)
+        if spectra:
+            coadds[desispec.io.findfile("coadd", **location)] = spectra
+        redrocks.append(desispec.io.findfile("redrock", **location))
+    cost.update(files_cost(coadds, redrocks))
+    cost["bytes_returned"] = len(targets) * spectrum_bytes()
+    return cost
+
+
+def tile_spectra_cost(release: DataRelease, tiles: Dict[int, List[int]]) -> Cost:
+    """The cost of reading FIBERS of each of TILES from their latest cumulative coadds, see `get_tile_spectra`. Each petal of 500 fibers has its own coadd and redrock file"""
+    import desispec.io
+
+    fibers = sum(len(tile_fibers) for tile_fibers in tiles.values())
+    coadds, redrocks = dict(), []
+    for tile, tile_fibers in tiles.items():
+        night = latest_tile_night(release, tile)
+        petals, counts = np.unique(np.asarray(tile_fibers, dtype=np.int64) // 500, return_counts=True)
+        for petal, spectra in zip(petals.tolist(), counts.tolist()):
+            location = dict(tile=tile, night=night, spectrograph=petal, groupname="cumulative", specprod_dir=release.directory)
+            coadds[desispec.io.findfile("coadd", **location)] = spectra
+            redrocks.append(desispec.io.findfile("redrock", **location))
+    cost = {"rows": fibers, "spectra": fibers, "cached_spectra": 0}
+    cost.update(files_cost(coadds, redrocks))
+    cost["bytes_returned"] = fibers * spectrum_bytes()
+    return cost
+
+
+def over_limits(cost: Cost, limits: Optional[Mapping[str, int]]) -> List[str]:
+    """Descriptions of each of LIMITS that COST exceeds"""
+    if not limits:
+        return []
+    measured = {
+        "spectra": cost.get("spectra", 0),
+        "files": cost.get("coadd_files", 0) + cost.get("redrock_files", 0),
+        "bytes_read": cost.get("bytes_read", 0),
+    }
+    return [
+        f"{measured[key]} {key.replace('_', ' ')} (at most {limit})"
+        for key, limit in limits.items()
+        if key in measured and measured[key] > limit
+    ]
+
+
+def check_cost(cost: Cost):
+    """Raise RequestTooLargeException if COST is over the configured limits"""
+    exceeded = over_limits(cost, _limits)
+    if exceeded:
+        log("rejecting request costing", cost)
+        raise RequestTooLargeException(
+            f"request is too large: {', '.join(exceeded)}. Add filters or split it into smaller requests",
+            cost,
+            dict(_limits),
+        )
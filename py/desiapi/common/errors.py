@@ -15,3 +15,21 @@ class ServerFailedException(DesiApiException):
 
 class SqlException(DesiApiException):
     pass
+
+
+class ServerBusyException(DesiApiException):
+    """The server is too busy to take on a request now. STATUS is the HTTP status to answer with (429 or 503), RETRY_AFTER the seconds the client should wait before trying again"""
+
+    def __init__(self, message: str, status: int, retry_after: int) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RequestTooLargeException(DesiApiException):
+    """The request is well-formed, but would cost more than the server's limits allow (see cost.py). COST is what it would cost, LIMITS the limits it was checked against"""
+
+    def __init__(self, message: str, cost: dict, limits: dict) -> None:
+        super().__init__(message)
+        self.cost = cost
+        self.limits = limits
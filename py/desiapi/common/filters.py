@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import List, Optional, Set
+
+import numpy as np
+
+from .categorical import CategoricalZcatalog
+from .errors import MalformedRequestException
+from .models import SPECIAL_QUERY_PARAMS, Clause, Filter, Zcatalog
+
+# Filters are query params of the form COLUMN=<expression>, where an expression is one of:
+#   *                  any value, only adds COLUMN to the response
+#   a  or  =a          equal to a
+#   =a,b,c             equal to any of a, b and c
+#   !=a,b              equal to none of a and b
+#   >x, <x, >=x, <=x   comparisons
+#   x..y               between x and y inclusive, either end can be left off
+#   e1|e2|...          any of the alternatives. Alternatives after the first can test a different column by starting
+#                      with its name and a colon, so `Z=>2|SPECTYPE:QSO` is "Z > 2 or SPECTYPE = QSO"
+# Filters on different columns must all hold. Each expression is parsed once into a tree of predicates, which are
+# evaluated a whole column at a time. Values are converted to the type of the column they are compared with when the
+# predicate is evaluated, so parsing doesn't need the catalog.
+
+OPERATORS = ["!=", ">=", "<=", ">", "<", "="]  # Longest first, so ">=" isn't read as ">"
+OTHER_COLUMN = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*):(.*)$")
+
+
+def coerce(dtype: np.dtype, column: str, text: str):
+    """TEXT as a value comparable with a column of DTYPE. Integers are parsed as such, since 64 bit IDs don't survive a round trip through float"""
+    try:
+        match dtype.kind:
+            case "i" | "u":
+                try:
+                    return int(text)
+                except ValueError:
+                    return float(text)
+            case "f":
+                return float(text)
+            case "b":
+                return {"true": True, "1": True, "false": False, "0": False}[text.lower()]
+            case "S":
+                return text.encode()
+            case _:
+                return text
+    except (ValueError, KeyError):
+        raise MalformedRequestException(f"{column} can't be compared with {text}")
+
+
+def column_values(targets: Zcatalog, column: str) -> np.ndarray:
+    if isinstance(targets, CategoricalZcatalog) and column in targets.categories:
+        return targets.decode(column)
+    return np.asarray(targets[column])
+
+
+class Predicate(ABC):
+    """A test on the rows of a zcatalog"""
+
+    def columns(self) -> Set[str]:
+        """The columns the test reads"""
+        return set()
+
+    @abstractmethod
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        """A boolean mask, true for the rows of TARGETS that pass"""
+
+    def index_rows(self, zcatalog) -> Optional[np.ndarray]:
+        """The rows (ascending) of ZCATALOG that pass, found from its sorted indexes without reading any rows. None if it doesn't have the indexes to answer this"""
+        return None
+
+
+class Everything(Predicate):
+    def __init__(self, column: str) -> None:
+        self.column = column
+
+    def columns(self) -> Set[str]:
+        return {self.column}
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        return np.ones(len(targets), dtype=bool)
+
+
+class Compare(Predicate):
+    """COLUMN > VALUE or COLUMN < VALUE"""
+
+    def __init__(self, column: str, op: str, value: str) -> None:
+        self.column = column
+        self.op = op
+        self.value = value
+
+    def columns(self) -> Set[str]:
+        return {self.column}
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        values = column_values(targets, self.column)
+        value = coerce(values.dtype, self.column, self.value)
+        return values > value if self.op == ">" else values < value
+
+
+class InList(Predicate):
+    """COLUMN is one of VALUES, or none of them if NEGATE"""
+
+    def __init__(self, column: str, values: List[str], negate: bool = False) -> None:
+        self.column = column
+        self.values = values
+        self.negate = negate
+
+    def columns(self) -> Set[str]:
+        return {self.column}
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        if isinstance(targets, CategoricalZcatalog) and self.column in targets.categories:
+            # Compare codes, no strings involved. Values no row has can't match
+            codes = [targets.code_for(self.column, value) for value in self.values]
+            keep = np.isin(targets[self.column], [code for code in codes if code is not None])
+        else:
+            values = np.asarray(targets[self.column])
+            keep = np.isin(values, [coerce(values.dtype, self.column, value) for value in self.values])
+        return ~keep if self.negate else keep
+
+    def index_rows(self, zcatalog) -> Optional[np.ndarray]:
+        dtype = zcatalog.index_dtype(self.column)
+        if dtype is None or self.negate:
+            return None
+        return zcatalog.lookup(self.column, [coerce(dtype, self.column, value) for value in self.values])
+
+
+class Range(Predicate):
+    """LOW <= COLUMN <= HIGH, either bound may be None"""
+
+    def __init__(self, column: str, low: Optional[str], high: Optional[str]) -> None:
+        self.column = column
+        self.low = low
+        self.high = high
+
+    def columns(self) -> Set[str]:
+        return {self.column}
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        values = column_values(targets, self.column)
+        keep = np.ones(len(values), dtype=bool)
+        if self.low is not None:
+            keep &= values >= coerce(values.dtype, self.column, self.low)
+        if self.high is not None:
+            keep &= values <= coerce(values.dtype, self.column, self.high)
+        return keep
+
+    def index_rows(self, zcatalog) -> Optional[np.ndarray]:
+        dtype = zcatalog.index_dtype(self.column)
+        if dtype is None:
+            return None
+        low = None if self.low is None else coerce(dtype, self.column, self.low)
+        high = None if self.high is None else coerce(dtype, self.column, self.high)
+        return zcatalog.lookup_range(self.column, low, high)
+
+
+class AnyOf(Predicate):
+    def __init__(self, parts: List[Predicate]) -> None:
+        self.parts = parts
+
+    def columns(self) -> Set[str]:
+        return set().union(*[part.columns() for part in self.parts])
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        keep = np.zeros(len(targets), dtype=bool)
+        for part in self.parts:
+            keep |= part.evaluate(targets)
+        return keep
+
+    def index_rows(self, zcatalog) -> Optional[np.ndarray]:
+        found = [part.index_rows(zcatalog) for part in self.parts]
+        if any(rows is None for rows in found):
+            return None
+        return np.unique(np.concatenate(found))
+
+
+class AllOf(Predicate):
+    def __init__(self, parts: List[Predicate]) -> None:
+        self.parts = parts
+
+    def columns(self) -> Set[str]:
+        return set().union(*[part.columns() for part in self.parts])
+
+    def evaluate(self, targets: Zcatalog) -> Clause:
+        keep = np.ones(len(targets), dtype=bool)
+        for part in self.parts:
+            keep &= part.evaluate(targets)
+        return keep
+
+
+def parse_term(column: str, text: str) -> Predicate:
+    """A single test on COLUMN, see the grammar above"""
+    if text.startswith("*"):
+        return Everything(column)
+    for op in OPERATORS:
+        if text.startswith(op):
+            value = text[len(op) :]
+            match op:
+                case "=":
+                    return InList(column, value.split(","))
+                case "!=":
+                    return InList(column, value.split(","), negate=True)
+                case ">=":
+                    return Range(column, value, None)
+                case "<=":
+                    return Range(column, None, value)
+                case _:
+                    return Compare(column, op, value)
+    if ".." in text:
+        low, high = text.split("..", 1)
+        return Range(column, low or None, high or None)
+    return InList(column, text.split(","))
+
+
+@lru_cache(maxsize=1024)
+def parse_filter(column: str, text: str) -> Predicate:
+    """Parse the filter COLUMN=TEXT into a predicate tree
+
+    :param column: The query param's name, the column tested unless an alternative names another one
+    :param text: The query param's value, an expression in the grammar above
+    :returns: The predicate, shared between every request with the same filter, so it must not be modified
+    """
+    alternatives = text.split("|")
+    parts = [parse_term(column.upper(), alternatives[0])]
+    for alternative in alternatives[1:]:
+        other = OTHER_COLUMN.match(alternative)
+        if other:
+            parts.append(parse_term(other.group(1).upper(), other.group(2)))
+        else:
+            parts.append(parse_term(column.upper(), alternative))
+    return parts[0] if len(parts) == 1 else AnyOf(parts)
+
+
+def compile_filters(filters: Filter) -> Optional[AllOf]:
+    """All the (non-special) filters in FILTERS, as one predicate. None if there aren't any"""
+    parts = [parse_filter(k, v) for k, v in filters.items() if k not in SPECIAL_QUERY_PARAMS]
+    return AllOf(parts) if parts else None
+
+
+def filter_columns(filters: Filter) -> List[str]:
+    """Every column FILTERS read, in a fixed order"""
+    predicate = compile_filters(filters)
+    return sorted(predicate.columns()) if predicate else []
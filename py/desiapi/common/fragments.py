@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .models import DataRelease, FRAGMENT_CACHE_SIZE, Spectra, Zcatalog
+from .utils import get_max_cache_size, log
+
+# Overlapping requests (popular targets, nearby radec cones) keep re-reading the same rows of the same healpix
+# coadd files. We keep each target's spectrum as a "fragment" in an LRU cache keyed by (release, version, TARGETID), so that
+# a request only has to read the targets nobody has asked for recently. The version is that of the release's FITS
+# (`DataRelease.fits_version`), so rebuilding the intermediate files doesn't throw away spectra that haven't changed.
+
+
+def fragment_key(release: DataRelease, target_id) -> tuple:
+    """The key TARGET_ID's spectrum from RELEASE is cached under"""
+    return release.name, release.fits_version, int(target_id)
+
+
+@dataclass
+class SpectrumFragment:
+    """The spectrum of a single target, stored compactly.
+
+    Coadd files store flux, ivar and resolution data as float32, and `read_spectra` upcasts them to float64, so
+    storing them as float32 here halves the memory used without losing any precision.
+    """
+
+    bands: List[str]
+    wave: Dict[str, np.ndarray]  # Shared between all fragments read in the same batch
+    flux: Dict[str, np.ndarray]
+    ivar: Dict[str, np.ndarray]
+    mask: Optional[Dict[str, np.ndarray]]
+    resolution_data: Optional[Dict[str, np.ndarray]]
+    fibermap: np.ndarray  # A single row
+    exp_fibermap: Optional[np.ndarray]  # All exposures of this target
+    scores: Optional[np.ndarray]  # A single row
+    meta: dict
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.fibermap] + [
+            a
+            for band_arrays in [self.flux, self.ivar, self.mask, self.resolution_data]
+            if band_arrays is not None
+            for a in band_arrays.values()
+        ]
+        arrays += [a for a in [self.exp_fibermap, self.scores] if a is not None]
+        return sum(a.nbytes for a in arrays)
+
+
+def _single(band_arrays: Optional[Dict[str, np.ndarray]], i: int) -> Optional[Dict[str, np.ndarray]]:
+    if band_arrays is None:
+        return None
+    return {band: band_arrays[band][i].astype(np.float32) for band in band_arrays}
+
+
+def _table_rows(table, rows) -> Optional[np.ndarray]:
+    if table is None:
+        return None
+    return np.asarray(table[rows]).copy()
+
+
+def split_spectra(spectra: Spectra) -> List[SpectrumFragment]:
+    """Split a Spectra object into one fragment per spectrum, in order"""
+    wave = {band: spectra.wave[band] for band in spectra.bands}
+    fragments = []
+    exp_ids = spectra.exp_fibermap["TARGETID"] if spectra.exp_fibermap is not None else None
+    for i, target_id in enumerate(spectra.fibermap["TARGETID"]):
+        fragments.append(
+            SpectrumFragment(
+                bands=list(spectra.bands),
+                wave=wave,
+                flux=_single(spectra.flux, i),
+                ivar=_single(spectra.ivar, i),
+                mask=(
+                    {band: spectra.mask[band][i].copy() for band in spectra.bands}
+                    if spectra.mask is not None
+                    else None
+                ),
+                resolution_data=_single(spectra.resolution_data, i),
+                fibermap=_table_rows(spectra.fibermap, slice(i, i + 1)),
+                exp_fibermap=(
+                    _table_rows(spectra.exp_fibermap, exp_ids == target_id)
+                    if exp_ids is not None
+                    else None
+                ),
+                scores=_table_rows(spectra.scores, slice(i, i + 1)),
+                meta=spectra.meta,
+            )
+        )
+    return fragments
+
+
+def _concatenate_rows(rows: List[np.ndarray]):
+    """Stack per-fragment table rows into a single astropy Table. Rows read by different requests can have different string widths, in which case we let astropy work out a common dtype"""
+    from astropy.table import Table, vstack
+
+    if all(r.dtype == rows[0].dtype for r in rows):
+        return Table(np.concatenate(rows))
+    return vstack([Table(r) for r in rows])
+
+
+def compatible(fragments: List[SpectrumFragment]) -> bool:
+    """Whether FRAGMENTS can be combined into one Spectra object (same bands, wavelength grid, and optional data)"""
+    first = fragments[0]
+    for f in fragments[1:]:
+        if f.bands != first.bands:
+            return False
+        if (f.mask is None) != (first.mask is None) or (f.resolution_data is None) != (first.resolution_data is None):
+            return False
+        if (f.exp_fibermap is None) != (first.exp_fibermap is None) or (f.scores is None) != (first.scores is None):
+            return False
+        if f.wave is not first.wave and not all(
+            np.array_equal(f.wave[band], first.wave[band]) for band in first.bands
+        ):
+            return False
+    return True
+
+
+def assemble_fragments(fragments: List[SpectrumFragment]) -> Spectra:
+    """Combine FRAGMENTS, in order, into a single Spectra object equivalent to reading them from the coadd files"""
+    from desispec.spectra import Spectra
+
+    first = fragments[0]
+    bands = first.bands
+
+    def stack(attribute: str, dtype=None):
+        if getattr(first, attribute) is None:
+            return None
+        return {
+            band: np.stack([getattr(f, attribute)[band] for f in fragments]).astype(dtype or first.flux[band].dtype)
+            for band in bands
+        }
+
+    return Spectra(
+        bands=bands,
+        wave={band: first.wave[band].copy() for band in bands},
+        flux=stack("flux", np.float64),
+        ivar=stack("ivar", np.float64),
+        mask=stack("mask", first.mask[bands[0]].dtype if first.mask is not None else None),
+        resolution_data=stack("resolution_data", np.float64),
+        fibermap=_concatenate_rows([f.fibermap for f in fragments]),
+        exp_fibermap=(
+            _concatenate_rows([f.exp_fibermap for f in fragments])
+            if first.exp_fibermap is not None
+            else None
+        ),
+        scores=(
+            _concatenate_rows([f.scores for f in fragments])
+            if first.scores is not None
+            else None
+        ),
+        meta=dict(first.meta) if first.meta is not None else None,
+    )
+
+
+class FragmentCache:
+    """A thread-safe LRU cache of SpectrumFragments, bounded by the total size of the fragments in bytes"""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._fragments: OrderedDict[Tuple[str, str, int], SpectrumFragment] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[SpectrumFragment]:
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._fragments.move_to_end(key)
+            return fragment
+
+    def __contains__(self, key: Tuple[str, str, int]) -> bool:
+        """Whether KEY is cached, without counting as a hit or miss or refreshing its place in the LRU order"""
+        with self._lock:
+            return key in self._fragments
+
+    def put(self, key: Tuple[str, str, int], fragment: SpectrumFragment):
+        size = fragment.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._fragments.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._fragments[key] = fragment
+            self.nbytes += size
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._fragments:
+            _, evicted = self._fragments.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "fragments": len(self._fragments),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+FRAGMENT_CACHE = FragmentCache(get_max_cache_size(FRAGMENT_CACHE_SIZE))
+
+
+def configure_fragment_cache(max_size: str):
+    """Resize the shared fragment cache, MAX_SIZE is human-readable like the cache `max_size` config ('512mb')"""
+    FRAGMENT_CACHE.resize(get_max_cache_size(max_size))
+
+
+def read_target_spectra(release: DataRelease, targets: Zcatalog) -> Spectra:
+    """Read the spectra of TARGETS (a zcatalog with TARGETID, SURVEY, PROGRAM and HEALPIX) in order, taking as many as possible from the fragment cache and reading only the rest from the healpix coadd files.
+
+    :param release: The data release to use as a data source
+    :param targets: Zcatalog rows of the targets to read
+    :returns: A Spectra object with one spectrum per target, in the same order as TARGETS
+    """
+    import desispec.io
+
+    keys = [fragment_key(release, t) for t in targets["TARGETID"]]
+    fragments = [FRAGMENT_CACHE.get(key) for key in keys]
+    missing = np.array([f is None for f in fragments])
+    log(f"{len(keys) - missing.sum()} of {len(keys)} spectra found in fragment cache")
+
+    if missing.any():
+        spectra = desispec.io.read_spectra_parallel(targets[missing], specprod=release.name)
+        read = split_spectra(spectra)
+        for i, fragment in zip(np.flatnonzero(missing), read):
+            fragments[i] = fragment
+            FRAGMENT_CACHE.put(keys[i], fragment)
+        if missing.all():
+            return spectra
+
+    if not compatible(fragments):
+        log("cached fragments are incompatible, rereading all targets")
+        return desispec.io.read_spectra_parallel(targets, specprod=release.name)
+    return assemble_fragments(fragments)
@@ -1,42 +1,92 @@
 #!/usr/bin/env ipython3
+import hashlib
+import json
 import os
+import threading
+import time
 from dataclasses import dataclass, asdict, field
 from enum import Enum
-from typing import List, Mapping, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
 
-from .utils import list_directories
+from .utils import list_directories, log
 
 from numpy import ndarray
 
-from .errors import MalformedRequestException
+from .errors import DataNotFoundException, DesiApiException, MalformedRequestException
 
-from astropy.table import Table
-
-
-from desispec.spectra import Spectra as DesiSpectra
+# astropy.table and desispec take seconds to import, so they are only imported where they are actually used
+if TYPE_CHECKING:
+    from astropy.table import Table
+    from desispec.spectra import Spectra as DesiSpectra
 
  # TODO doc this file
 # Type aliases my beloved
 DataFrame = ndarray
 Target = DataFrame
 Filter = Mapping[str, str]
-Zcatalog = Table
+Zcatalog = "Table"
 Clause = List[bool]  # A boolean mask, used in filtering Zcatalogs
-Spectra = DesiSpectra
+Spectra = "DesiSpectra"
 
-PRELOAD_RELEASES = ("fujilite", "jura", "iron")
+PRELOAD_RELEASES = ("fujilite", "jura", "iron")  # Preloaded when the config file doesn't say otherwise
 # PRELOAD_RELEASES = ("fujilite",)
+RELEASE_ALIASES = {"edr": "fuji", "dr1": "iron"}  # Public names of releases, and the directories they live in
+RELEASE_REFRESH_INTERVAL = 600  # Seconds before a release's files are looked up again, in case a new zcatalog version has appeared
 MEMMAP_DIR = os.path.expandvars("$DESI_API_INTERMEDIATE/memmap")
 HDF5_DIR = os.path.expandvars("$DESI_API_INTERMEDIATE/hdf5")
 DTYPES_DIR = os.path.expandvars("$DESI_API_INTERMEDIATE/dtypes")
+MANIFEST_FILE = os.path.expandvars("$DESI_API_INTERMEDIATE/manifest.json")  # Source FITS the intermediates were built from, see convert/build.py
 SPECTRO_REDUX = os.getenv("DESI_SPECTRO_REDUX")
 # CACHE = "/cache" # Where we mount cache
 DEFAULT_CONF = "/config/default.toml"
 USER_CONF = "/config/config.toml"
 # DEFAULT_FILETYPE = "fits"  # The default filetype for zcat files
 DEFAULT_FILETYPE = "json"  # The default filetype for zcat files
+TILE_READ_WORKERS = 8  # Maximum number of tiles read concurrently for a multi-tile request
+FRAGMENT_CACHE_SIZE = "512mb"  # Default memory budget for cached per-target spectra, see fragments.py
+DEFAULT_PAGE_SIZE = 1000  # Rows per zcat page when a cursor is given without a limit
+MAX_PAGE_SIZE = 100_000  # Largest limit accepted for a single zcat page
+ROW_INDEX_CACHE_SIZE = "256mb"  # Memory budget for the cached row positions behind paged zcat requests, see paging.py
+PLOT_REBIN_FACTOR = 4  # Pixels combined into one for spectra plots, see rebin.py
+CACHE_SIDECAR_SUFFIXES = (".meta", ".table.npy", ".tmp")  # Files in a cache directory that aren't responses (sidecars, and responses still being written)
+MAX_CACHE_DIR_LENGTH = 200  # Cache directory names longer than this are replaced by a hash
+HDF5_CHUNK_ROWS = 65536  # Rows per chunk of each HDF5 column, the unit HDF5 reads and decompresses
+HDF5_COMPRESSION = "lzf"  # Fast to decompress, which matters more than size for column scans
+HDF5_INDEX_COLUMNS = ["TARGETID", "TILEID"]  # Columns HDF5 files get a sorted index for, see convert/hdf5.py
+CATEGORICAL_COLUMNS = ["SURVEY", "PROGRAM"]  # Low-cardinality string columns stored as integer codes, see categorical.py
+CONVERT_WORKERS = 2  # Catalogs converted at once
+CONVERT_CHUNK_ROWS = 250_000  # Rows read from the FITS at a time when converting, which bounds the memory a conversion needs
+CONE_CHUNK_ROWS = 65536  # Rows tested at a time by the cone search, which sizes its scratch buffers, see sky.py
+MAX_TARGET_IDS = 500  # Most target IDs the server accepts in a single spectra plot request, and the Python client sends at once
+MAX_FIBERS = 500  # Most fibers the server accepts in a single spectra plot request, across all tiles, and the Python client sends at once
+MAX_TILES = 100  # Most tiles the server accepts in a single multi-tile request
+MAX_XMATCH_POSITIONS = 50_000  # Most positions the server accepts in a single cross-match
+SKY_TREE_CACHE_SIZE = 2  # Spatial trees kept for cross-matching, each one is roughly 50 bytes per catalog row
+DEC_INDEX_CACHE_SIZE = 2  # Declination indexes kept for box and polygon queries, each one is 16 bytes per catalog row
+ADMISSION_LIMITS = {
+    "zcat": {"max_concurrent": 16, "max_queued": 64, "queue_timeout": 30},
+    "spectra": {"max_concurrent": 4, "max_queued": 16, "queue_timeout": 120},
+    "plot": {"max_concurrent": 4, "max_queued": 16, "queue_timeout": 120},
+}  # Default admission control for each class of request, see web/admission.py
+COST_LIMITS = {
+    "spectra": 5000,
+    "files": 1000,
+    "bytes_read": 4 * 1024**3,
+}  # Most a single spectra request served by the server may return, open and read, see cost.py
+SPECTRUM_BYTES = 400_000  # Rough size of one coadded spectrum (every band, with resolution data), for cost estimates until some have been cached
+MAX_AGGREGATE_GROUPS = 10_000  # Most groups a single aggregate response can have
+MAX_HISTOGRAM_BINS = 100_000  # Most bins in a single histogram, for 2D histograms this is the product of both axes
 SPECIAL_QUERY_PARAMS = [
-    "filetype"
+    "filetype",
+    "limit",
+    "cursor",
+    "rebin",
+    "columns",
+    "group_by",
+    "stats",
+    "hist",
+    "hist2d",
+    "plan",
 ]  # Query params that don't correspond to data filters
 
 DESIRED_COLUMNS = [
@@ -60,22 +110,15 @@ def canonise_release_name(release: str) -> str:
     :returns: Canonised name which maps to a directory
 
     """
-    # TODO This is kind of gross, we should really have this live outside the code in a json or something, or pulled directly?
-    allowed = ["fuji", "iron", "daily", "fujilite"]
-    translations = {"edr": "fuji", "dr1": "iron"}
-    if release in translations.keys():
-        return translations[release]
-    if release.isidentifier():
-        return release
-    raise MalformedRequestException(
-        f"release must be alphanumeric, cannot be {release}"
-    )
+    # Aliases and the releases allowed are configured in the [releases] section of the config file, see ReleaseRegistry
+    return RELEASES.canonical(release)
 
 
 class RequestedData(Enum):
     UNSPECIFIED = 0
     ZCAT = 1
     SPECTRA = 2
+    AGGREGATE = 3
 
     def __str__(self) -> str:
         return self.name
@@ -101,6 +144,10 @@ class Endpoint(Enum):
     TILE = 1
     TARGETS = 2
     RADEC = 3
+    TILES = 4  # Several tiles, each with its own list of fibers
+    XMATCH = 5  # Cross-match a list of positions, each with its own radius
+    BOX = 6  # Everything between two right ascensions and two declinations
+    POLYGON = 7  # Everything inside a convex polygon on the sky
 
     def __str__(self) -> str:
         return self.name
@@ -149,6 +196,18 @@ class TileParameters(Parameters):
         return str({"Tile ID": self.tile, "Fibers": sorted(self.fibers)})
 
 
+@dataclass
+class MultiTileParameters(Parameters):
+    tiles: Dict[int, List[int]]  # Tile ID -> fibers on that tile
+
+    @property
+    def canonical(self) -> Tuple:
+        return tuple((tile, sorted(fibers)) for tile, fibers in sorted(self.tiles.items()))
+
+    def __str__(self) -> str:
+        return str({f"Tile {tile} Fibers": sorted(fibers) for tile, fibers in self.tiles.items()})
+
+
 @dataclass
 class TargetParameters(Parameters):
     target_ids: List[int]
@@ -161,6 +220,55 @@ class TargetParameters(Parameters):
         return str({"Target IDs": sorted(self.target_ids)})
 
 
+@dataclass
+class CrossMatchParameters(Parameters):
+    ra: List[float]
+    dec: List[float]
+    radius: List[float]  # One per position
+
+    @property
+    def canonical(self) -> Tuple:
+        # Thousands of positions don't fit in a cache path, but their hash does
+        digest = hashlib.sha1(json.dumps([self.ra, self.dec, self.radius]).encode()).hexdigest()
+        return (len(self.ra), digest)
+
+    def __str__(self) -> str:
+        return str({"Positions": len(self.ra)})
+
+
+@dataclass
+class BoxParameters(Parameters):
+    ra_min: float
+    ra_max: float  # Less than ra_min for boxes that wrap through RA 0
+    dec_min: float
+    dec_max: float
+
+    @property
+    def canonical(self) -> Tuple:
+        return (float(self.ra_min), float(self.ra_max), float(self.dec_min), float(self.dec_max))
+
+    def __str__(self) -> str:
+        return str(
+            {
+                "Right Ascension": (float(self.ra_min), float(self.ra_max)),
+                "Declination": (float(self.dec_min), float(self.dec_max)),
+            }
+        )
+
+
+@dataclass
+class PolygonParameters(Parameters):
+    ra: List[float]  # Vertices in order, joined by great circles
+    dec: List[float]
+
+    @property
+    def canonical(self) -> Tuple:
+        return tuple((float(ra), float(dec)) for ra, dec in zip(self.ra, self.dec))
+
+    def __str__(self) -> str:
+        return str({"Vertices": [(float(ra), float(dec)) for ra, dec in zip(self.ra, self.dec)]})
+
+
 @dataclass()
 class ApiRequest:
     requested_data: RequestedData  # zcat/spectra
@@ -169,14 +277,23 @@ class ApiRequest:
     endpoint: Endpoint  # tile/target/radec
     params: Parameters
     filters: Filter = field(default_factory=lambda: dict())
+    release_version: str = ""  # Version of the release the response is built from, set by the server so cached responses to older versions aren't reused
 
     def get_cache_path(self) -> str:
         """Return the path (relative to cache dir) to write this request to
         :returns:
         """
-        return self.replace_for_fitsio(
-            f"{self.requested_data.name}-{self.response_type.name}-{canonise_release_name(self.release)}-{self.endpoint.name}-params-{self.params.canonical}-{self.filters}"
+        release = canonise_release_name(self.release)
+        if self.release_version:
+            release = f"{release}-v{self.release_version}"
+        path = self.replace_for_fitsio(
+            f"{self.requested_data.name}-{self.response_type.name}-{release}-{self.endpoint.name}-params-{self.params.canonical}-{self.filters}"
         )
+        if len(path) > MAX_CACHE_DIR_LENGTH:
+            # Long ID lists (or paging cursors) would exceed the filesystem's limit on file name length
+            digest = hashlib.sha1(path.encode()).hexdigest()
+            path = f"{self.requested_data.name}-{self.response_type.name}-{release}-{self.endpoint.name}-{digest}"
+        return path
 
     @staticmethod
     def replace_for_fitsio(s: str):
@@ -224,6 +341,9 @@ class ApiRequest:
 class DataRelease:
     name: str
     directory: str
+    zcat_dir: str
+    version: str
+    fits_version: str
     tile_dir: str
     tile_fits: str
     healpix_fits: str
@@ -232,6 +352,8 @@ class DataRelease:
     def __init__(self, name: str) -> None:
         self.name = name.lower()
         self.directory = f"{SPECTRO_REDUX}/{self.name}"
+        # Every path is worked out here, so the filesystem is only probed once per DataRelease, see ReleaseRegistry
+        self.zcat_dir = find_zcat_dir(self.directory, self.name)
 
         self.tile_fits = f"{self.zcat_dir}/zall-tilecumulative-{self.name}.fits"
         self.tile_dir = f"{self.directory}/tiles/cumulative"
@@ -242,35 +364,175 @@ class DataRelease:
         self.tile_hdf5 = f"{HDF5_DIR}/zall-tilecumulative-{self.name}.hdf5"
         # self.sqlite_file = f"{SQL_DIR}/{self.name}.sqlite"
 
-    @property
-    def zcat_dir(self) -> str:
-        guess = f"{self.directory}/zcatalog"
-        if os.path.exists(f"{guess}/zall-pix-{self.name}.fits") and os.path.exists(
-            f"{guess}/zall-tilecumulative-{self.name}.fits"
-        ):
-            return guess
-        else:
-            dirs = list_directories(guess)
-            versions = [int(d.replace("v", "")) for d in dirs]
-            latest = max(versions)
-            return f"{guess}/v{latest}"
-
-    @property
-    def tile_memmap(self) -> str:
-        return os.path.expandvars(
-            f"{MEMMAP_DIR}/zall-tilecumulative-{self.name}.npy"
+        self.tile_memmap = os.path.expandvars(f"{MEMMAP_DIR}/zall-tilecumulative-{self.name}.npy")
+        self.tile_dtype = os.path.expandvars(f"{DTYPES_DIR}/zall-tilecumulative-{self.name}.pickle")
+        self.healpix_memmap = os.path.expandvars(f"{MEMMAP_DIR}/zall-pix-{self.name}.npy")
+        self.healpix_dtype = os.path.expandvars(f"{DTYPES_DIR}/zall-pix-{self.name}.pickle")
+        self.version = release_version(
+            [
+                self.healpix_fits,
+                self.tile_fits,
+                self.healpix_memmap,
+                self.healpix_dtype,
+                self.tile_memmap,
+                self.tile_dtype,
+                self.healpix_hdf5,
+                self.tile_hdf5,
+            ]
         )
+        # Only the zcatalog FITS, which is all that preloading reads, so rebuilding an intermediate doesn't force a preload
+        self.fits_version = release_version([self.healpix_fits, self.tile_fits])
+
+
+def release_version(files: List[str]) -> str:
+    """A short hash of the size and modification time of each of FILES that exists. Rewriting the zcatalog, or rebuilding an intermediate file (which replaces it), gives a new version"""
+    signatures = []
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signatures.append((path, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(json.dumps(signatures).encode()).hexdigest()[:12]
+
+
+def find_zcat_dir(directory: str, name: str) -> str:
+    """The directory holding the zall files of the release NAME: either `zcatalog` itself, or its latest `v<n>` subdirectory"""
+    guess = f"{directory}/zcatalog"
+    if os.path.exists(f"{guess}/zall-pix-{name}.fits") and os.path.exists(
+        f"{guess}/zall-tilecumulative-{name}.fits"
+    ):
+        return guess
+    else:
+        dirs = list_directories(guess)
+        versions = [int(d.replace("v", "")) for d in dirs]
+        latest = max(versions)
+        return f"{guess}/v{latest}"
+
+
+class ReleaseRegistry:
+    """The releases the server knows about, resolved into DataReleases once and reused, instead of probing the filesystem on every request.
+    A release is resolved again once it is older than REFRESH_INTERVAL seconds (0 means never), or after `refresh`/`reload`, which picks up new zcatalog versions.
+    Each DataRelease has a version, and LISTENERS are told when a release comes back with a different one. Requests hold on to the DataRelease they started with, so they are unaffected
+    Which names are accepted, and what they are aliases for, come from the `[releases]` section of the config file (see `configure`)
+    """
 
-    @property
-    def tile_dtype(self) -> str:
-        return os.path.expandvars(
-            f"{DTYPES_DIR}/zall-tilecumulative-{self.name}.pickle"
-        )
+    def __init__(
+        self,
+        aliases: Mapping[str, str] = RELEASE_ALIASES,
+        allowed: Optional[Iterable[str]] = None,
+        preload: Iterable[str] = PRELOAD_RELEASES,
+        refresh_interval: float = RELEASE_REFRESH_INTERVAL,
+    ) -> None:
+        self.aliases = dict(aliases)
+        self.allowed = set(allowed) if allowed else None
+        self.preload = tuple(preload)
+        self.refresh_interval = refresh_interval
+        # Name -> (DataRelease, when it was resolved), None once `reload` has marked it stale
+        self._releases: Dict[str, Tuple["DataRelease", Optional[float]]] = dict()
+        self._lock = threading.Lock()
+        # Called with (old, new) DataRelease whenever a release is found to have a new version
+        self.listeners: List[Callable[["DataRelease", "DataRelease"], None]] = []
+        self._watcher: Optional[threading.Thread] = None
+
+    def configure(self, config: Mapping):
+        """Take aliases, allowed releases, preloaded releases and the refresh interval from CONFIG (the `[releases]` table of the config file), and forget anything already resolved"""
+        self.aliases = dict(config.get("aliases", RELEASE_ALIASES))
+        allowed = config.get("allowed")
+        self.allowed = {name.lower() for name in allowed} if allowed else None
+        self.preload = tuple(config.get("preload", PRELOAD_RELEASES))
+        self.refresh_interval = config.get("refresh_interval", RELEASE_REFRESH_INTERVAL)
+        self.reload()
+
+    def canonical(self, release: str) -> str:
+        """The name of the directory RELEASE lives in, following aliases. Raises MalformedRequestException for names that aren't allowed"""
+        release = self.aliases.get(release, release)
+        if not release.isidentifier():
+            raise MalformedRequestException(
+                f"release must be alphanumeric, cannot be {release}"
+            )
+        if self.allowed is not None and release.lower() not in self.allowed:
+            raise MalformedRequestException(
+                f"unknown release {release}, must be one of {', '.join(sorted(self.allowed))}"
+            )
+        return release
 
-    @property
-    def healpix_memmap(self) -> str:
-        return os.path.expandvars(f"{MEMMAP_DIR}/zall-pix-{self.name}.npy")
+    def get(self, release: str) -> "DataRelease":
+        """The DataRelease for RELEASE (any accepted name for it), resolved if it hasn't been yet or has gone stale
 
-    @property
-    def healpix_dtype(self) -> str:
-        return os.path.expandvars(f"{DTYPES_DIR}/zall-pix-{self.name}.pickle")
+        :param release: Not-necessarily-canonical name of a Data Release
+        :returns: The resolved DataRelease, shared with other requests, so it must not be modified
+        """
+        name = self.canonical(release).lower()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._releases.get(name)
+        if cached is not None and cached[1] is not None and (self.refresh_interval == 0 or now - cached[1] < self.refresh_interval):
+            return cached[0]
+        return self._resolve(name)
+
+    def _resolve(self, name: str) -> "DataRelease":
+        now = time.monotonic()
+        try:
+            resolved = DataRelease(name)
+        except (OSError, ValueError) as e:
+            raise DataNotFoundException(f"unable to find the files for release {name}: {e}")
+        with self._lock:
+            previous = self._releases.get(name)
+            self._releases[name] = (resolved, now)
+        if previous is not None and previous[0].version != resolved.version:
+            log(f"release {name} changed from version {previous[0].version} to {resolved.version}")
+            for listener in self.listeners:
+                try:
+                    listener(previous[0], resolved)
+                except Exception as e:
+                    log(e)
+        return resolved
+
+    def resolve_all(self, releases: Iterable[str]):
+        """Resolve RELEASES up front, so the first request for each doesn't pay for it. Releases that can't be found are skipped"""
+        for release in releases:
+            try:
+                self.get(release)
+            except DesiApiException as e:
+                log(e)
+
+    def refresh(self):
+        """Resolve every known release again now, picking up new versions"""
+        for name in self.known():
+            try:
+                self._resolve(name)
+            except DesiApiException as e:
+                log(e)
+
+    def reload(self):
+        """Mark every resolved release stale, so each is resolved again when next asked for. The stale DataReleases are kept, so listeners are still told if a release comes back with a new version"""
+        with self._lock:
+            self._releases = {name: (release, None) for name, (release, _) in self._releases.items()}
+
+    def start_watcher(self) -> Optional[threading.Thread]:
+        """Refresh the known releases every `refresh_interval` seconds in a daemon thread, so new versions are noticed (and preloaded) without waiting for a request. Does nothing if the interval is 0"""
+        if not self.refresh_interval or self._watcher is not None:
+            return self._watcher
+
+        def watch():
+            while True:
+                time.sleep(self.refresh_interval)
+                self.refresh()
+
+        self._watcher = threading.Thread(target=watch, name="desiapi-releases", daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def known(self) -> List[str]:
+        """Names of the releases resolved so far"""
+        with self._lock:
+            return sorted(self._releases)
+
+
+RELEASES = ReleaseRegistry()
+
+
+def get_release(release: str) -> DataRelease:
+    """The DataRelease for RELEASE, from the shared registry"""
+    return RELEASES.get(release)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .errors import MalformedRequestException
+from .models import *
+from .utils import get_max_cache_size, log
+
+# A paged zcat request selects its rows once: the positions of every matching row in the unfiltered zcatalog are
+# kept in an LRU cache, keyed by the query (everything except `limit` and `cursor`). Each page is then a slice of
+# those positions, so later pages never recompute the filters. Cursors are opaque to clients, they encode the offset
+# of the next row along with a hash of the query, so a cursor can't be replayed against a different query.
+
+PAGING_PARAMS = ["limit", "cursor"]
+
+
+def query_key(req: ApiRequest, release: Optional[DataRelease] = None) -> str:
+    """A key identifying the rows REQ selects from RELEASE (the one REQ names if not given), the same for every page of the same query"""
+    release = release or get_release(req.release)
+    filters = {k: v for k, v in sorted(req.filters.items()) if k not in SPECIAL_QUERY_PARAMS}
+    # Rows are positions in a particular version of the release, they mean nothing in any other
+    return f"{canonise_release_name(req.release)}-{release.version}-{req.endpoint.name}-{req.params.canonical}-{filters}"
+
+
+def query_hash(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def encode_cursor(key: str, offset: int) -> str:
+    """Build the cursor pointing at row OFFSET of the query identified by KEY"""
+    payload = json.dumps({"offset": offset, "query": query_hash(key)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(key: str, cursor: str) -> int:
+    """Return the row offset CURSOR points at, checking that it was issued for the query identified by KEY"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        offset = int(payload["offset"])
+        query = payload["query"]
+    except (ValueError, KeyError, TypeError):
+        raise MalformedRequestException(f"invalid cursor: {cursor}")
+    if query != query_hash(key) or offset < 0:
+        raise MalformedRequestException("cursor does not belong to this query")
+    return offset
+
+
+def page_bounds(req: ApiRequest, release: Optional[DataRelease] = None) -> Optional[Tuple[int, int]]:
+    """The (offset, limit) REQ asks for, or None if it isn't a paged request. Cursors are checked against the query on RELEASE (the one REQ names if not given)"""
+    if "limit" not in req.filters and "cursor" not in req.filters:
+        return None
+    try:
+        limit = int(req.filters.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise MalformedRequestException("limit must be an integer")
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise MalformedRequestException(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    cursor = req.filters.get("cursor")
+    offset = decode_cursor(query_key(req, release), cursor) if cursor else 0
+    return offset, limit
+
+
+class RowIndexCache:
+    """A thread-safe LRU cache of row position arrays, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._rows: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            rows = self._rows.get(key)
+            if rows is not None:
+                self._rows.move_to_end(key)
+            return rows
+
+    def put(self, key: str, rows: np.ndarray):
+        if rows.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._rows.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._rows[key] = rows
+            self.nbytes += rows.nbytes
+            while self.nbytes > self.max_bytes and self._rows:
+                _, evicted = self._rows.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self.nbytes = 0
+
+
+ROW_INDEX_CACHE = RowIndexCache(get_max_cache_size(ROW_INDEX_CACHE_SIZE))
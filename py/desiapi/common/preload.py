@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import datetime as dt
+import threading
+from dataclasses import asdict, dataclass
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import fitsio
+import numpy as np
+
+from .categorical import CategoricalZcatalog, encode_zcatalog
+from .sky import unit_vectors
+from .models import DESIRED_COLUMNS_TARGET, DESIRED_COLUMNS_TILE, RELEASES, DataFrame, DataRelease, get_release
+from .utils import log
+
+# Preloading reads a subset of each release's zcatalog FITS files into memory. It can take minutes, so the server
+# does it in a background thread and requests fall back to the memmap/HDF5/FITS paths until a release is loaded.
+#
+# Preloaded data is tagged with the version of the FITS files it was read from (see `DataRelease.fits_version`), and is
+# only handed out for that version. Rebuilding an intermediate gives the release a new version but leaves the FITS, and
+# so the preload, alone. When the release registry finds new FITS for a preloaded release, they are read in the
+# background and swapped in once complete. Meanwhile requests for the new version use the other sources, and requests
+# already holding the old arrays carry on with them.
+
+
+class PreloadState(Enum):
+    PENDING = 0
+    LOADING = 1
+    READY = 2
+    FAILED = 3
+    RELOADING = 4  # A new version is being read, requests for it use the other sources until it is ready
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+@dataclass
+class PreloadProgress:
+    release: str
+    state: PreloadState = PreloadState.PENDING
+    files_loaded: int = 0
+    files_total: int = 2
+    rows_loaded: int = 0
+    version: Optional[str] = None
+    started: Optional[dt.datetime] = None
+    finished: Optional[dt.datetime] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        progress = asdict(self)
+        progress["state"] = self.state.name.lower()
+        progress["started"] = self.started.isoformat() if self.started else None
+        progress["finished"] = self.finished.isoformat() if self.finished else None
+        end = self.finished or dt.datetime.now()
+        progress["elapsed"] = (end - self.started).total_seconds() if self.started else None
+        return progress
+
+
+# Fits file path -> (fits version, preloaded array). Arrays are only added once fully read, so readers never see partial data
+_preloaded: Dict[str, Tuple[str, DataFrame | CategoricalZcatalog]] = dict()
+# Fits file path -> (fits version, unit vectors of TARGET_RA/TARGET_DEC for every preloaded row), for cone searches (see sky.py)
+_unit_vectors: Dict[str, Tuple[str, np.ndarray]] = dict()
+# Release name -> the fits files preloaded for it, so files of an older version can be dropped
+_release_files: Dict[str, List[str]] = dict()
+_progress: Dict[str, PreloadProgress] = dict()
+_lock = threading.Lock()
+
+
+def get_preloaded(fits_file: str, version: Optional[str] = None) -> DataFrame | CategoricalZcatalog | None:
+    """Return the preloaded data for FITS_FILE, or None if it hasn't been (or is still being) loaded, or was loaded from a version other than VERSION (when given). Never blocks."""
+    entry = _preloaded.get(fits_file)
+    if entry is None or (version is not None and entry[0] != version):
+        return None
+    return entry[1]
+
+
+def get_unit_vectors(fits_file: str, version: Optional[str] = None) -> np.ndarray | None:
+    """The unit vectors for the rows of the preloaded FITS_FILE, or None if it hasn't been loaded (from VERSION, when given). Never blocks."""
+    entry = _unit_vectors.get(fits_file)
+    if entry is None or (version is not None and entry[0] != version):
+        return None
+    return entry[1]
+
+
+def preload_release(release_name: str, reload: bool = False):
+    """Read the default columns of the healpix and tile zcatalogs for a release into memory, recording progress as we go
+
+    :param release_name: The release to read Zcat metadata for
+    :param reload: Read the release again even if it is already loaded, to pick up a new version
+    """
+    with _lock:
+        progress = _progress.setdefault(release_name, PreloadProgress(release_name))
+        if progress.state in (PreloadState.LOADING, PreloadState.RELOADING):
+            return
+        if progress.state == PreloadState.READY and not reload:
+            return
+        progress.state = PreloadState.RELOADING if progress.state == PreloadState.READY else PreloadState.LOADING
+        progress.started = dt.datetime.now()
+        progress.finished = progress.error = None
+    log("reading fits for:", release_name)
+    try:
+        while True:
+            release = get_release(release_name)
+            with _lock:
+                progress.version = release.fits_version
+                progress.files_loaded = progress.rows_loaded = 0
+            files = [release.healpix_fits, release.tile_fits]
+            for fits_file, columns in [
+                (release.healpix_fits, DESIRED_COLUMNS_TARGET),
+                (release.tile_fits, DESIRED_COLUMNS_TILE),
+            ]:
+                log(fits_file)
+                # SURVEY and PROGRAM are held as codes, see categorical.py
+                data = encode_zcatalog(fitsio.read(fits_file, "ZCATALOG", columns=columns))
+                # Cone searches only run against the healpix catalog
+                xyz = None
+                if fits_file == release.healpix_fits:
+                    xyz = unit_vectors(data["TARGET_RA"], data["TARGET_DEC"])
+                with _lock:
+                    if xyz is not None:
+                        _unit_vectors[fits_file] = (release.fits_version, xyz)
+                    _preloaded[fits_file] = (release.fits_version, data)
+                    progress.files_loaded += 1
+                    progress.rows_loaded += len(data)
+            with _lock:
+                # A new version can live in a different directory, the old one's files are no use any more
+                for stale in set(_release_files.get(release_name, [])) - set(files):
+                    _preloaded.pop(stale, None)
+                    _unit_vectors.pop(stale, None)
+                _release_files[release_name] = files
+            # The release may have changed again while we were reading it
+            if get_release(release_name).fits_version == release.fits_version:
+                break
+        progress.state = PreloadState.READY
+    except Exception as e:
+        log(e)
+        progress.state = PreloadState.FAILED
+        progress.error = str(e)
+    progress.finished = dt.datetime.now()
+
+
+def reload_preloaded(old: DataRelease, new: DataRelease):
+    """Registry listener: when a release that is preloaded gets new FITS files, read them in the background. New intermediates alone don't change what is preloaded"""
+    with _lock:
+        scheduled = new.name in _progress
+    if scheduled and old.fits_version != new.fits_version:
+        log(f"preloading version {new.fits_version} of {new.name}")
+        threading.Thread(
+            target=preload_release, args=(new.name, True), name="desiapi-reload", daemon=True
+        ).start()
+
+
+RELEASES.listeners.append(reload_preloaded)
+
+
+def preload_fits(release_names: Iterable[str]) -> Dict:
+    """Find the Zcatalog fits files for each release, read them into numpy arrays, and return a mapping of filenames to arrays. Releases which are already loaded are not read again.
+
+    :param release_names: A list of releases to read Zcat metadata for
+    :returns: A dict mapping fits file names to ndarrays
+    """
+    for name in release_names:
+        preload_release(name)
+    return {fits_file: data for fits_file, (_, data) in _preloaded.items()}
+
+
+def start_background_preload(release_names: Iterable[str]) -> threading.Thread:
+    """Preload RELEASE_NAMES one after another in a daemon thread, and return immediately. Use `preload_status` to follow progress.
+
+    :param release_names: A list of releases to read Zcat metadata for
+    :returns: The (started) loader thread
+    """
+    release_names = list(release_names)
+    with _lock:
+        for name in release_names:
+            _progress.setdefault(name, PreloadProgress(name))
+    thread = threading.Thread(
+        target=preload_fits, args=(release_names,), name="desiapi-preload", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def preload_status() -> Dict[str, dict]:
+    """Progress of every release that has been scheduled for preloading, keyed by release name"""
+    with _lock:
+        return {name: progress.to_dict() for name, progress in _progress.items()}
+
+
+def preload_finished() -> bool:
+    """Whether every scheduled release has either loaded (at least once, it may be reloading a newer version) or failed to load"""
+    with _lock:
+        return all(
+            p.state in (PreloadState.READY, PreloadState.FAILED, PreloadState.RELOADING)
+            for p in _progress.values()
+        )
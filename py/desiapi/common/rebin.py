@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .errors import MalformedRequestException
+from .models import PLOT_REBIN_FACTOR, Filter, Spectra
+
+# Plots don't need full resolution: a coadd has ~2700 pixels per band per spectrum, far more than a browser can
+# usefully draw, and prospect embeds every one of them (plus the resolution matrices) in the HTML. For PLOT responses
+# we combine every FACTOR adjacent pixels into one before plotting. DOWNLOAD responses are never rebinned.
+# Redrock models are convolved with each spectrum's resolution matrix, which the rebinned copy doesn't have, so they
+# are built from the full-resolution spectra and rebinned the same way.
+
+
+def rebin_factor(filters: Filter) -> int:
+    """The rebinning factor requested by the `rebin` query param, or the default for plots"""
+    try:
+        factor = int(filters.get("rebin", PLOT_REBIN_FACTOR))
+    except ValueError:
+        raise MalformedRequestException("rebin must be an integer")
+    if factor < 1:
+        raise MalformedRequestException("rebin must be at least 1")
+    return factor
+
+
+def rebin_band(
+    wave: np.ndarray, flux: np.ndarray, ivar: np.ndarray, mask: Optional[np.ndarray], factor: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """Combine every FACTOR adjacent pixels of a single band, for all spectra at once. Trailing pixels that don't fill a whole bin are dropped.
+
+    :param wave: 1-d wavelength grid of the band
+    :param flux: (nspec, nwave) flux
+    :param ivar: (nspec, nwave) inverse variance of the flux
+    :param mask: (nspec, nwave) mask, nonzero for bad pixels, or None
+    :param factor: Number of pixels per output bin
+    :returns: The rebinned (wave, flux, ivar, mask). Flux is the ivar-weighted mean of each bin, and ivar the sum
+    """
+    nspec = flux.shape[0]
+    nbins = len(wave) // factor
+    end = nbins * factor
+
+    # Masked pixels contribute nothing to the weighted mean
+    weights = ivar[:, :end] if mask is None else np.where(mask[:, :end] == 0, ivar[:, :end], 0)
+    weights = weights.reshape(nspec, nbins, factor)
+    binned_flux = flux[:, :end].reshape(nspec, nbins, factor)
+
+    new_ivar = weights.sum(axis=2)
+    weighted = (binned_flux * weights).sum(axis=2)
+    # Bins with no valid pixels get the plain mean, and are masked below
+    new_flux = np.where(
+        new_ivar > 0, weighted / np.where(new_ivar > 0, new_ivar, 1), binned_flux.mean(axis=2)
+    )
+    new_wave = wave[:end].reshape(nbins, factor).mean(axis=1)
+    new_mask = None
+    if mask is not None:
+        new_mask = np.where(
+            new_ivar > 0, 0, np.bitwise_or.reduce(mask[:, :end].reshape(nspec, nbins, factor), axis=2)
+        ).astype(mask.dtype)
+    return new_wave, new_flux, new_ivar, new_mask
+
+
+def rebin_spectra(spectra: Spectra, factor: int) -> Spectra:
+    """Return a low-resolution copy of SPECTRA for plotting: every band rebinned by FACTOR, without resolution data. Fibermaps, scores and the redrock catalog are kept as they are.
+
+    :param spectra: Full-resolution spectra, as read from the coadd files
+    :param factor: Number of pixels per output bin, 1 means no rebinning
+    :returns: The rebinned Spectra object
+    """
+    from desispec.spectra import Spectra
+
+    if factor <= 1:
+        return spectra
+    wave: Dict[str, np.ndarray] = dict()
+    flux: Dict[str, np.ndarray] = dict()
+    ivar: Dict[str, np.ndarray] = dict()
+    mask: Optional[Dict[str, np.ndarray]] = dict() if spectra.mask is not None else None
+    for band in spectra.bands:
+        band_mask = spectra.mask[band] if spectra.mask is not None else None
+        wave[band], flux[band], ivar[band], rebinned_mask = rebin_band(
+            spectra.wave[band], spectra.flux[band], spectra.ivar[band], band_mask, factor
+        )
+        if mask is not None:
+            mask[band] = rebinned_mask
+    return Spectra(
+        bands=list(spectra.bands),
+        wave=wave,
+        flux=flux,
+        ivar=ivar,
+        mask=mask,
+        resolution_data=None,
+        fibermap=spectra.fibermap,
+        exp_fibermap=spectra.exp_fibermap,
+        meta=spectra.meta,
+        scores=spectra.scores,
+        extra_catalog=spectra.extra_catalog,
+    )
+
+
+def rebin_model(model: Tuple[np.ndarray, np.ndarray], factor: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Rebin a (wave, flux) model, as built by prospect's `create_model`, by FACTOR to go with `rebin_spectra`. Every pixel of a model has the same weight"""
+    wave, flux = model
+    if factor <= 1:
+        return wave, flux
+    new_wave, new_flux, _, _ = rebin_band(wave, flux, np.ones_like(flux), None, factor)
+    return new_wave, new_flux
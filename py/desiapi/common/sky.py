@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .errors import MalformedRequestException
+from .models import (
+    CONE_CHUNK_ROWS,
+    DEC_INDEX_CACHE_SIZE,
+    SKY_TREE_CACHE_SIZE,
+    BoxParameters,
+    Parameters,
+    PolygonParameters,
+)
+
+# Cone searches as plain float64 arithmetic on unit vectors, instead of building SkyCoord objects for the whole
+# catalog. A point p is within angle r of the centre c iff the chord between them is at most 2 sin(r/2), that is iff
+# p . c >= 1 - 2 sin^2(r/2) (= cos r, but accurate for small r). The catalog is tested a chunk of CONE_CHUNK_ROWS rows
+# at a time, reusing the same scratch buffers for every chunk, so the only allocation that grows with the catalog is
+# the list of matching rows.
+#
+# All angles are in degrees.
+
+
+def unit_vectors(ra: np.ndarray, dec: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """The (n, 3) unit vectors pointing at each (RA, DEC). Written into OUT if given"""
+    ra = np.radians(ra, dtype=np.float64)
+    dec = np.radians(dec, dtype=np.float64)
+    if out is None:
+        out = np.empty((len(ra), 3), dtype=np.float64)
+    cos_dec = np.cos(dec)
+    np.multiply(cos_dec, np.cos(ra), out=out[:, 0])
+    np.multiply(cos_dec, np.sin(ra), out=out[:, 1])
+    np.sin(dec, out=out[:, 2])
+    return out
+
+
+def chord_length(radius: np.ndarray) -> np.ndarray:
+    """The straight-line distance between unit vectors RADIUS apart"""
+    return 2.0 * np.sin(np.radians(np.minimum(radius, 180.0)) / 2)
+
+
+def chord_to_angle(chord: np.ndarray) -> np.ndarray:
+    return np.degrees(2.0 * np.arcsin(np.clip(chord / 2, 0.0, 1.0)))
+
+
+def min_dot(radius: float) -> float:
+    """The smallest dot product between unit vectors less than RADIUS apart"""
+    half = np.radians(min(radius, 180.0)) / 2
+    return 1.0 - 2.0 * np.sin(half) ** 2
+
+
+class _ConeTest:
+    """Scratch buffers for testing CHUNK_ROWS unit vectors at a time against a single cone"""
+
+    def __init__(self, ra: float, dec: float, radius: float, chunk_rows: int) -> None:
+        self.centre = unit_vectors(np.array([ra]), np.array([dec]))[0]
+        self.threshold = min_dot(radius)
+        self.dots = np.empty(chunk_rows, dtype=np.float64)
+        self.inside = np.empty(chunk_rows, dtype=bool)
+
+    def hits(self, block: np.ndarray) -> np.ndarray:
+        """Positions of the rows of BLOCK (at most chunk_rows unit vectors) inside the cone"""
+        n = len(block)
+        np.dot(block, self.centre, out=self.dots[:n])
+        np.greater_equal(self.dots[:n], self.threshold, out=self.inside[:n])
+        return np.flatnonzero(self.inside[:n])
+
+
+def _concatenate(found: list) -> np.ndarray:
+    return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+
+def cone_search_vectors(
+    xyz: np.ndarray, ra: float, dec: float, radius: float, chunk_rows: int = CONE_CHUNK_ROWS
+) -> np.ndarray:
+    """Positions (ascending) of the rows of XYZ, as returned by `unit_vectors`, within RADIUS of (RA, DEC)"""
+    test = _ConeTest(ra, dec, radius, min(chunk_rows, len(xyz)))
+    found = []
+    for start in range(0, len(xyz), chunk_rows):
+        hits = test.hits(xyz[start : start + chunk_rows])
+        if len(hits):
+            found.append(hits + start)
+    return _concatenate(found)
+
+
+def cone_search(
+    ra_column: np.ndarray,
+    dec_column: np.ndarray,
+    ra: float,
+    dec: float,
+    radius: float,
+    chunk_rows: int = CONE_CHUNK_ROWS,
+) -> np.ndarray:
+    """Positions (ascending) of the rows within RADIUS of (RA, DEC), for catalogs without precomputed unit vectors. Each chunk's vectors are computed into the same buffer
+
+    :param ra_column: Right ascension of every row, such as TARGET_RA
+    :param dec_column: Declination of every row, such as TARGET_DEC
+    :param ra: Right ascension of the centre of the cone
+    :param dec: Declination of the centre of the cone
+    :param radius: Radius of the cone
+    :param chunk_rows: Rows tested at a time
+    :returns: The positions of the rows in the cone
+    """
+    nrows = len(ra_column)
+    chunk_rows = max(1, min(chunk_rows, nrows))
+    test = _ConeTest(ra, dec, radius, chunk_rows)
+    xyz = np.empty((chunk_rows, 3), dtype=np.float64)
+    found = []
+    for start in range(0, nrows, chunk_rows):
+        end = min(start + chunk_rows, nrows)
+        block = unit_vectors(ra_column[start:end], dec_column[start:end], out=xyz[: end - start])
+        hits = test.hits(block)
+        if len(hits):
+            found.append(hits + start)
+    return _concatenate(found)
+
+
+# Cross-matching many positions at once uses a k-d tree over the catalog's unit vectors, so each position costs a tree
+# lookup instead of a pass over the catalog. Trees take a while to build for a big release, so the last few are kept.
+
+
+class SkyTree:
+    """A k-d tree over the unit vectors of some rows of a catalog"""
+
+    def __init__(self, ra_column: np.ndarray, dec_column: np.ndarray, rows: np.ndarray) -> None:
+        """
+        :param ra_column: Right ascension of every row of the catalog
+        :param dec_column: Declination of every row of the catalog
+        :param rows: The rows to put in the tree, such as the primary ones
+        """
+        from scipy.spatial import cKDTree
+
+        self.rows = rows
+        self.tree = cKDTree(unit_vectors(ra_column[rows], dec_column[rows]))
+
+    def cross_match(
+        self, ra: np.ndarray, dec: np.ndarray, radius: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Every catalog row within RADIUS[i] of (RA[i], DEC[i]), for all positions at once
+
+        :param ra: Right ascension of each position
+        :param dec: Declination of each position
+        :param radius: Search radius around each position
+        :returns: Three arrays with one entry per match: the position it matched, the catalog row, and the separation between them. Ordered by position, then by catalog row
+        """
+        points = unit_vectors(ra, dec)
+        neighbours = self.tree.query_ball_point(points, chord_length(radius), workers=-1, return_sorted=True)
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+        if counts.sum() == 0:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, np.array([], dtype=np.float64)
+        positions = np.repeat(np.arange(len(points)), counts)
+        members = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours if len(n)])
+        chords = np.linalg.norm(self.tree.data[members] - points[positions], axis=1)
+        return positions, self.rows[members], chord_to_angle(chords)
+
+
+# Boxes and polygons can cover a lot of sky, too much to test every row of the catalog against. Instead the primary
+# rows are sorted by declination once (a DecIndex), so the rows in a region's declination range are a contiguous slice
+# found by binary search, and only those are tested against the region itself.
+
+
+class SkyBox:
+    """The part of the sky between two right ascensions and two declinations. Boxes with RA_MIN > RA_MAX wrap through RA 0"""
+
+    def __init__(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float) -> None:
+        if not np.isfinite([ra_min, ra_max, dec_min, dec_max]).all():
+            raise MalformedRequestException("box bounds must be finite")
+        if not -90 <= dec_min <= dec_max <= 90:
+            raise MalformedRequestException("box declinations must be within [-90, 90], smallest first")
+        self.full_circle = ra_max - ra_min >= 360
+        self.ra_min = ra_min % 360
+        self.ra_max = ra_max % 360
+        self.dec_min = dec_min
+        self.dec_max = dec_max
+
+    def dec_range(self) -> Tuple[float, float]:
+        return self.dec_min, self.dec_max
+
+    def contains(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        inside = (dec >= self.dec_min) & (dec <= self.dec_max)
+        if self.full_circle:
+            return inside
+        ra = np.mod(ra, 360)
+        if self.ra_min <= self.ra_max:
+            return inside & (ra >= self.ra_min) & (ra <= self.ra_max)
+        return inside & ((ra >= self.ra_min) | (ra <= self.ra_max))
+
+
+class SkyPolygon:
+    """A convex polygon on the sky, with edges along great circles. A point is inside iff it is on the inner side of every edge's great circle"""
+
+    def __init__(self, ra: List[float], dec: List[float]) -> None:
+        if len(ra) != len(dec) or len(ra) < 3:
+            raise MalformedRequestException("a polygon needs at least 3 vertices, each with an ra and a dec")
+        if not (np.isfinite(ra).all() and np.isfinite(dec).all()) or (np.abs(dec) > 90).any():
+            raise MalformedRequestException("polygon vertices must be finite, with dec within [-90, 90]")
+        self.vertices = unit_vectors(np.asarray(ra), np.asarray(dec))
+        normals = np.cross(self.vertices, np.roll(self.vertices, -1, axis=0))
+        lengths = np.linalg.norm(normals, axis=1)
+        if (lengths < 1e-12).any():
+            raise MalformedRequestException("polygon vertices must be distinct, and no two can be opposite each other")
+        normals /= lengths[:, None]
+        # Vertices may come in either order, the other vertices show which side of each edge is inside
+        sides = self.vertices @ normals.T
+        if (sides >= -1e-12).all():
+            self.normals = normals
+        elif (sides <= 1e-12).all():
+            self.normals = -normals
+        else:
+            raise MalformedRequestException("polygon must be convex, with its vertices in order")
+        if (np.abs(sides) <= 1e-12).all():
+            raise MalformedRequestException("polygon vertices can't all be on one great circle")
+
+    def contains_vectors(self, xyz: np.ndarray) -> np.ndarray:
+        return ((xyz @ self.normals.T) >= 0).all(axis=1)
+
+    def contains(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return self.contains_vectors(unit_vectors(ra, dec))
+
+    def dec_range(self) -> Tuple[float, float]:
+        """The smallest and largest declination inside the polygon. Edges can bulge past their vertices, towards the pole, so each edge's extremes are included if they lie on it"""
+        z = list(self.vertices[:, 2])
+        pole = np.array([0.0, 0.0, 1.0])
+        for start, end, normal in zip(self.vertices, np.roll(self.vertices, -1, axis=0), self.normals):
+            # The point of the edge's great circle nearest the pole, and its opposite
+            towards_pole = pole - normal[2] * normal
+            length = np.linalg.norm(towards_pole)
+            if length < 1e-12:
+                continue
+            for extreme in (towards_pole / length, -towards_pole / length):
+                # Orientation of the edge from start to end, whichever way round the normals point
+                edge = np.cross(start, end)
+                if np.cross(start, extreme) @ edge >= 0 and np.cross(extreme, end) @ edge >= 0:
+                    z.append(extreme[2])
+        for pole_z in (1.0, -1.0):
+            if self.contains_vectors(np.array([[0.0, 0.0, pole_z]]))[0]:
+                z.append(pole_z)
+        low, high = np.degrees(np.arcsin(np.clip([min(z), max(z)], -1.0, 1.0)))
+        return float(low), float(high)
+
+
+SkyRegion = Union[SkyBox, SkyPolygon]
+
+
+def sky_region(params: Parameters) -> SkyRegion:
+    """The region of the sky described by the parameters of a box or polygon request. Raises if they don't describe one"""
+    if isinstance(params, BoxParameters):
+        return SkyBox(float(params.ra_min), float(params.ra_max), float(params.dec_min), float(params.dec_max))
+    if isinstance(params, PolygonParameters):
+        return SkyPolygon([float(ra) for ra in params.ra], [float(dec) for dec in params.dec])
+    raise MalformedRequestException(f"{type(params).__name__} doesn't describe a region of the sky")
+
+
+class DecIndex:
+    """Some rows of a catalog, sorted by declination"""
+
+    def __init__(self, dec_column: np.ndarray, rows: np.ndarray) -> None:
+        """
+        :param dec_column: Declination of every row of the catalog
+        :param rows: The rows to index, such as the primary ones
+        """
+        dec = np.asarray(dec_column[rows], dtype=np.float64)
+        order = np.argsort(dec, kind="stable")
+        self.rows = rows[order]
+        self.dec = dec[order]
+
+    def rows_between(self, dec_min: float, dec_max: float) -> np.ndarray:
+        """Positions (ascending) of the indexed rows with DEC_MIN <= declination <= DEC_MAX"""
+        start = np.searchsorted(self.dec, dec_min, side="left")
+        end = np.searchsorted(self.dec, dec_max, side="right")
+        return np.sort(self.rows[start:end])
+
+
+def region_search(
+    region: SkyRegion,
+    index: DecIndex,
+    ra_column: np.ndarray,
+    dec_column: np.ndarray,
+    chunk_rows: int = CONE_CHUNK_ROWS,
+) -> np.ndarray:
+    """Positions (ascending) of the indexed rows inside REGION. Only the rows in REGION's declination range are read, a chunk at a time
+
+    :param region: The box or polygon to search
+    :param index: Declination index of the rows to search
+    :param ra_column: Right ascension of every row, such as TARGET_RA
+    :param dec_column: Declination of every row, such as TARGET_DEC
+    :param chunk_rows: Rows tested at a time
+    :returns: The positions of the rows in the region
+    """
+    candidates = index.rows_between(*region.dec_range())
+    found = []
+    for start in range(0, len(candidates), chunk_rows):
+        rows = candidates[start : start + chunk_rows]
+        inside = region.contains(np.asarray(ra_column[rows], dtype=np.float64), np.asarray(dec_column[rows], dtype=np.float64))
+        if inside.any():
+            found.append(rows[inside])
+    return _concatenate(found)
+
+
+class SkyIndexCache:
+    """The spatial indexes (SkyTrees or DecIndexes) of the last MAX_INDEXES catalogs searched. Each index is built once: requests that need an index while it is being built wait for that build rather than starting their own"""
+
+    def __init__(self, max_indexes: int) -> None:
+        self.max_indexes = max_indexes
+        self._indexes: OrderedDict[Hashable, object] = OrderedDict()
+        self._building: Dict[Hashable, Future] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], object]):
+        """The index stored under KEY, calling BUILD to make it if there isn't one"""
+        with self._lock:
+            if key in self._indexes:
+                self._indexes.move_to_end(key)
+                return self._indexes[key]
+            building = self._building.get(key)
+            if building is None:
+                building = self._building[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return building.result()
+        try:
+            index = build()
+        except BaseException as e:
+            # Waiting requests fail with the same error, and the next request tries again
+            with self._lock:
+                del self._building[key]
+            building.set_exception(e)
+            raise
+        with self._lock:
+            del self._building[key]
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        building.set_result(index)
+        return index
+
+
+SKY_TREES = SkyIndexCache(SKY_TREE_CACHE_SIZE)
+DEC_INDEXES = SkyIndexCache(DEC_INDEX_CACHE_SIZE)
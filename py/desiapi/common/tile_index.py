@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import os
+import threading
+from typing import Dict, Tuple
+
+from .errors import DataNotFoundException
+from .models import DataRelease
+
+# Finding the latest cumulative night for a tile used to mean listing the tile's directory on every request. We
+# remember the answer per (release, tile), along with the directory's mtime: a new night directory changes the
+# mtime, so a single stat tells us whether the cached answer is still good.
+
+# release name -> tile -> (mtime_ns of the tile directory, latest night)
+_index: Dict[str, Dict[int, Tuple[int, str]]] = dict()
+_lock = threading.Lock()
+
+
+def latest_tile_night(release: DataRelease, tile: int) -> str:
+    """Return the most recent cumulative night directory for TILE in RELEASE
+
+    :param release: The data release to look in
+    :param tile: Tile ID
+    :returns: The name of the latest night directory, such as '20210505'
+    """
+    folder = f"{release.tile_dir}/{tile}"
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        raise DataNotFoundException(f"unable to locate tile {tile}")
+    with _lock:
+        cached = _index.get(release.name, dict()).get(tile)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    nights = os.listdir(folder)
+    if not nights:
+        raise DataNotFoundException(f"no cumulative spectra for tile {tile}")
+    latest = max(nights)
+    with _lock:
+        _index.setdefault(release.name, dict())[tile] = (mtime, latest)
+    return latest
+
+
+def clear_tile_index():
+    with _lock:
+        _index.clear()
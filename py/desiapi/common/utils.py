@@ -1,9 +1,11 @@
 #!/usr/bin/env ipython3
 
 import os
+import tempfile
 import tomllib
 import datetime as dt
-from typing import Any, Callable, List
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List
 import numpy as np
 import logging
 
@@ -43,6 +45,26 @@ def expand_path(path: str) -> str:
     return os.path.expanduser(os.path.expandvars(path))
 
 
+@contextmanager
+def atomic_path(path: str) -> Iterator[str]:
+    """Yield a temporary path in the same directory as PATH, and move it onto PATH once the block finishes. Readers see either the old file or the complete new one, never a partly written file. The temporary file is removed if the block fails"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{filename(path)}.", suffix=".tmp")
+    os.close(fd)
+    # mkstemp makes the file private, give it the permissions a plain open() would have
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 # Parsing params
 def build_list_parser(func: Callable[[str], Any]) -> Callable[[str], List[Any]]:
     """Returns a func that takes in a string representing a comma-separated list of integers or floats (no spaces) and returns the list"""
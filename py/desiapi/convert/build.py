@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import List, Sequence, Tuple
+
+from ..common.models import CONVERT_CHUNK_ROWS, CONVERT_WORKERS, MANIFEST_FILE, PRELOAD_RELEASES, DataRelease
+from ..common.utils import atomic_path, log
+from .hdf5 import Hdf5Writer
+from .memmap import MemmapWriter, read_footer
+from .stream import fits_chunks, fits_layout
+
+# Keeps the intermediate files up to date with the FITS they are built from. The manifest records, for each catalog
+# of each release, the size and modification time of the source FITS when each format was last built. A build only
+# converts the catalogs whose source has changed since (or whose outputs are missing), streams each source FITS once
+# into all the formats built from it, and converts separate catalogs in parallel processes.
+#
+# Every output is written to a temporary file and renamed into place, so running servers never see a half-written
+# memmap or HDF5 file.
+
+CATALOGS = ("tile", "healpix")
+FORMATS = ("memmap", "hdf5")
+
+Job = Tuple[str, str, List[str]]  # (release, catalog, formats to build)
+
+
+def source_fits(release: DataRelease, catalog: str) -> str:
+    return release.tile_fits if catalog == "tile" else release.healpix_fits
+
+
+def output_files(release: DataRelease, catalog: str, fmt: str) -> List[str]:
+    """The files FMT writes for CATALOG of RELEASE"""
+    match fmt, catalog:
+        case "memmap", "tile":
+            return [release.tile_memmap, release.tile_dtype]
+        case "memmap", "healpix":
+            return [release.healpix_memmap, release.healpix_dtype]
+        case "hdf5", "tile":
+            return [release.tile_hdf5]
+        case "hdf5", "healpix":
+            return [release.healpix_hdf5]
+    raise ValueError(f"unknown format {fmt} or catalog {catalog}")
+
+
+def source_signature(path: str) -> dict:
+    """What we compare to decide whether PATH has changed since the last build"""
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_manifest(manifest_file: str = MANIFEST_FILE) -> dict:
+    if not os.path.exists(manifest_file):
+        return dict()
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest: dict, manifest_file: str = MANIFEST_FILE):
+    with atomic_path(manifest_file) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def is_stale(manifest: dict, release_name: str, catalog: str, fmt: str) -> bool:
+    """Whether FMT for CATALOG of RELEASE_NAME needs rebuilding: its outputs are missing, or it was built from a different version of the source FITS"""
+    release = DataRelease(release_name)
+    outputs = output_files(release, catalog, fmt)
+    if not all(os.path.exists(f) for f in outputs):
+        return True
+    if fmt == "memmap" and read_footer(outputs[0]) is None:
+        # Written before the dtype and categories were embedded in the array file, so they weren't published atomically
+        return True
+    built_from = manifest.get(release.name, dict()).get(catalog, dict()).get(fmt)
+    return built_from != source_signature(source_fits(release, catalog))
+
+
+def stale_jobs(
+    manifest: dict, releases: Sequence[str], formats: Sequence[str], force: bool = False
+) -> List[Job]:
+    """The catalogs that need converting, and into which formats. Releases whose FITS can't be found are skipped
+
+    :param manifest: As returned by `read_manifest`
+    :param releases: Releases to check
+    :param formats: Intermediate formats to check, some of FORMATS
+    :param force: Rebuild everything, whether or not it is stale
+    :returns: A list of (release, catalog, formats) to build
+    """
+    jobs = []
+    for release_name in releases:
+        for catalog in CATALOGS:
+            try:
+                stale = [fmt for fmt in formats if force or is_stale(manifest, release_name, catalog, fmt)]
+            except (FileNotFoundError, ValueError) as e:
+                log(f"skipping {catalog} catalog of {release_name}", e)
+                continue
+            if stale:
+                jobs.append((release_name, catalog, stale))
+    return jobs
+
+
+def open_writer(release: DataRelease, catalog: str, fmt: str, dtype, nrows: int, chunk_rows: int):
+    outputs = output_files(release, catalog, fmt)
+    if fmt == "memmap":
+        return MemmapWriter(*outputs, dtype, nrows)
+    return Hdf5Writer(*outputs, dtype, nrows, chunk_rows)
+
+
+def build_catalog(
+    release_name: str, catalog: str, formats: List[str], chunk_rows: int = CONVERT_CHUNK_ROWS
+) -> Tuple[str, str, List[str], dict]:
+    """Stream the FITS for CATALOG of RELEASE_NAME, CHUNK_ROWS rows at a time, into each of FORMATS. The FITS is only read once, however many formats are built. Returns the job, and the signature of the FITS it was built from"""
+    release = DataRelease(release_name)
+    fits_file = source_fits(release, catalog)
+    # Taken before reading, so if the file changes while we read it the next build picks that up
+    signature = source_signature(fits_file)
+    log(f"converting {fits_file} to {', '.join(formats)}")
+    nrows, dtype = fits_layout(fits_file)
+    with ExitStack() as stack:
+        writers = [stack.enter_context(open_writer(release, catalog, fmt, dtype, nrows, chunk_rows)) for fmt in formats]
+        for start, chunk in fits_chunks(fits_file, chunk_rows):
+            for writer in writers:
+                writer.write(start, chunk)
+    return release_name, catalog, formats, signature
+
+
+def build_intermediates(
+    releases: Sequence[str] = PRELOAD_RELEASES,
+    formats: Sequence[str] = FORMATS,
+    workers: int = CONVERT_WORKERS,
+    force: bool = False,
+    chunk_rows: int = CONVERT_CHUNK_ROWS,
+    manifest_file: str = MANIFEST_FILE,
+) -> List[Job]:
+    """Bring the intermediate files for RELEASES up to date, converting stale catalogs in up to WORKERS processes. The manifest is updated as each catalog finishes, so an interrupted build keeps the work it completed
+
+    :param releases: Releases to build
+    :param formats: Intermediate formats to build, some of FORMATS
+    :param workers: Catalogs converted at once
+    :param force: Rebuild everything, whether or not it is stale
+    :param chunk_rows: Rows read from the FITS at a time, which bounds the memory each worker needs
+    :param manifest_file: Where the manifest is kept
+    :returns: The jobs that were built
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"unknown formats {sorted(unknown)}, expected some of {list(FORMATS)}")
+    manifest = read_manifest(manifest_file)
+    jobs = stale_jobs(manifest, releases, formats, force)
+    if not jobs:
+        log("intermediate files are up to date")
+        return []
+    built = []
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        futures = [pool.submit(build_catalog, *job, chunk_rows) for job in jobs]
+        for future in as_completed(futures):
+            try:
+                release_name, catalog, built_formats, signature = future.result()
+            except FileNotFoundError as e:
+                log(e)
+                continue
+            entry = manifest.setdefault(release_name.lower(), dict()).setdefault(catalog, dict())
+            for fmt in built_formats:
+                entry[fmt] = signature
+            write_manifest(manifest, manifest_file)
+            built.append((release_name, catalog, built_formats))
+            log(f"built {catalog} catalog of {release_name}")
+    return built
+
+
+def main():
+    build_intermediates()
+
+
+if __name__ == "__main__":
+    main()
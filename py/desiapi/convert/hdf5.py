@@ -1,21 +1,28 @@
 from os.path import basename
 import h5py
 import os
-import fitsio
 import datetime as dt
 import numpy as np
-from typing import List, Tuple
-import numpy.lib.recfunctions as rfn
-
-from astropy.table import Table
+import json
+import tempfile
+from contextlib import ExitStack
+from functools import lru_cache
+from typing import Iterator, List, Tuple, Union
 
 from ..common.models import (
+    CONVERT_CHUNK_ROWS,
+    HDF5_CHUNK_ROWS,
+    HDF5_COMPRESSION,
+    HDF5_INDEX_COLUMNS,
     PRELOAD_RELEASES,
     DataRelease,
     DESIRED_COLUMNS_TARGET,
     DESIRED_COLUMNS_TILE,
+    Zcatalog,
 )
-from ..common.utils import log, basename
+from ..common.categorical import CategoryEncoder, decode_column
+from ..common.utils import atomic_path, log, basename
+from .stream import fits_chunks, fits_layout
 
 
 def replace_type(old_type, new_type_label):
@@ -45,49 +52,318 @@ strings_to_bytes = replace_type(np.str_, "S")
 bytes_to_strings = replace_type(np.bytes_, "U")
 
 
-def create_hdf5(release_name: str):
+def create_hdf5(release_name: str, chunk_rows: int = CONVERT_CHUNK_ROWS):
+    """Convert the tilecumulative and zpix catalogs of a release to HDF5, reading the FITS CHUNK_ROWS rows at a time"""
     release = DataRelease(release_name)
-    log(release.tile_fits)
-    tile = fitsio.read(release.tile_fits, "ZCATALOG")
-    to_hdf5_datasets(tile, release.tile_hdf5)
-    log(release.healpix_fits)
-    healpix = fitsio.read(release.healpix_fits, "ZCATALOG")
-    to_hdf5_datasets(healpix, release.healpix_hdf5)
+    for fits_file, outfile in [
+        (release.tile_fits, release.tile_hdf5),
+        (release.healpix_fits, release.healpix_hdf5),
+    ]:
+        log(fits_file)
+        nrows, dtype = fits_layout(fits_file)
+        with Hdf5Writer(outfile, dtype, nrows, chunk_rows) as writer:
+            for start, chunk in fits_chunks(fits_file, chunk_rows):
+                writer.write(start, chunk)
 
 
-def read_hdf5s(release_name: str) -> Tuple[Table, Table]:
+def read_hdf5s(release_name: str) -> Tuple[Zcatalog, Zcatalog]:
     release = DataRelease(release_name)
     tile = from_hdf5_datasets(release.tile_hdf5, columns=DESIRED_COLUMNS_TILE)
     healpix = from_hdf5_datasets(release.healpix_hdf5, columns=DESIRED_COLUMNS_TARGET)
     return tile, healpix
 
 
+def dataset_options(shape: tuple) -> dict:
+    """Chunked, compressed layout for a column with SHAPE. Chunks span HDF5_CHUNK_ROWS rows, so reading a few rows only decompresses the chunks they fall in"""
+    if shape[0] == 0:
+        return dict()
+    return dict(
+        chunks=(min(HDF5_CHUNK_ROWS, shape[0]),) + tuple(shape[1:]),
+        compression=HDF5_COMPRESSION,
+        shuffle=True,
+    )
+
+
+def hdf5_type(dtype: np.dtype) -> np.dtype:
+    """The type a column of DTYPE is stored as: HDF5 has no unicode strings, so they are stored as bytes"""
+    if dtype.type == np.str_:
+        return np.dtype(("S", dtype.itemsize // 4))
+    return dtype
+
+
+class Hdf5Writer:
+    """Fills in an HDF5 file holding NROWS rows of the structured DTYPE, a block of rows at a time. Each field is a chunked, compressed dataset allocated up front, with SURVEY and PROGRAM stored as codes (see categorical.py). The indexes for HDF5_INDEX_COLUMNS (sorted CHUNK_ROWS rows at a time) and the categories of the encoded columns are written when the writer is closed. The file is built in a temporary file and moved into place, so readers never open a partly written file"""
+
+    def __init__(self, outfile: str, dtype: np.dtype, nrows: int, chunk_rows: int = CONVERT_CHUNK_ROWS) -> None:
+        self.outfile = outfile
+        self.chunk_rows = chunk_rows
+        self.encoder = CategoryEncoder(dtype)
+        self.nrows = nrows
+        self._files = ExitStack()
+        self._file: h5py.File | None = None
+
+    def __enter__(self) -> "Hdf5Writer":
+        with ExitStack() as files:
+            tmp_file = files.enter_context(atomic_path(self.outfile))
+            self._file = files.enter_context(h5py.File(tmp_file, "w"))
+            for col, type_tuple in self.encoder.dtype.fields.items():
+                dtype = type_tuple[0]
+                shape = (self.nrows,) + dtype.shape
+                self._file.create_dataset(col, shape=shape, dtype=hdf5_type(dtype.base), **dataset_options(shape))
+            self._files = files.pop_all()
+        return self
+
+    def write(self, start: int, rows: np.ndarray):
+        """Copy ROWS into the datasets, starting at row START"""
+        rows = self.encoder.encode(rows)
+        for col in rows.dtype.names:
+            dataset = self._file[col]
+            dataset[start : start + len(rows)] = rows[col].astype(dataset.dtype, copy=False)
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            for col in HDF5_INDEX_COLUMNS:
+                if col in self._file:
+                    write_index(self._file, col, self.chunk_rows)
+            for col, category in self.encoder.categories().items():
+                self._file[col].attrs["categories"] = json.dumps(category)
+        self._file = None
+        return self._files.__exit__(exc_type, *exc_info)
+
+
 def to_hdf5_datasets(arr: np.recarray, outfile: str):
-    with h5py.File(outfile, "w") as f:
-        for col, type_tuple in arr.dtype.fields.items():
-            dtype = type_tuple[0]
-            if dtype.type == np.str_:
-                byte_type = ("S", dtype.itemsize)
-                new_type = (col, byte_type)
-                f.create_dataset(col, data=arr[col].astype(byte_type))
-            else:
-                f.create_dataset(col, data=arr[col])
+    """Write ARR, already in memory, to OUTFILE"""
+    with Hdf5Writer(outfile, arr.dtype, len(arr)) as writer:
+        writer.write(0, arr)
+
+
+def write_index(f: h5py.File, column: str, run_rows: int = CONVERT_CHUNK_ROWS):
+    """Store a sorted index of COLUMN under `index/COLUMN`: the distinct values, and for each one the (ascending) rows it appears in, found via `offsets`.
+
+    The column is never read whole: each block of RUN_ROWS rows is sorted into a run in a scratch file next to F, and the runs are then merged a slice of each at a time (see `merge_runs`), so memory is bounded by RUN_ROWS rather than by the catalog"""
+    dataset = f[column]
+    nrows = dataset.shape[0]
+    group = f.create_group(f"index/{column}")
+    values_out = group.create_dataset("values", shape=(0,), maxshape=(None,), dtype=dataset.dtype, chunks=(HDF5_CHUNK_ROWS,))
+    offsets_out = group.create_dataset("offsets", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(HDF5_CHUNK_ROWS,))
+    rows_out = group.create_dataset("rows", shape=(nrows,), dtype=np.int64, **dataset_options((nrows,)))
+    fd, scratch_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(f.filename)), suffix=".h5")
+    os.close(fd)
+    try:
+        with h5py.File(scratch_file, "w") as scratch:
+            runs = []
+            for i, start in enumerate(range(0, nrows, run_rows)):
+                values = dataset[start : start + run_rows]
+                order = np.argsort(values, kind="stable")
+                runs.append(
+                    (
+                        scratch.create_dataset(f"{i}/values", data=values[order]),
+                        scratch.create_dataset(f"{i}/rows", data=order.astype(np.int64) + start),
+                    )
+                )
+            written = 0
+            for values, rows in merge_runs(runs, max(1, run_rows // max(1, len(runs)))):
+                distinct, starts = np.unique(values, return_index=True)
+                append_to(values_out, distinct)
+                append_to(offsets_out, starts.astype(np.int64) + written)
+                rows_out[written : written + len(rows)] = rows
+                written += len(rows)
+            append_to(offsets_out, np.array([nrows], dtype=np.int64))
+    finally:
+        os.remove(scratch_file)
+
+
+def append_to(dataset: h5py.Dataset, data: np.ndarray):
+    """Append DATA to the resizable, 1-d DATASET"""
+    start = dataset.shape[0]
+    dataset.resize((start + len(data),))
+    dataset[start:] = data
+
+
+def merge_runs(runs: List[Tuple[h5py.Dataset, h5py.Dataset]], block_rows: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Merge RUNS, each a pair of (values sorted ascending, their rows), yielding consecutive (values, rows) blocks of the merged order, reading BLOCK_ROWS of a run at a time.
+
+    Every value less than the smallest last value buffered from a run that isn't used up can't appear again, so those are sorted (by value, then row) and yielded. A value is never split between blocks, so each block holds whole groups of equal values, with their rows ascending"""
+    buffered = [(np.empty(0, run_values.dtype), np.empty(0, np.int64)) for run_values, _ in runs]
+    read = [0] * len(runs)
+    while True:
+        for i, (run_values, run_rows) in enumerate(runs):
+            values, rows = buffered[i]
+            # A buffer holding a single value might hold only part of that value's rows, so read on
+            if read[i] < len(run_values) and (len(values) == 0 or values[0] == values[-1]):
+                end = read[i] + block_rows
+                buffered[i] = (
+                    np.concatenate([values, run_values[read[i] : end]]),
+                    np.concatenate([rows, run_rows[read[i] : end]]),
+                )
+                read[i] = min(end, len(run_values))
+        unread = [buffered[i][0][-1] for i, (run_values, _) in enumerate(runs) if read[i] < len(run_values)]
+        if not unread and not any(len(values) for values, _ in buffered):
+            return
+        taken_values, taken_rows = [], []
+        for i, (values, rows) in enumerate(buffered):
+            n = np.searchsorted(values, min(unread), side="left") if unread else len(values)
+            taken_values.append(values[:n])
+            taken_rows.append(rows[:n])
+            buffered[i] = (values[n:], rows[n:])
+        values, rows = np.concatenate(taken_values), np.concatenate(taken_rows)
+        if len(values):
+            order = np.lexsort((rows, values))
+            yield values[order], rows[order]
+
+
+@lru_cache(maxsize=16)
+def _read_index(infile: str, column: str, mtime_ns: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+    with h5py.File(infile, "r") as f:
+        if f"index/{column}" not in f:
+            return None
+        group = f[f"index/{column}"]
+        return group["values"][:], group["offsets"][:], group["rows"][:]
+
+
+def lookup_rows(infile: str, column: str, values: List) -> np.ndarray:
+    """The rows (ascending) of INFILE where COLUMN takes any of VALUES. Uses the file's index for COLUMN if it has one, otherwise scans the column"""
+    index = _read_index(infile, column, os.stat(infile).st_mtime_ns)
+    if index is None:
+        return np.flatnonzero(np.isin(read_hdf5_column(infile, column), values))
+    distinct, offsets, rows = index
+    positions = np.searchsorted(distinct, values)
+    positions = positions[positions < len(distinct)]
+    positions = np.unique(positions[np.isin(distinct[positions], values)])
+    if len(positions) == 0:
+        return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate([rows[offsets[i] : offsets[i + 1]] for i in positions]))
+
+
+def index_dtype(infile: str, column: str) -> np.dtype | None:
+    """The type of COLUMN's values, if INFILE has an index for it"""
+    index = _read_index(infile, column, os.stat(infile).st_mtime_ns)
+    return None if index is None else index[0].dtype
+
 
+def lookup_range_rows(infile: str, column: str, low, high) -> np.ndarray:
+    """The rows (ascending) of INFILE where LOW <= COLUMN <= HIGH, either bound may be None. The values in range are a single slice of the index, so this is two binary searches. INFILE must have an index for COLUMN"""
+    distinct, offsets, rows = _read_index(infile, column, os.stat(infile).st_mtime_ns)
+    start = 0 if low is None else np.searchsorted(distinct, low, side="left")
+    end = len(distinct) if high is None else np.searchsorted(distinct, high, side="right")
+    if start >= end:
+        return np.array([], dtype=np.int64)
+    return np.sort(rows[offsets[start] : offsets[end]])
+
+
+def read_dataset_rows(dataset: h5py.Dataset, rows: Union[slice, np.ndarray]) -> np.ndarray:
+    """Read ROWS of DATASET. For a list of rows, each chunk containing any of them is read once, as a hyperslab covering just the requested rows in that chunk"""
+    if isinstance(rows, slice):
+        return dataset[rows]
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+    order = None
+    if np.any(rows[1:] < rows[:-1]):
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+    block = dataset.chunks[0] if dataset.chunks else HDF5_CHUNK_ROWS
+    blocks = rows // block
+    starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+    ends = np.r_[starts[1:], len(rows)]
+    out = np.empty((len(rows),) + dataset.shape[1:], dtype=dataset.dtype)
+    for start, end in zip(starts, ends):
+        first, last = rows[start], rows[end - 1]
+        out[start:end] = dataset[first : last + 1][rows[start:end] - first]
+    if order is not None:
+        unsorted = np.empty_like(out)
+        unsorted[order] = out
+        out = unsorted
+    return out
+
+
+def decode_strings(data: np.ndarray) -> np.ndarray:
+    if data.dtype.type == np.bytes_:
+        return data.astype(("U", data.dtype.itemsize))
+    return data
+
+
+def read_column_rows(dataset: h5py.Dataset, rows: Union[slice, np.ndarray]) -> np.ndarray:
+    """Read ROWS of DATASET, turning bytes and encoded columns back into strings"""
+    data = read_dataset_rows(dataset, rows)
+    if "categories" in dataset.attrs:
+        return decode_column(data, json.loads(dataset.attrs["categories"]))
+    return decode_strings(data)
+
+
+def read_hdf5_column(infile: str, column: str, rows: Union[slice, np.ndarray] = slice(None)) -> np.ndarray:
+    """Read ROWS (all by default) of a single COLUMN from INFILE"""
+    with h5py.File(infile, "r") as f:
+        return read_column_rows(f[column], rows)
+
+
+def read_stored_column(infile: str, column: str, rows: Union[slice, np.ndarray]) -> Tuple[np.ndarray, dict | None]:
+    """ROWS of COLUMN as they are stored: codes for encoded columns, along with the categories they stand for (None for other columns)"""
+    with h5py.File(infile, "r") as f:
+        dataset = f[column]
+        if "categories" in dataset.attrs:
+            return read_dataset_rows(dataset, rows), json.loads(dataset.attrs["categories"])
+        return decode_strings(read_dataset_rows(dataset, rows)), None
+
+
+def read_hdf5_rows(infile: str, columns: List[str], rows: Union[slice, np.ndarray] = slice(None)) -> Zcatalog:
+    """Read ROWS (a slice, or an array of row positions) of COLUMNS from INFILE into a table. Only the chunks containing those rows are read, and only those rows' strings are decoded
+
+    :param infile: HDF5 file written by `to_hdf5_datasets`
+    :param columns: The columns to read
+    :param rows: Rows to read, in the order they should be returned
+    :returns: A table with one row per entry of ROWS
+    """
+    from astropy.table import Table
 
-def from_hdf5_datasets(infile: str, columns: List[str]) -> Table:
     table = Table()
     with h5py.File(infile, "r") as f:
         for col in columns:
-            data = f[col][:]
-            dtype = data.dtype
-            if dtype.type == np.bytes_:
-                string_type = ("U", dtype.itemsize)
-                table[col] = data.astype(string_type)
-            else:
-                table[col] = data
+            table[col] = read_column_rows(f[col], rows)
     return table
 
 
+class Hdf5Zcatalog:
+    """A zcatalog in an HDF5 file, read on demand. Indexing with a column name reads that column, indexing with rows reads just those rows (of every column) into a table, so a tile or target lookup can avoid reading whole columns"""
+
+    def __init__(self, infile: str, columns: List[str]) -> None:
+        self.infile = infile
+        self.columns = columns
+        with h5py.File(infile, "r") as f:
+            missing = [col for col in columns if col not in f]
+            if missing:
+                raise KeyError(f"{infile} has no columns {missing}")
+            self.nrows = f[columns[0]].shape[0]
+
+    def __len__(self) -> int:
+        return self.nrows
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return read_hdf5_column(self.infile, key)
+        return read_hdf5_rows(self.infile, self.columns, key)
+
+    def lookup(self, column: str, values: List) -> np.ndarray:
+        return lookup_rows(self.infile, column, values)
+
+    def take(self, rows, columns: List[str]) -> Zcatalog:
+        """ROWS of just COLUMNS"""
+        return read_hdf5_rows(self.infile, columns, rows)
+
+    def stored(self, column: str, rows) -> Tuple[np.ndarray, dict | None]:
+        return read_stored_column(self.infile, column, rows)
+
+    def index_dtype(self, column: str) -> np.dtype | None:
+        return index_dtype(self.infile, column)
+
+    def lookup_range(self, column: str, low, high) -> np.ndarray:
+        return lookup_range_rows(self.infile, column, low, high)
+
+
+def from_hdf5_datasets(infile: str, columns: List[str]) -> Zcatalog:
+    return read_hdf5_rows(infile, columns)
+
+
 def main():
     for release in PRELOAD_RELEASES:
         log(release)
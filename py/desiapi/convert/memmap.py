@@ -1,11 +1,14 @@
-import fitsio
+import os
 import datetime as dt
 import numpy as np
 import pickle
-from typing import Tuple, Dict
+import struct
+from contextlib import ExitStack
+from typing import List, Optional
 
 
 from ..common.models import (
+    CONVERT_CHUNK_ROWS,
     DESIRED_COLUMNS_TARGET,
     DESIRED_COLUMNS_TILE,
     DataRelease,
@@ -13,48 +16,139 @@ from ..common.models import (
     Zcatalog,
 )
 
-from ..common.utils import log
+from ..common.categorical import CategoricalZcatalog, CategoryEncoder, read_categories
+from ..common.utils import atomic_path, log
+from .stream import fits_chunks, fits_layout
 
 
-def create_memmap(release_name: str):
-    """Read the tilecumulative and zpix metadata for a release and create memmap
+def create_memmap(release_name: str, chunk_rows: int = CONVERT_CHUNK_ROWS):
+    """Read the tilecumulative and zpix metadata for a release and create memmap. The FITS are read CHUNK_ROWS rows at a time, so this never holds a whole catalog in memory
 
     :param release_name:
+    :param chunk_rows: Rows read from the FITS at a time
     :returns:
 
     """
 
     release = DataRelease(release_name)
-    tile = fitsio.read(release.tile_fits, "ZCATALOG")
-    with open(release.tile_dtype, "wb") as f:
-        pickle.dump(tile.dtype, f)
-    write = np.memmap(
-        release.tile_memmap, mode="w+", dtype=tile.dtype, shape=tile.shape
-    )
-    write[:] = tile
-    del write
-    healpix = fitsio.read(release.healpix_fits, "ZCATALOG")
-    with open(release.healpix_dtype, "wb") as f:
-        pickle.dump(healpix.dtype, f)
-    write = np.memmap(
-        release.healpix_memmap, mode="w+", dtype=healpix.dtype, shape=healpix.shape
-    )
-    write[:] = healpix
-    del write
-
-
-def read_memmap(numpy_file: str, dtype_file: str) -> Zcatalog:
-    """Given a memory-mapped numpy array as a file, and the pickled dtype for it, read that in and return it
-
-    :param numpy_file:
-    :param dtype_file:
+    for fits_file, numpy_file, dtype_file in [
+        (release.tile_fits, release.tile_memmap, release.tile_dtype),
+        (release.healpix_fits, release.healpix_memmap, release.healpix_dtype),
+    ]:
+        nrows, dtype = fits_layout(fits_file)
+        with MemmapWriter(numpy_file, dtype_file, dtype, nrows) as writer:
+            for start, chunk in fits_chunks(fits_file, chunk_rows):
+                writer.write(start, chunk)
+
+
+def categories_file(dtype_file: str) -> str:
+    """Where the categories of the encoded columns (see categorical.py) were kept by memmaps written before they were embedded in the array file"""
+    return f"{os.path.splitext(dtype_file)[0]}.categories.json"
+
+
+# The array file is the rows followed by a footer: the pickled dtype, categories and row count, then the footer's
+# length and FOOTER_MAGIC. Everything needed to read the rows is in the one file, so renaming it into place publishes
+# the rows, dtype and categories together, and a server can never pair new rows with an old dtype.
+FOOTER_MAGIC = b"DESIMMv1"
+FOOTER_TRAILER = struct.Struct("<Q8s")  # Footer length, magic
+
+
+def write_footer(numpy_file: str, dtype: np.dtype, categories: dict, nrows: int):
+    footer = pickle.dumps({"dtype": dtype, "categories": categories, "nrows": nrows})
+    with open(numpy_file, "ab") as f:
+        f.write(footer)
+        f.write(FOOTER_TRAILER.pack(len(footer), FOOTER_MAGIC))
+
+
+def read_footer(numpy_file: str) -> Optional[dict]:
+    """The dtype, categories and row count embedded at the end of NUMPY_FILE, or None if it was written without them"""
+    with open(numpy_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < FOOTER_TRAILER.size:
+            return None
+        f.seek(size - FOOTER_TRAILER.size)
+        length, magic = FOOTER_TRAILER.unpack(f.read(FOOTER_TRAILER.size))
+        if magic != FOOTER_MAGIC or length > size - FOOTER_TRAILER.size:
+            return None
+        f.seek(size - FOOTER_TRAILER.size - length)
+        return pickle.loads(f.read(length))
+
+
+class MemmapWriter:
+    """Fills in a memmap of NROWS rows of DTYPE, a block of rows at a time, with SURVEY and PROGRAM stored as codes (see categorical.py). The array, followed by a footer holding its dtype and categories, is written to a temporary file and moved into place in a single rename when the writer is closed without error, so a running server never maps a half-written array or one described by another build's dtype (it keeps reading the old one until it reopens the file).
+    The dtype is also pickled to DTYPE_FILE, for tools that inspect it, but readers take it from the footer"""
+
+    def __init__(self, numpy_file: str, dtype_file: str, dtype: np.dtype, nrows: int) -> None:
+        self.numpy_file = numpy_file
+        self.dtype_file = dtype_file
+        self.encoder = CategoryEncoder(dtype)
+        self.nrows = nrows
+        self._files = ExitStack()
+        self._array = None
+        self._tmp_numpy = None
+
+    def __enter__(self) -> "MemmapWriter":
+        with ExitStack() as files:
+            # Entered first so it is renamed last, the array file is what publishes the new build
+            self._tmp_numpy = files.enter_context(atomic_path(self.numpy_file))
+            tmp_dtype = files.enter_context(atomic_path(self.dtype_file))
+            with open(tmp_dtype, "wb") as f:
+                pickle.dump(self.encoder.dtype, f)
+            self._array = np.memmap(self._tmp_numpy, mode="w+", dtype=self.encoder.dtype, shape=(self.nrows,))
+            self._files = files.pop_all()
+        return self
+
+    def write(self, start: int, rows: np.ndarray):
+        """Copy ROWS into the array, starting at row START"""
+        self._array[start : start + len(rows)] = self.encoder.encode(rows)
+
+    def __exit__(self, exc_type, *exc_info):
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+        if exc_type is None:
+            # Categories are only known once every row has been seen
+            write_footer(self._tmp_numpy, self.encoder.dtype, self.encoder.categories(), self.nrows)
+        suppress = self._files.__exit__(exc_type, *exc_info)
+        if exc_type is None and os.path.exists(categories_file(self.dtype_file)):
+            os.remove(categories_file(self.dtype_file))  # Superseded by the footer
+        return suppress
+
+
+def to_memmap(arr: np.ndarray, numpy_file: str, dtype_file: str):
+    """Serialise ARR, already in memory, as a memmap in NUMPY_FILE with its dtype pickled to DTYPE_FILE"""
+    with MemmapWriter(numpy_file, dtype_file, arr.dtype, len(arr)) as writer:
+        writer.write(0, arr)
+
+
+def read_memmap(numpy_file: str, dtype_file: str, columns: Optional[List[str]] = None) -> Zcatalog:
+    """Given a memory-mapped numpy array as a file, read it in and return it. If it has encoded columns, it is wrapped in a CategoricalZcatalog that decodes them
+
+    :param numpy_file: The array, with its dtype and categories in a footer (see `MemmapWriter`)
+    :param dtype_file: The pickled dtype, only used for arrays written before the footer existed
+    :param columns: If given, only these columns are returned, as a view of the memmap (nothing is read until rows are taken from it)
     :returns:
 
     """
 
-    with open(dtype_file, "rb") as f:
-        dtype = pickle.load(f)
-    read = np.memmap(numpy_file, mode="r", dtype=dtype)
+    footer = read_footer(numpy_file)
+    if footer is not None:
+        dtype, categories = footer["dtype"], footer["categories"]
+        read = np.memmap(numpy_file, mode="r", dtype=dtype, shape=(footer["nrows"],))
+    else:
+        with open(dtype_file, "rb") as f:
+            dtype = pickle.load(f)
+        read = np.memmap(numpy_file, mode="r", dtype=dtype)
+        legacy_categories = categories_file(dtype_file)
+        categories = read_categories(legacy_categories) if os.path.exists(legacy_categories) else None
+    if columns is not None:
+        missing = [column for column in columns if column not in dtype.names]
+        if missing:
+            raise KeyError(f"{numpy_file} has no columns {missing}")
+        read = read[columns]
+    if categories:
+        return CategoricalZcatalog(read, categories)
     return read
 
 
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+from typing import Iterator, Tuple
+
+import fitsio
+import numpy as np
+
+# Reading a FITS table a block of rows at a time, so converting a catalog needs memory for one block of rows
+# (CONVERT_CHUNK_ROWS unless the converter is given --chunk-rows) rather than for the whole catalog (tens of GB
+# for iron). The writers in memmap.py and hdf5.py take these blocks and write them straight into their output.
+
+ZCATALOG_HDU = "ZCATALOG"
+
+
+def fits_layout(fits_file: str, ext: str = ZCATALOG_HDU) -> Tuple[int, np.dtype]:
+    """The number of rows in, and the dtype `fitsio.read` would give for, the EXT table of FITS_FILE"""
+    with fitsio.FITS(fits_file) as f:
+        hdu = f[ext]
+        nrows = hdu.get_nrows()
+        # Read a row rather than trusting the header, so strings come back as the same type they will be read as
+        dtype = hdu[0:1].dtype if nrows else hdu.get_rec_dtype()[0]
+    return nrows, dtype
+
+
+def fits_chunks(fits_file: str, chunk_rows: int, ext: str = ZCATALOG_HDU) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yield (first row, rows) for consecutive blocks of at most CHUNK_ROWS rows of the EXT table of FITS_FILE"""
+    with fitsio.FITS(fits_file) as f:
+        hdu = f[ext]
+        nrows = hdu.get_nrows()
+        for start in range(0, nrows, chunk_rows):
+            yield start, hdu[start : min(start + chunk_rows, nrows)]
@@ -1,16 +1,19 @@
 import datetime
+import json
 import os
-from json import dumps
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Union
 
-import requests
-from desispec.io import read_spectra
+import numpy as np
 
+from ..common.aggregate import handle_aggregate
 from ..common.build_spectra import handle_spectra, handle_zcatalog
 from ..common.cache import check_cache
 from ..common.errors import DataNotFoundException, DesiApiException
 from ..common.models import *
-from ..common.utils import log, expand_path
+from ..common.utils import atomic_path, log, expand_path, mimetype
+from .decode import spectra_from_bytes, zcat_from_bytes
+from .transport import DEFAULT_CLIENT_WORKERS, HttpTransport, merge_responses, split_request
 
 
 def default_cache_dir() -> str:
@@ -28,21 +31,50 @@ DEFAULT_SERVER = "http://0.0.0:5000"  # possibly change this
 DEFAULT_MAX_AGE = 60
 
 
-def deserialize(path: str) -> Zcatalog | Spectra:
+def deserialize(path: str) -> Union[Zcatalog, Spectra]:
     log("deserialize path", path)
     base = os.path.basename(path)
     requested_data = base.split(".")[-2]  # Just before the extension
     log(requested_data)
     match requested_data:
         case "zcat":
-            return Table.read(path)
+            with open(path, "rb") as f:
+                return zcat_from_bytes(f.read(), mimetype(path).lstrip("."))
         case "spectra":
+            from desispec.io import read_spectra
+
             return read_spectra(path)
+        case "aggregate":
+            with open(path) as f:
+                return json.load(f)
+        case _:
+            raise DesiApiException()
+
+
+def decode_response(req: ApiRequest, response_data: bytes) -> Union[Zcatalog, Spectra]:
+    """Decode the server's response to REQ directly from the bytes of the response"""
+    match req.requested_data:
+        case RequestedData.ZCAT:
+            return zcat_from_bytes(response_data, guess_ext(req))
+        case RequestedData.SPECTRA:
+            return spectra_from_bytes(response_data)
+        case RequestedData.AGGREGATE:
+            return json.loads(response_data)
         case _:
             raise DesiApiException()
 
 
+def make_xmatch_params(ra: Sequence[float], dec: Sequence[float], radius: float | Sequence[float]) -> CrossMatchParameters:
+    """Parameters for cross-matching the positions (RA[i], DEC[i]), with either one RADIUS for all of them or one each"""
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), ra.shape)
+    return CrossMatchParameters(ra.tolist(), dec.tolist(), radius.tolist())
+
+
 def guess_ext(req: ApiRequest) -> str:
+    if req.requested_data == RequestedData.AGGREGATE:
+        return "json"
     if "filetype" in req.filters.keys():
         return req.filters["filetype"]
     if req.response_type == ResponseType.PLOT:
@@ -54,6 +86,21 @@ def guess_ext(req: ApiRequest) -> str:
     return DEFAULT_FILETYPE  # as good a guess as any
 
 
+def write_cache_file(
+    cache_root: str, req: ApiRequest, req_time: datetime.datetime, response_data: bytes
+) -> str:
+    """Save the server's response to REQ in the client cache, and return the path to it"""
+    extension = guess_ext(req)
+    requested_data = req.requested_data.name.lower()
+    cache_dir = f"{cache_root}/{req.get_cache_path()}"
+    cache_path = f"{cache_dir}/{req_time.isoformat()}.{requested_data}.{extension}"
+    # Written to a temporary file and moved into place, so check_cache never picks up a partly written file
+    with atomic_path(cache_path) as tmp_path:
+        with open(tmp_path, "wb") as resp_file:
+            resp_file.write(response_data)
+    return cache_path
+
+
 def make_request(
     requested_data: RequestedData,
     endpoint: Endpoint,
@@ -72,14 +119,26 @@ def make_request(
 
 class DesiApiClient:
     def __init__(
-        self, release=None, server_url=None, cache_root=None, cache_max_age=None
+        self,
+        release=None,
+        server_url=None,
+        cache_root=None,
+        cache_max_age=None,
+        max_workers=None,
+        write_cache=True,
     ) -> None:
         self.release = release or default_release()
         self.server_url = server_url or DEFAULT_SERVER
         self.cache_root = cache_root or default_cache_dir()
         self.cache_max_age = DEFAULT_MAX_AGE
+        self.write_cache = write_cache
+        self.transport = HttpTransport(
+            self.server_url, max_workers=max_workers or DEFAULT_CLIENT_WORKERS
+        )
+        # Responses are decoded straight from memory, and saved to the cache in the background
+        self._cache_writer = ThreadPoolExecutor(max_workers=1)
 
-    def get_data_with_fallback(self, req: ApiRequest) -> Zcatalog | Spectra:
+    def get_data_with_fallback(self, req: ApiRequest) -> Union[Zcatalog, Spectra]:
         req.release = self.release
         try:
             match req.requested_data:
@@ -89,30 +148,37 @@ class DesiApiClient:
                     resp = handle_spectra(req)
                     log("handled spectra")
                     return resp
+                case RequestedData.AGGREGATE:
+                    return handle_aggregate(req)
                 case _:
                     raise MalformedRequestException("Ok what the actual hell")
         except DataNotFoundException:
-            req_time = datetime.datetime.now()
-            cached = check_cache(req, req_time, self.cache_root, self.cache_max_age)
-            if cached:
-                log("using cache", cached)
-                return deserialize(cached)
-            web_response = self.fallback_to_web(req, req_time)
-            log(web_response)
-            return deserialize(web_response)
-
-    def fallback_to_web(self, req: ApiRequest, req_time: datetime.datetime) -> str:
-        extension = guess_ext(req)
-        payload = req.to_post_payload()
-        resp = requests.post(f"{self.server_url}/api/v1/post", json=dumps(payload))
-        if not resp.ok:
-            raise DesiApiException(f"Server Failed With Response: {resp.text}", resp)
-        response_data = resp.content
-        requested_data = req.requested_data.name.lower()
-        cache_path = f"{self.cache_root}/{req.get_cache_path()}/{req_time.isoformat()}.{requested_data}.{extension}"
-        with open(cache_path, "wb") as resp_file:
-            resp_file.write(response_data)
-        return cache_path
+            # Requests larger than the server accepts are split up, fetched concurrently, and merged back in order
+            chunks = split_request(req)
+            log(f"fetching from server in {len(chunks)} chunk(s)")
+            return merge_responses(req, self.transport.map(self.fetch_from_web, chunks))
+
+    def fetch_from_web(self, req: ApiRequest) -> Union[Zcatalog, Spectra]:
+        """Get the response to REQ from the client cache if it is recent enough, otherwise from the server"""
+        req_time = datetime.datetime.now()
+        cached = check_cache(req, req_time, self.cache_root, self.cache_max_age)
+        if cached:
+            log("using cache", cached)
+            return deserialize(cached)
+        return decode_response(req, self.fallback_to_web(req, req_time))
+
+    def fallback_to_web(self, req: ApiRequest, req_time: datetime.datetime) -> bytes:
+        """Fetch the response to REQ from the server, start saving it to the cache, and return the raw response"""
+        response_data = self.transport.post(req)
+        if self.write_cache:
+            self._cache_writer.submit(
+                write_cache_file, self.cache_root, req, req_time, response_data
+            )
+        return response_data
+
+    def flush_cache_writes(self):
+        """Wait for any responses still being written to the cache"""
+        self._cache_writer.submit(lambda: None).result()
 
     # user facing class methods
     def get_zcat_radec(self, ra: float, dec: float, radius: float, **filters):
@@ -124,18 +190,49 @@ class DesiApiClient:
         )
         return self.get_data_with_fallback(req)
 
+    def get_zcat_box(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float, **filters):
+        req = make_request(
+            RequestedData.ZCAT,
+            Endpoint.BOX,
+            BoxParameters(ra_min, ra_max, dec_min, dec_max),
+            filters,
+        )
+        return self.get_data_with_fallback(req)
+
+    def get_zcat_polygon(self, ra: Sequence[float], dec: Sequence[float], **filters):
+        req = make_request(
+            RequestedData.ZCAT,
+            Endpoint.POLYGON,
+            PolygonParameters(list(ra), list(dec)),
+            filters,
+        )
+        return self.get_data_with_fallback(req)
+
     def get_zcat_tile(self, tile: int, fibers: List[int], **filters):
         req = make_request(
             RequestedData.ZCAT, Endpoint.TILE, TileParameters(tile, fibers), filters
         )
         return self.get_data_with_fallback(req)
 
+    def get_zcat_tiles(self, tiles: Dict[int, List[int]], **filters):
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.TILES, MultiTileParameters(tiles), filters
+        )
+        return self.get_data_with_fallback(req)
+
     def get_zcat_targets(self, target_ids: List[int], **filters):
         req = make_request(
             RequestedData.ZCAT, Endpoint.TARGETS, TargetParameters(target_ids), filters
         )
         return self.get_data_with_fallback(req)
 
+    def get_zcat_xmatch(self, ra: Sequence[float], dec: Sequence[float], radius: float | Sequence[float], **filters):
+        """The zcat rows within RADIUS of each (RA[i], DEC[i]), tagged with the index of the position they matched (INPUT_ROW) and their separation from it (SEPARATION)"""
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.XMATCH, make_xmatch_params(ra, dec, radius), filters
+        )
+        return self.get_data_with_fallback(req)
+
     def get_spectra_radec(self, ra: float, dec: float, radius: float, **filters):
         req = make_request(
             RequestedData.SPECTRA,
@@ -145,12 +242,39 @@ class DesiApiClient:
         )
         return self.get_data_with_fallback(req)
 
+    def get_spectra_box(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float, **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.BOX,
+            BoxParameters(ra_min, ra_max, dec_min, dec_max),
+            filters,
+        )
+        return self.get_data_with_fallback(req)
+
+    def get_spectra_polygon(self, ra: Sequence[float], dec: Sequence[float], **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.POLYGON,
+            PolygonParameters(list(ra), list(dec)),
+            filters,
+        )
+        return self.get_data_with_fallback(req)
+
     def get_spectra_tile(self, tile: int, fibers: List[int], **filters):
         req = make_request(
             RequestedData.SPECTRA, Endpoint.TILE, TileParameters(tile, fibers), filters
         )
         return self.get_data_with_fallback(req)
 
+    def get_spectra_tiles(self, tiles: Dict[int, List[int]], **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.TILES,
+            MultiTileParameters(tiles),
+            filters,
+        )
+        return self.get_data_with_fallback(req)
+
     def get_spectra_targets(self, target_ids: List[int], **filters):
         req = make_request(
             RequestedData.SPECTRA,
@@ -160,6 +284,16 @@ class DesiApiClient:
         )
         return self.get_data_with_fallback(req)
 
+    def get_aggregate(self, endpoint: Union[Endpoint, str], params: Parameters, **filters) -> dict:
+        """Counts, ranges and histograms over the zcat rows ENDPOINT would return for PARAMS, without fetching the rows. FILTERS are the usual filters plus `group_by`, `stats`, `hist` and `hist2d`, e.g.
+
+            client.get_aggregate("radec", RadecParameters(210.9, 5.2, 0.5), group_by="SURVEY,PROGRAM", hist="Z:0:4:40")
+        """
+        if isinstance(endpoint, str):
+            endpoint = Endpoint[endpoint.upper()]
+        req = make_request(RequestedData.AGGREGATE, endpoint, params, filters)
+        return self.get_data_with_fallback(req)
+
 
 # User-facing functions
 
@@ -178,6 +312,34 @@ def get_zcat_radec(
     )
 
 
+def get_zcat_box(
+    ra_min: float,
+    ra_max: float,
+    dec_min: float,
+    dec_max: float,
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_zcat_box(
+        ra_min, ra_max, dec_min, dec_max, **filters
+    )
+
+
+def get_zcat_polygon(
+    ra: Sequence[float],
+    dec: Sequence[float],
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_zcat_polygon(
+        ra, dec, **filters
+    )
+
+
 def get_zcat_tile(
     tile: int,
     fibers: List[int],
@@ -191,6 +353,18 @@ def get_zcat_tile(
     )
 
 
+def get_zcat_tiles(
+    tiles: Dict[int, List[int]],
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_zcat_tiles(
+        tiles, **filters
+    )
+
+
 def get_zcat_targets(
     target_ids: List[int], release: str, server_url=None, cache_root=None, **filters
 ):
@@ -199,6 +373,20 @@ def get_zcat_targets(
     )
 
 
+def get_zcat_xmatch(
+    ra: Sequence[float],
+    dec: Sequence[float],
+    radius: float | Sequence[float],
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_zcat_xmatch(
+        ra, dec, radius, **filters
+    )
+
+
 def get_spectra_radec(
     ra: float,
     dec: float,
@@ -213,6 +401,34 @@ def get_spectra_radec(
     )
 
 
+def get_spectra_box(
+    ra_min: float,
+    ra_max: float,
+    dec_min: float,
+    dec_max: float,
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_spectra_box(
+        ra_min, ra_max, dec_min, dec_max, **filters
+    )
+
+
+def get_spectra_polygon(
+    ra: Sequence[float],
+    dec: Sequence[float],
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_spectra_polygon(
+        ra, dec, **filters
+    )
+
+
 def get_spectra_tile(
     tile: int,
     fibers: List[int],
@@ -226,9 +442,34 @@ def get_spectra_tile(
     )
 
 
+def get_spectra_tiles(
+    tiles: Dict[int, List[int]],
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_spectra_tiles(
+        tiles, **filters
+    )
+
+
 def get_spectra_targets(
     target_ids: List[int], release: str, server_url=None, cache_root=None, **filters
 ):
     return DesiApiClient(release, server_url, cache_root).get_spectra_targets(
         target_ids, **filters
     )
+
+
+def get_aggregate(
+    endpoint: Union[Endpoint, str],
+    params: Parameters,
+    release: str,
+    server_url=None,
+    cache_root=None,
+    **filters,
+):
+    return DesiApiClient(release, server_url, cache_root).get_aggregate(
+        endpoint, params, **filters
+    )
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import asyncio
+import datetime
+from json import dumps
+from typing import Dict, List, Optional, Sequence, Set, Union
+
+import aiohttp
+
+from ..common.aggregate import handle_aggregate
+from ..common.build_spectra import handle_spectra, handle_zcatalog
+from ..common.cache import check_cache
+from ..common.errors import DataNotFoundException, DesiApiException, MalformedRequestException
+from ..common.models import *
+from ..common.utils import log
+from .api import (
+    DEFAULT_MAX_AGE,
+    DEFAULT_SERVER,
+    decode_response,
+    default_cache_dir,
+    default_release,
+    deserialize,
+    make_request,
+    make_xmatch_params,
+    write_cache_file,
+)
+from .transport import DEFAULT_RETRIES, DEFAULT_TIMEOUT, RETRY_STATUSES, merge_responses, split_request
+
+# An asyncio version of DesiApiClient, for issuing many independent queries from one process (notebooks,
+# orchestration services). The methods are the same as DesiApiClient's, but are coroutines:
+#
+#     async with AsyncDesiApiClient("iron") as client:
+#         tables = await asyncio.gather(*[client.get_zcat_radec(ra, dec, 10) for ra, dec in points])
+#
+# At most `max_concurrency` requests are sent to the server at once, however many are awaited. Responses go in the
+# same cache directory as DesiApiClient's, and identical requests that are in flight at the same time share a
+# single server round trip.
+
+DEFAULT_CONCURRENCY = 32
+
+
+class AsyncDesiApiClient:
+    def __init__(
+        self,
+        release=None,
+        server_url=None,
+        cache_root=None,
+        cache_max_age=None,
+        max_concurrency=None,
+        retries=DEFAULT_RETRIES,
+        timeout=DEFAULT_TIMEOUT,
+        write_cache=True,
+    ) -> None:
+        self.release = release or default_release()
+        self.server_url = server_url or DEFAULT_SERVER
+        self.cache_root = cache_root or default_cache_dir()
+        self.cache_max_age = DEFAULT_MAX_AGE
+        self.max_concurrency = max_concurrency or DEFAULT_CONCURRENCY
+        self.retries = retries
+        self.timeout = timeout
+        self.write_cache = write_cache
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight: Dict[str, asyncio.Future] = dict()
+        self._cache_writes: Set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> "AsyncDesiApiClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.flush_cache_writes()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def flush_cache_writes(self):
+        """Wait for any responses still being written to the cache"""
+        if self._cache_writes:
+            await asyncio.gather(*self._cache_writes, return_exceptions=True)
+
+    def session(self) -> aiohttp.ClientSession:
+        # Created on first use, since aiohttp sessions have to be created inside the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def get_data_with_fallback(self, req: ApiRequest) -> Union[Zcatalog, Spectra]:
+        req.release = self.release
+        try:
+            match req.requested_data:
+                case RequestedData.ZCAT:
+                    return await asyncio.to_thread(handle_zcatalog, req)
+                case RequestedData.SPECTRA:
+                    return await asyncio.to_thread(handle_spectra, req)
+                case RequestedData.AGGREGATE:
+                    return await asyncio.to_thread(handle_aggregate, req)
+                case _:
+                    raise MalformedRequestException("invalid requested_data")
+        except DataNotFoundException:
+            chunks = split_request(req)
+            log(f"fetching from server in {len(chunks)} chunk(s)")
+            responses = await asyncio.gather(*[self.fetch_from_web(chunk) for chunk in chunks])
+            return merge_responses(req, list(responses))
+
+    async def fetch_from_web(self, req: ApiRequest) -> Union[Zcatalog, Spectra]:
+        """Get the response to REQ from the client cache if it is recent enough, otherwise from the server. Concurrent calls for the same request share one fetch"""
+        key = req.get_cache_path()
+        if key in self._in_flight:
+            return await asyncio.shield(self._in_flight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await self._fetch_from_web(req)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting on this future, so don't let it log an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _fetch_from_web(self, req: ApiRequest) -> Union[Zcatalog, Spectra]:
+        req_time = datetime.datetime.now()
+        cached = await asyncio.to_thread(
+            check_cache, req, req_time, self.cache_root, self.cache_max_age
+        )
+        if cached:
+            log("using cache", cached)
+            return await asyncio.to_thread(deserialize, cached)
+        response_data = await self.post(req)
+        if self.write_cache:
+            # Saved in the background, the caller only waits for the response to be decoded
+            write = asyncio.create_task(
+                asyncio.to_thread(write_cache_file, self.cache_root, req, req_time, response_data)
+            )
+            self._cache_writes.add(write)
+            write.add_done_callback(self._cache_writes.discard)
+        return await asyncio.to_thread(decode_response, req, response_data)
+
+    async def post(self, req: ApiRequest) -> bytes:
+        """Send REQ to the server and return the body of the response, retrying connection errors and busy-server responses with backoff"""
+        session = self.session()
+        for attempt in range(self.retries + 1):
+            delay = 0.5 * 2**attempt
+            try:
+                async with self._semaphore:
+                    async with session.post(
+                        f"{self.server_url}/api/v1/post",
+                        json=dumps(req.to_post_payload()),
+                    ) as resp:
+                        body = await resp.read()
+                        if resp.ok:
+                            return body
+                        if resp.status not in RETRY_STATUSES or attempt == self.retries:
+                            raise DesiApiException(
+                                f"Server Failed With Response: {body.decode(errors='replace')}", resp.status
+                            )
+                        delay = float(resp.headers.get("Retry-After", delay))
+            except aiohttp.ClientConnectionError:
+                if attempt == self.retries:
+                    raise
+            log(f"retrying in {delay}s")
+            await asyncio.sleep(delay)
+        raise DesiApiException("unreachable")
+
+    # user facing class methods
+    async def get_zcat_radec(self, ra: float, dec: float, radius: float, **filters):
+        req = make_request(
+            RequestedData.ZCAT,
+            Endpoint.RADEC,
+            RadecParameters(ra, dec, radius),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_box(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float, **filters):
+        req = make_request(
+            RequestedData.ZCAT,
+            Endpoint.BOX,
+            BoxParameters(ra_min, ra_max, dec_min, dec_max),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_polygon(self, ra: Sequence[float], dec: Sequence[float], **filters):
+        req = make_request(
+            RequestedData.ZCAT,
+            Endpoint.POLYGON,
+            PolygonParameters(list(ra), list(dec)),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_tile(self, tile: int, fibers: List[int], **filters):
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.TILE, TileParameters(tile, fibers), filters
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_tiles(self, tiles: Dict[int, List[int]], **filters):
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.TILES, MultiTileParameters(tiles), filters
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_targets(self, target_ids: List[int], **filters):
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.TARGETS, TargetParameters(target_ids), filters
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_zcat_xmatch(self, ra: Sequence[float], dec: Sequence[float], radius: float | Sequence[float], **filters):
+        req = make_request(
+            RequestedData.ZCAT, Endpoint.XMATCH, make_xmatch_params(ra, dec, radius), filters
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_radec(self, ra: float, dec: float, radius: float, **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.RADEC,
+            RadecParameters(ra, dec, radius),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_box(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float, **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.BOX,
+            BoxParameters(ra_min, ra_max, dec_min, dec_max),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_polygon(self, ra: Sequence[float], dec: Sequence[float], **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.POLYGON,
+            PolygonParameters(list(ra), list(dec)),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_tile(self, tile: int, fibers: List[int], **filters):
+        req = make_request(
+            RequestedData.SPECTRA, Endpoint.TILE, TileParameters(tile, fibers), filters
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_tiles(self, tiles: Dict[int, List[int]], **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.TILES,
+            MultiTileParameters(tiles),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_spectra_targets(self, target_ids: List[int], **filters):
+        req = make_request(
+            RequestedData.SPECTRA,
+            Endpoint.TARGETS,
+            TargetParameters(target_ids),
+            filters,
+        )
+        return await self.get_data_with_fallback(req)
+
+    async def get_aggregate(self, endpoint: Union[Endpoint, str], params: Parameters, **filters) -> dict:
+        if isinstance(endpoint, str):
+            endpoint = Endpoint[endpoint.upper()]
+        req = make_request(RequestedData.AGGREGATE, endpoint, params, filters)
+        return await self.get_data_with_fallback(req)
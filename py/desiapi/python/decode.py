@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import io
+import json
+import re
+
+import numpy as np
+
+from ..common.errors import MalformedRequestException
+from ..common.models import Spectra, Zcatalog
+
+# Decoding server responses straight from the bytes of the HTTP body, so the client doesn't have to write a file
+# and read it back before returning anything. The FITS layout is the one `desispec.io.write_spectra` produces.
+
+TABLE_HDUS = ["FIBERMAP", "EXP_FIBERMAP", "SCORES", "EXTRA_CATALOG"]
+
+
+def zcat_from_bytes(data: bytes, filetype: str) -> Zcatalog:
+    """Decode a zcat response body in FILETYPE (fits or json) into an astropy Table"""
+    from astropy.table import Table
+
+    match filetype:
+        case "fits":
+            return Table.read(io.BytesIO(data), format="fits")
+        case "json":
+            records = json.loads(data)
+            return Table(rows=records) if len(records) else Table()
+        case _:
+            raise MalformedRequestException(f"cannot decode zcat responses of type {filetype}")
+
+
+def native_table(hdu):
+    """A FITS table HDU as `read_spectra` gives it: native byte order, strings encoded, header keywords in its meta"""
+    from astropy.table import Table
+    from desispec.io.util import addkeys
+    from desiutil.io import encode_table
+
+    data = np.asarray(hdu.data)
+    table = encode_table(Table(data.astype(data.dtype.newbyteorder("=")), copy=True).as_array())
+    addkeys(table.meta, hdu.header)
+    return table
+
+
+def spectra_from_bytes(data: bytes) -> Spectra:
+    """Decode a spectra FITS response body into a Spectra object, equivalent to `desispec.io.read_spectra` on the same file. Like it, the *_MODEL and REDSHIFTS HDUs are left out"""
+    from astropy.io import fits
+    from desispec.spectra import Spectra
+
+    tables = dict()
+    bands = []
+    wave, flux, ivar, mask, resolution, extra = dict(), dict(), dict(), dict(), dict(), dict()
+    with fits.open(io.BytesIO(data), memmap=False) as hdus:
+        meta = dict(hdus[0].header)
+        for hdu in hdus[1:]:
+            name = hdu.name
+            if name in TABLE_HDUS:
+                tables[name] = native_table(hdu)
+                continue
+            match = re.match(r"(.*)_(.*)", name)
+            if match is None:
+                continue
+            band, kind = match.group(1).lower(), match.group(2)
+            if band not in bands:
+                bands.append(band)
+            if kind == "WAVELENGTH":
+                wave[band] = np.asarray(hdu.data, dtype=np.float64)
+            elif kind == "FLUX":
+                flux[band] = np.asarray(hdu.data, dtype=np.float64)
+            elif kind == "IVAR":
+                ivar[band] = np.asarray(hdu.data, dtype=np.float64)
+            elif kind == "MASK":
+                mask[band] = np.asarray(hdu.data, dtype=np.uint32)
+            elif kind == "RESOLUTION":
+                resolution[band] = np.asarray(hdu.data, dtype=np.float64)
+            elif kind != "MODEL":
+                extra.setdefault(band, dict())[kind] = np.asarray(hdu.data, dtype=np.float64)
+    return Spectra(
+        bands=bands,
+        wave=wave,
+        flux=flux,
+        ivar=ivar,
+        mask=mask or None,
+        resolution_data=resolution or None,
+        fibermap=tables.get("FIBERMAP"),
+        exp_fibermap=tables.get("EXP_FIBERMAP"),
+        meta=meta,
+        extra=extra or None,
+        scores=tables.get("SCORES"),
+        extra_catalog=tables.get("EXTRA_CATALOG"),
+    )
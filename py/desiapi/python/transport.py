@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from typing import Callable, Dict, List, TypeVar, Union
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..common.errors import DesiApiException
+from ..common.models import *
+
+# How the client talks to the server. A single pooled session is shared by every request a client makes, so
+# connections are kept alive between requests, and transient failures (connection errors, 429/502/503/504) are
+# retried with backoff. Requests bigger than the server accepts are split into chunks that are fetched concurrently
+# and merged back together in order.
+
+DEFAULT_CLIENT_WORKERS = 4  # Chunks of a single request fetched at once
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 300  # seconds, building a large spectra response can take a while
+RETRY_STATUSES = [429, 502, 503, 504]
+
+T = TypeVar("T")
+
+
+def make_session(pool_size: int = DEFAULT_CLIENT_WORKERS, retries: int = DEFAULT_RETRIES) -> requests.Session:
+    """A requests Session with a connection pool of POOL_SIZE and automatic retries"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def chunks(items: list, size: int) -> List[list]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def split_tiles(tiles: Dict[int, List[int]]) -> List[Dict[int, List[int]]]:
+    """Split a multi-tile request into groups of at most MAX_TILES tiles and MAX_FIBERS fibers, keeping the tile order"""
+    groups: List[Dict[int, List[int]]] = [dict()]
+    fibers_in_group = 0
+    for tile, fibers in tiles.items():
+        for part in chunks(list(fibers), MAX_FIBERS) or [[]]:
+            if len(groups[-1]) == MAX_TILES or fibers_in_group + len(part) > MAX_FIBERS:
+                groups.append(dict())
+                fibers_in_group = 0
+            groups[-1].setdefault(tile, []).extend(part)
+            fibers_in_group += len(part)
+    return groups
+
+
+def split_request(req: ApiRequest) -> List[ApiRequest]:
+    """Split REQ into requests small enough for the server to accept, such that concatenating their responses in order gives the response to REQ"""
+    params = req.params
+    if req.requested_data == RequestedData.AGGREGATE:
+        # Aggregates over parts of a request can't be put back together, so they're sent whole
+        split = []
+    elif req.endpoint == Endpoint.TARGETS:
+        split = [TargetParameters(ids) for ids in chunks(list(params.target_ids), MAX_TARGET_IDS)]
+    elif req.endpoint == Endpoint.TILE:
+        split = [TileParameters(params.tile, fibers) for fibers in chunks(list(params.fibers), MAX_FIBERS)]
+    elif req.endpoint == Endpoint.TILES:
+        split = [MultiTileParameters(tiles) for tiles in split_tiles(params.tiles)]
+    elif req.endpoint == Endpoint.XMATCH:
+        split = [
+            CrossMatchParameters(*positions)
+            for positions in zip(*[chunks(list(values), MAX_XMATCH_POSITIONS) for values in (params.ra, params.dec, params.radius)])
+        ]
+    else:
+        split = []
+    if len(split) <= 1:
+        return [req]
+    return [dataclasses.replace(req, params=p, filters=dict(req.filters)) for p in split]
+
+
+def merge_responses(req: ApiRequest, responses: list) -> Union[Zcatalog, Spectra]:
+    """Concatenate the responses to each chunk of REQ (split by `split_request`), in order. Targets come back in the order they were asked for"""
+    if len(responses) == 1:
+        return responses[0]
+    if req.endpoint == Endpoint.XMATCH:
+        # Each chunk numbers its positions from 0
+        offset = 0
+        for chunk, response in zip(split_request(req), responses):
+            response["INPUT_ROW"] += offset
+            offset += len(chunk.params.ra)
+    if req.requested_data == RequestedData.ZCAT:
+        from astropy.table import vstack
+
+        merged = vstack(responses)
+        target_ids = merged["TARGETID"]
+    else:
+        from desispec.spectra import stack
+
+        merged = stack(responses)
+        target_ids = merged.fibermap["TARGETID"]
+    if req.endpoint == Endpoint.TARGETS:
+        position = {int(t): i for i, t in enumerate(req.params.target_ids)}
+        order = np.argsort([position.get(int(t), len(position)) for t in target_ids], kind="stable")
+        merged = merged[order]
+    return merged
+
+
+class HttpTransport:
+    """Sends ApiRequests to the server over a shared, pooled session"""
+
+    def __init__(
+        self,
+        server_url: str,
+        max_workers: int = DEFAULT_CLIENT_WORKERS,
+        retries: int = DEFAULT_RETRIES,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> None:
+        self.server_url = server_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = make_session(max_workers, retries)
+
+    def post(self, req: ApiRequest) -> bytes:
+        """Send REQ to the server and return the body of the response"""
+        resp = self.session.post(
+            f"{self.server_url}/api/v1/post",
+            json=dumps(req.to_post_payload()),
+            timeout=self.timeout,
+        )
+        if not resp.ok:
+            raise DesiApiException(f"Server Failed With Response: {resp.text}", resp)
+        return resp.content
+
+    def map(self, fetch: Callable[[ApiRequest], T], reqs: List[ApiRequest]) -> List[T]:
+        """Apply FETCH to every request in REQS, up to `max_workers` at a time, and return the results in the same order"""
+        if len(reqs) == 1:
+            return [fetch(reqs[0])]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(reqs))) as pool:
+            return list(pool.map(fetch, reqs))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Benchmark every endpoint against every zcatalog data path, using a synthetic data tree.
+
+Run `python -m desiapi.test.benchmark --out bench.json` to generate a tree (see `synthetic.py`), build the memmap and
+HDF5 intermediates for it, and time tile/targets/radec requests for both zcat and spectra against each of the
+preload, memmap, HDF5 and FITS paths in `unfiltered_zcatalog`.
+
+The report also compares a single cone search over the whole healpix catalog using astropy SkyCoords (what the radec
+endpoint used to do) against the unit vector kernel in `sky.py`.
+
+Spectra requests keep each target's spectrum in the fragment cache (see `fragments.py`), so `times` are cold: the
+cache is cleared before each repeat, and every repeat reads the coadds. `warm_times` are the same request repeated with
+the cache left full, as a popular request would be served.
+
+Each data path is timed in a fresh worker process, since the paths are selected by which intermediates exist under
+`$DESI_API_INTERMEDIATE` and `models` reads that once at import time.
+Results are written as JSON so that they can be compared between runs.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .synthetic import SyntheticTree, make_synthetic_tree, synthetic_environment
+
+MODES = ["preload", "memmap", "hdf5", "fits"]
+REQUESTED_DATA = ["ZCAT", "SPECTRA"]
+ENDPOINTS = ["TILE", "TARGETS", "RADEC"]
+
+
+def mode_intermediate(tree: SyntheticTree, mode: str) -> str:
+    """The directory to use as `$DESI_API_INTERMEDIATE` for MODE, containing only the intermediates that mode should see"""
+    if mode in ("preload", "memmap"):
+        return tree.intermediate
+    path = f"{tree.root}/intermediate-{mode}"
+    os.makedirs(path, exist_ok=True)
+    if mode == "hdf5" and not os.path.exists(f"{path}/hdf5"):
+        os.symlink(f"{tree.intermediate}/hdf5", f"{path}/hdf5")
+    return path
+
+
+def worker_env(tree: SyntheticTree, mode: str) -> dict:
+    env = dict(os.environ)
+    env.update(synthetic_environment(tree))
+    env["DESI_API_INTERMEDIATE"] = mode_intermediate(tree, mode)
+    return env
+
+
+def run_module(args: list, env: dict) -> str:
+    """Run this module in a subprocess with ENV, and return its stdout"""
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.run(
+        [sys.executable, "-m", "desiapi.test.benchmark"] + args,
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    return proc.stdout
+
+
+def build_intermediates(tree: SyntheticTree):
+    """Create the memmap and HDF5 files for the synthetic release. Runs inside a worker process"""
+    from ..common.models import DTYPES_DIR, HDF5_DIR, MEMMAP_DIR
+    from ..convert import hdf5, memmap
+
+    for folder in [MEMMAP_DIR, HDF5_DIR, DTYPES_DIR]:
+        os.makedirs(folder, exist_ok=True)
+    memmap.create_memmap(tree.release)
+    hdf5.create_hdf5(tree.release)
+
+
+def build_cases(tree: SyntheticTree):
+    """The (requested_data, endpoint, params) combinations to time"""
+    from ..common.models import RadecParameters, TargetParameters, TileParameters
+
+    tile, fibers = next(iter(tree.tiles.items()))
+    # get_radec_zcatalog currently interprets the radius in degrees
+    radius = tree.cluster_radius / 3600
+    params = {
+        "TILE": TileParameters(tile, fibers[:10] + fibers[-10:]),
+        "TARGETS": TargetParameters(tree.target_ids[:20]),
+        "RADEC": RadecParameters(tree.cluster_ra, tree.cluster_dec, radius),
+    }
+    return [(data, endpoint, params[endpoint]) for data in REQUESTED_DATA for endpoint in ENDPOINTS]
+
+
+def time_mode(tree: SyntheticTree, mode: str, repeat: int) -> dict:
+    """Time every case for a single data path. Runs inside a worker process"""
+    from ..common import build_spectra
+    from ..common.fragments import FRAGMENT_CACHE
+    from ..common.models import ApiRequest, Endpoint, RequestedData, ResponseType
+    from ..common.preload import preload_fits
+
+    # Only the preload path should see preloaded data
+    start = time.perf_counter()
+    if mode == "preload":
+        preload_fits([tree.release])
+    setup = time.perf_counter() - start
+
+    results = []
+    for data, endpoint, params in build_cases(tree):
+        req = ApiRequest(
+            requested_data=RequestedData[data],
+            response_type=ResponseType.DOWNLOAD,
+            release=tree.release,
+            endpoint=Endpoint[endpoint],
+            params=params,
+            filters=dict(),
+        )
+        handler = build_spectra.handle_zcatalog if data == "ZCAT" else build_spectra.handle_spectra
+        result = {"mode": mode, "requested_data": data, "endpoint": endpoint}
+        times, warm_times = [], []
+        try:
+            for _ in range(repeat):
+                FRAGMENT_CACHE.clear()
+                start = time.perf_counter()
+                response = handler(req)
+                times.append(time.perf_counter() - start)
+            # The last cold repeat left every fragment this request needs in the cache
+            for _ in range(repeat):
+                start = time.perf_counter()
+                handler(req)
+                warm_times.append(time.perf_counter() - start)
+            result["rows"] = len(response) if data == "ZCAT" else response.num_spectra()
+            result.update(
+                times=times,
+                min=min(times),
+                median=statistics.median(times),
+                mean=statistics.mean(times),
+                warm_times=warm_times,
+                warm_min=min(warm_times),
+                warm_median=statistics.median(warm_times),
+            )
+        except Exception as e:
+            result["error"] = repr(e)
+        results.append(result)
+    return {"mode": mode, "setup": setup, "results": results}
+
+
+def skycoord_cone(ra_column, dec_column, ra: float, dec: float, radius: float):
+    """The cone search select_radec_rows used to do, with astropy SkyCoords for the whole catalog"""
+    import numpy as np
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+
+    targets = SkyCoord(ra_column * u.degree, dec_column * u.degree)
+    centre = SkyCoord(ra * u.degree, dec * u.degree)
+    return np.flatnonzero(centre.separation(targets) <= radius * u.degree)
+
+
+def time_cone_search(tree: SyntheticTree, repeat: int) -> dict:
+    """Time a single cone search over the whole healpix catalog with SkyCoord, and with the unit vector kernel in `sky.py` (both with vectors precomputed, as for preloaded releases, and computed on the fly). Runs inside a worker process"""
+    import fitsio
+
+    from ..common import sky
+    from ..common.models import DataRelease
+
+    release = DataRelease(tree.release)
+    catalog = fitsio.read(release.healpix_fits, "ZCATALOG", columns=["TARGET_RA", "TARGET_DEC"])
+    ra_column, dec_column = catalog["TARGET_RA"], catalog["TARGET_DEC"]
+    xyz = sky.unit_vectors(ra_column, dec_column)
+    radius = tree.cluster_radius / 3600
+    searches = {
+        "skycoord": lambda: skycoord_cone(ra_column, dec_column, tree.cluster_ra, tree.cluster_dec, radius),
+        "unit_vectors": lambda: sky.cone_search(ra_column, dec_column, tree.cluster_ra, tree.cluster_dec, radius),
+        "preloaded_unit_vectors": lambda: sky.cone_search_vectors(xyz, tree.cluster_ra, tree.cluster_dec, radius),
+    }
+    results = []
+    expected = None
+    for name, search in searches.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = search()
+            times.append(time.perf_counter() - start)
+        expected = rows if expected is None else expected
+        results.append(
+            {
+                "method": name,
+                "rows": len(rows),
+                "matches_skycoord": bool(len(rows) == len(expected) and (rows == expected).all()),
+                "times": times,
+                "min": min(times),
+                "median": statistics.median(times),
+                "mean": statistics.mean(times),
+            }
+        )
+    return {"catalog_rows": len(catalog), "results": results}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(tree: SyntheticTree, modes: list, repeat: int) -> dict:
+    """Build intermediates for TREE and time each mode in its own process, returning the combined report"""
+    import numpy as np
+
+    run_module(["--build", tree.root], worker_env(tree, "memmap"))
+    report = {
+        "timestamp": dt.datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "release": tree.release,
+        "healpix_rows": tree.healpix_rows,
+        "tile_rows": tree.tile_rows,
+        "repeat": repeat,
+        "setup": dict(),
+        "results": [],
+    }
+    out = run_module(["--cone", "--repeat", str(repeat), tree.root], worker_env(tree, "memmap"))
+    report["cone_search"] = json.loads(out.strip().splitlines()[-1])
+    for mode in modes:
+        out = run_module(["--worker", mode, "--repeat", str(repeat), tree.root], worker_env(tree, mode))
+        timed = json.loads(out.strip().splitlines()[-1])
+        report["setup"][mode] = timed["setup"]
+        report["results"].extend(timed["results"])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="desiapi.test.benchmark")
+    parser.add_argument("root", nargs="?", help="synthetic tree to use, generated if it does not exist")
+    parser.add_argument("--rows", type=int, default=500_000, help="rows in each generated zcatalog")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", default=",".join(MODES), help="comma-separated subset of " + ",".join(MODES))
+    parser.add_argument("--out", help="file to write the JSON report to, defaults to stdout")
+    parser.add_argument("--build", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--cone", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build:
+        build_intermediates(SyntheticTree.load(args.root))
+        return
+    if args.cone:
+        print(json.dumps(time_cone_search(SyntheticTree.load(args.root), args.repeat)))
+        return
+    if args.worker:
+        # Last line of stdout is the result, anything else (logging from desispec etc.) is ignored
+        print(json.dumps(time_mode(SyntheticTree.load(args.root), args.worker, args.repeat)))
+        return
+
+    root = args.root or tempfile.mkdtemp(prefix="desiapi-bench-")
+    if os.path.exists(f"{root}/synthetic.json"):
+        tree = SyntheticTree.load(root)
+    else:
+        tree = make_synthetic_tree(root, healpix_rows=args.rows, tile_rows=args.rows)
+    report = run_benchmarks(tree, args.modes.split(","), args.repeat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
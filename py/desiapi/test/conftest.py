@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Fixtures for the tests that run against a small synthetic release, see `synthetic.py`.
+
+`desiapi.common.models` reads its paths from the environment when it is imported, so the environment is pointed at
+the tree here, before any test module imports it, and the tree itself is only generated when a test first asks for
+it. If DESI_SPECTRO_REDUX is already set, the tests run against that production instead, and the ones that need the
+synthetic release are skipped.
+"""
+import os
+import tempfile
+
+import pytest
+
+from desiapi.test.synthetic import SYNTHETIC_RELEASE, SyntheticTree, make_synthetic_tree, root_environment
+
+TEST_ROWS = 20_000  # Rows in each synthetic zcatalog, enough for several rows per healpix and tile
+TEST_NWAVE = 50
+
+SYNTHETIC_ROOT = None
+if "DESI_SPECTRO_REDUX" not in os.environ:
+    SYNTHETIC_ROOT = tempfile.mkdtemp(prefix="desiapi-test-")
+    os.environ.update(root_environment(SYNTHETIC_ROOT))
+
+
+@pytest.fixture(scope="session")
+def synthetic_tree() -> SyntheticTree:
+    if SYNTHETIC_ROOT is None:
+        pytest.skip("DESI_SPECTRO_REDUX points at a real production")
+    if os.path.exists(f"{SYNTHETIC_ROOT}/synthetic.json"):
+        return SyntheticTree.load(SYNTHETIC_ROOT)
+    return make_synthetic_tree(
+        SYNTHETIC_ROOT, SYNTHETIC_RELEASE, healpix_rows=TEST_ROWS, tile_rows=TEST_ROWS, nwave=TEST_NWAVE
+    )
+
+
+@pytest.fixture
+def client(synthetic_tree, tmp_path):
+    """A test client for the server, caching responses in a fresh directory"""
+    from desiapi.common.fragments import FRAGMENT_CACHE
+    from desiapi.web.server import app
+
+    FRAGMENT_CACHE.clear()
+    app.config.update({"cache": {"path": str(tmp_path / "cache"), "max_age": 0, "max_size": "1gb"}})
+    return app.test_client()
+
+
+@pytest.fixture
+def release(synthetic_tree):
+    """The synthetic DataRelease, as requests see it"""
+    from desiapi.common.models import get_release
+
+    return get_release(synthetic_tree.release)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""Generate a synthetic, DESI-shaped data tree for tests and benchmarks.
+
+The tree mimics the layout of a real production under `$DESI_SPECTRO_REDUX`:
+
+- `<release>/zcatalog/zall-pix-<release>.fits` and `zall-tilecumulative-<release>.fits`
+- `<release>/healpix/<survey>/<program>/<group>/<healpix>/{coadd,redrock}-*.fits`
+- `<release>/tiles/cumulative/<tile>/<night>/{coadd,redrock}-<petal>-<tile>-thru<night>.fits`
+
+Only a small cluster of targets (and a handful of tiles) are backed by real coadd/redrock files, the rest of the
+zcatalog rows are random filler spread over the sky so the catalogs have realistic sizes.
+"""
+import argparse
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+import fitsio
+import numpy as np
+import numpy.lib.recfunctions as rfn
+
+SYNTHETIC_RELEASE = "synth"
+BANDS = ["b", "r", "z"]
+BAND_RANGES = {"b": (3600.0, 5800.0), "r": (5760.0, 7620.0), "z": (7520.0, 9824.0)}
+NDIAG = 11
+SURVEYS = ["cmx", "special", "sv1", "sv2", "sv3", "main"]
+PROGRAMS = ["backup", "bright", "dark", "other"]
+HEALPIX_NSIDE = 64
+
+# Where the spectra-backed cluster of targets lives on the sky
+CLUSTER_RA = 210.9
+CLUSTER_DEC = 24.8
+CLUSTER_RADIUS = 50 / 3600  # degrees, well inside the radec limit
+
+
+@dataclass
+class SyntheticTree:
+    """Description of a generated tree, enough for a benchmark or test to build requests against it"""
+
+    root: str
+    release: str
+    healpix_rows: int
+    tile_rows: int
+    cluster_ra: float
+    cluster_dec: float
+    cluster_radius: float  # arcseconds
+    target_ids: List[int] = field(default_factory=list)
+    tiles: Dict[int, List[int]] = field(default_factory=dict)
+
+    @property
+    def redux(self) -> str:
+        return f"{self.root}/redux"
+
+    @property
+    def intermediate(self) -> str:
+        return f"{self.root}/intermediate"
+
+    def save(self):
+        with open(f"{self.root}/synthetic.json", "w") as f:
+            json.dump(asdict(self), f)
+
+    @staticmethod
+    def load(root: str) -> "SyntheticTree":
+        with open(f"{root}/synthetic.json") as f:
+            data = json.load(f)
+        data["tiles"] = {int(k): v for k, v in data["tiles"].items()}
+        return SyntheticTree(**data)
+
+
+def zcat_dtype(tile: bool) -> np.dtype:
+    """Column layout modelled on the real zall-pix/zall-tilecumulative ZCATALOG HDU (a representative subset)"""
+    columns = [
+        ("TARGETID", "i8"),
+        ("SURVEY", "U7"),
+        ("PROGRAM", "U6"),
+        ("HEALPIX", "i4"),
+        ("SPGRPVAL", "i4"),
+        ("Z", "f8"),
+        ("ZERR", "f8"),
+        ("ZWARN", "i8"),
+        ("CHI2", "f8"),
+        ("COEFF", "f8", (10,)),
+        ("NPIXELS", "i8"),
+        ("SPECTYPE", "U6"),
+        ("SUBTYPE", "U20"),
+        ("NCOEFF", "i8"),
+        ("DELTACHI2", "f8"),
+        ("COADD_FIBERSTATUS", "i4"),
+        ("TARGET_RA", "f8"),
+        ("TARGET_DEC", "f8"),
+        ("FLUX_G", "f4"),
+        ("FLUX_R", "f4"),
+        ("FLUX_Z", "f4"),
+        ("EBV", "f4"),
+        ("DESI_TARGET", "i8"),
+        ("BGS_TARGET", "i8"),
+        ("MWS_TARGET", "i8"),
+        ("TSNR2_LRG", "f4"),
+        ("ZCAT_NSPEC", "i2"),
+        ("ZCAT_PRIMARY", "?"),
+    ]
+    if tile:
+        columns += [("TILEID", "i4"), ("LASTNIGHT", "i4"), ("PETAL_LOC", "i2"), ("FIBER", "i4")]
+    return np.dtype(columns)
+
+
+def random_sky(rng: np.random.Generator, n: int):
+    """Uniformly distributed points on the sphere, avoiding the cluster"""
+    ra = rng.uniform(0, 360, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    near = (np.abs(dec - CLUSTER_DEC) < 1) & (np.abs(ra - CLUSTER_RA) < 1)
+    dec[near] += 5
+    return ra, dec
+
+
+def healpix_of(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    import healpy
+
+    return healpy.ang2pix(HEALPIX_NSIDE, ra, dec, nest=True, lonlat=True).astype("i4")
+
+
+def fill_zcat(rng: np.random.Generator, n: int, tile: bool) -> np.ndarray:
+    """Random filler rows with realistic types and value ranges"""
+    zcat = np.zeros(n, dtype=zcat_dtype(tile))
+    zcat["TARGETID"] = rng.choice(2**52, n, replace=False) + 2**55
+    zcat["SURVEY"] = rng.choice(SURVEYS, n, p=[0.02, 0.03, 0.1, 0.05, 0.15, 0.65])
+    zcat["PROGRAM"] = rng.choice(PROGRAMS, n, p=[0.05, 0.35, 0.55, 0.05])
+    ra, dec = random_sky(rng, n)
+    zcat["TARGET_RA"] = ra
+    zcat["TARGET_DEC"] = dec
+    zcat["HEALPIX"] = healpix_of(ra, dec)
+    zcat["SPGRPVAL"] = zcat["HEALPIX"]
+    zcat["Z"] = rng.exponential(0.8, n)
+    zcat["ZERR"] = rng.exponential(1e-4, n)
+    zcat["ZWARN"] = rng.choice([0, 4, 5, 1570], n, p=[0.9, 0.05, 0.03, 0.02])
+    zcat["CHI2"] = rng.normal(8000, 500, n)
+    zcat["COEFF"] = rng.normal(0, 1, (n, 10))
+    zcat["NPIXELS"] = 7929
+    zcat["SPECTYPE"] = rng.choice(["GALAXY", "QSO", "STAR"], n, p=[0.75, 0.15, 0.1])
+    zcat["NCOEFF"] = 10
+    zcat["DELTACHI2"] = rng.exponential(100, n)
+    for col in ["FLUX_G", "FLUX_R", "FLUX_Z"]:
+        zcat[col] = rng.lognormal(0, 1, n)
+    zcat["EBV"] = rng.uniform(0, 0.1, n)
+    zcat["DESI_TARGET"] = rng.integers(0, 2**20, n)
+    zcat["TSNR2_LRG"] = rng.uniform(0, 200, n)
+    zcat["ZCAT_NSPEC"] = 1
+    zcat["ZCAT_PRIMARY"] = rng.uniform(0, 1, n) < 0.95
+    if tile:
+        zcat["TILEID"] = rng.integers(1000, 90000, n)
+        zcat["LASTNIGHT"] = 20210505
+        zcat["FIBER"] = rng.integers(0, 5000, n)
+        zcat["PETAL_LOC"] = zcat["FIBER"] // 500
+    return zcat
+
+
+def fake_spectra(rng: np.random.Generator, fibermap, nwave: int):
+    """Build a coadd-like Spectra object with random flux for every row of FIBERMAP"""
+    from desispec.spectra import Spectra
+
+    n = len(fibermap)
+    wave, flux, ivar, mask, res = dict(), dict(), dict(), dict(), dict()
+    for band in BANDS:
+        lo, hi = BAND_RANGES[band]
+        wave[band] = np.linspace(lo, hi, nwave)
+        flux[band] = rng.normal(1, 0.5, (n, nwave)).astype("f4")
+        ivar[band] = rng.uniform(0.5, 2, (n, nwave)).astype("f4")
+        mask[band] = np.zeros((n, nwave), dtype="i4")
+        kernel = np.exp(-0.5 * (np.arange(NDIAG) - NDIAG // 2) ** 2)
+        kernel /= kernel.sum()
+        res[band] = np.tile(kernel[None, :, None], (n, 1, nwave)).astype("f4")
+    return Spectra(
+        bands=BANDS,
+        wave=wave,
+        flux=flux,
+        ivar=ivar,
+        mask=mask,
+        resolution_data=res,
+        fibermap=fibermap,
+    )
+
+
+def redrock_table(rows: np.ndarray) -> np.ndarray:
+    """A REDSHIFTS HDU carved out of zcat rows"""
+    columns = ["TARGETID", "CHI2", "COEFF", "Z", "ZERR", "ZWARN", "NPIXELS", "SPECTYPE", "SUBTYPE", "NCOEFF", "DELTACHI2"]
+    return rfn.repack_fields(rows[columns])
+
+
+def write_healpix_files(tree: SyntheticTree, rng, cluster: np.ndarray, nwave: int):
+    """Write coadd and redrock files for the cluster targets, grouped by (survey, program, healpix) like the real data"""
+    import desispec.io
+    from astropy.table import Table
+
+    groups = dict()
+    for i, row in enumerate(cluster):
+        groups.setdefault((row["SURVEY"], row["PROGRAM"], row["HEALPIX"]), []).append(i)
+    for (survey, program, hpix), idx in groups.items():
+        rows = cluster[idx]
+        kwargs = dict(healpix=hpix, survey=survey, faprogram=program, groupname="healpix")
+        specprod_dir = f"{tree.redux}/{tree.release}"
+        coadd = desispec.io.findfile("coadd", specprod_dir=specprod_dir, **kwargs)
+        redrock = desispec.io.findfile("redrock", specprod_dir=specprod_dir, **kwargs)
+        fibermap = Table(
+            {
+                "TARGETID": rows["TARGETID"],
+                "TARGET_RA": rows["TARGET_RA"],
+                "TARGET_DEC": rows["TARGET_DEC"],
+                "COADD_FIBERSTATUS": rows["COADD_FIBERSTATUS"],
+            }
+        )
+        desispec.io.write_spectra(coadd, fake_spectra(rng, fibermap, nwave))
+        fitsio.write(redrock, redrock_table(rows), extname="REDSHIFTS", clobber=True)
+
+
+def write_tile_files(tree: SyntheticTree, rng, tile_rows: np.ndarray, nwave: int):
+    """Write per-petal coadd and redrock files for each tile, with an older night alongside the latest one"""
+    import desispec.io
+    from astropy.table import Table
+
+    for tile in np.unique(tile_rows["TILEID"]):
+        in_tile = tile_rows[tile_rows["TILEID"] == tile]
+        for night in [20210405, int(in_tile["LASTNIGHT"][0])]:
+            folder = f"{tree.redux}/{tree.release}/tiles/cumulative/{tile}/{night}"
+            os.makedirs(folder, exist_ok=True)
+            for petal in np.unique(in_tile["PETAL_LOC"]):
+                rows = in_tile[in_tile["PETAL_LOC"] == petal]
+                fibermap = Table(
+                    {
+                        "TARGETID": rows["TARGETID"],
+                        "FIBER": rows["FIBER"],
+                        "PETAL_LOC": rows["PETAL_LOC"],
+                        "TILEID": rows["TILEID"],
+                        "TARGET_RA": rows["TARGET_RA"],
+                        "TARGET_DEC": rows["TARGET_DEC"],
+                        "COADD_FIBERSTATUS": rows["COADD_FIBERSTATUS"],
+                    }
+                )
+                desispec.io.write_spectra(
+                    f"{folder}/coadd-{petal}-{tile}-thru{night}.fits",
+                    fake_spectra(rng, fibermap, nwave),
+                )
+                fitsio.write(
+                    f"{folder}/redrock-{petal}-{tile}-thru{night}.fits",
+                    redrock_table(rows),
+                    extname="REDSHIFTS",
+                    clobber=True,
+                )
+
+
+def make_synthetic_tree(
+    root: str,
+    release: str = SYNTHETIC_RELEASE,
+    healpix_rows: int = 500_000,
+    tile_rows: int = 500_000,
+    cluster_size: int = 60,
+    n_tiles: int = 3,
+    fibers_per_petal: int = 20,
+    nwave: int = 500,
+    seed: int = 0,
+) -> SyntheticTree:
+    """Create a synthetic release under ROOT/redux, and return a description of it.
+
+    :param root: Directory to create the tree in. `ROOT/redux` plays the role of `$DESI_SPECTRO_REDUX` and `ROOT/intermediate` of `$DESI_API_INTERMEDIATE`
+    :param release: Name of the synthetic release
+    :param healpix_rows: Number of rows in zall-pix
+    :param tile_rows: Number of rows in zall-tilecumulative
+    :param cluster_size: Number of targets (near CLUSTER_RA, CLUSTER_DEC) with healpix coadd and redrock files
+    :param n_tiles: Number of tiles with cumulative coadd and redrock files
+    :param fibers_per_petal: Fibers with spectra on each of petals 0 and 1 of those tiles
+    :param nwave: Wavelength bins per band in the generated spectra
+    :param seed: Seed for the random generator, so trees are reproducible
+    :returns: A SyntheticTree describing what was generated
+    """
+    rng = np.random.default_rng(seed)
+    tree = SyntheticTree(
+        root=root,
+        release=release,
+        healpix_rows=healpix_rows,
+        tile_rows=tile_rows,
+        cluster_ra=CLUSTER_RA,
+        cluster_dec=CLUSTER_DEC,
+        cluster_radius=60,
+    )
+    zcat_dir = f"{tree.redux}/{release}/zcatalog"
+    os.makedirs(zcat_dir, exist_ok=True)
+    os.makedirs(tree.intermediate, exist_ok=True)
+
+    # Healpix catalog: filler plus a cluster of spectra-backed, primary, main/dark targets
+    healpix = fill_zcat(rng, healpix_rows, tile=False)
+    cluster = healpix[:cluster_size]
+    offset = CLUSTER_RADIUS * np.sqrt(rng.uniform(0, 1, cluster_size))
+    angle = rng.uniform(0, 2 * np.pi, cluster_size)
+    cluster["TARGET_DEC"] = CLUSTER_DEC + offset * np.sin(angle)
+    cluster["TARGET_RA"] = CLUSTER_RA + offset * np.cos(angle) / np.cos(np.radians(CLUSTER_DEC))
+    cluster["HEALPIX"] = healpix_of(cluster["TARGET_RA"], cluster["TARGET_DEC"])
+    cluster["SURVEY"] = "main"
+    cluster["PROGRAM"] = rng.choice(["dark", "bright"], cluster_size)
+    cluster["ZCAT_PRIMARY"] = True
+    healpix = healpix[rng.permutation(healpix_rows)]
+    fitsio.write(f"{zcat_dir}/zall-pix-{release}.fits", healpix, extname="ZCATALOG", clobber=True)
+    write_healpix_files(tree, rng, cluster, nwave)
+    tree.target_ids = [int(t) for t in cluster["TARGETID"]]
+
+    # Tile catalog: filler plus rows for the tiles we write spectra for
+    tiles = fill_zcat(rng, tile_rows, tile=True)
+    backed = tiles[: n_tiles * 2 * fibers_per_petal]
+    tile_ids = 80000 + np.arange(n_tiles)
+    backed["TILEID"] = np.repeat(tile_ids, 2 * fibers_per_petal)
+    fibers = np.concatenate([np.arange(fibers_per_petal), 500 + np.arange(fibers_per_petal)])
+    backed["FIBER"] = np.tile(fibers, n_tiles)
+    backed["PETAL_LOC"] = backed["FIBER"] // 500
+    # Filler rows must not collide with the backed tiles
+    filler_tiles = tiles["TILEID"][len(backed) :]
+    filler_tiles[np.isin(filler_tiles, tile_ids)] += 10000
+    tiles = tiles[rng.permutation(tile_rows)]
+    fitsio.write(f"{zcat_dir}/zall-tilecumulative-{release}.fits", tiles, extname="ZCATALOG", clobber=True)
+    write_tile_files(tree, rng, backed, nwave)
+    tree.tiles = {int(t): [int(f) for f in fibers] for t in tile_ids}
+
+    tree.save()
+    return tree
+
+
+def synthetic_environment(tree: SyntheticTree) -> Dict[str, str]:
+    """Environment variables pointing the API at TREE. They must be set before `desiapi.common.models` is imported"""
+    return root_environment(tree.root, tree.release)
+
+
+def root_environment(root: str, release: str = SYNTHETIC_RELEASE) -> Dict[str, str]:
+    """Environment variables pointing the API at a tree that is, or will be, generated in ROOT"""
+    return {
+        "DESI_SPECTRO_REDUX": f"{root}/redux",
+        "DESI_API_INTERMEDIATE": f"{root}/intermediate",
+        "SPECPROD": release,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="desiapi.test.synthetic")
+    parser.add_argument("root", help="directory to create the synthetic tree in")
+    parser.add_argument("--release", default=SYNTHETIC_RELEASE)
+    parser.add_argument("--rows", type=int, default=500_000, help="rows in each zcatalog")
+    parser.add_argument("--nwave", type=int, default=500, help="wavelength bins per band")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    tree = make_synthetic_tree(
+        args.root,
+        args.release,
+        healpix_rows=args.rows,
+        tile_rows=args.rows,
+        nwave=args.nwave,
+        seed=args.seed,
+    )
+    for k, v in synthetic_environment(tree).items():
+        print(f"export {k}={v}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import json
+import threading
+
+import pytest
+
+from desiapi.common.errors import ServerBusyException
+from desiapi.web import admission
+from desiapi.web.admission import AdmissionClass, configure_admission
+
+
+@pytest.fixture
+def limits():
+    """Set the admission limits for one test, putting the defaults back afterwards"""
+    yield configure_admission
+    configure_admission(dict())
+
+
+def zcat_path(synthetic_tree) -> str:
+    return f"/api/v1/zcat/download/{synthetic_tree.release}/targets/{','.join(map(str, synthetic_tree.target_ids[:5]))}?filetype=json"
+
+
+def test_queue_full(client, synthetic_tree, limits):
+    limits({"zcat": {"max_concurrent": 1, "max_queued": 0, "queue_timeout": 5}})
+    with admission._classes["zcat"].admit():
+        response = client.get(zcat_path(synthetic_tree))
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert json.loads(response.data)["Retry-After"] == int(response.headers["Retry-After"])
+    assert admission.admission_status()["zcat"]["refused"] == 1
+    # Once the slot is free the same request goes through
+    assert client.get(zcat_path(synthetic_tree)).status_code == 200
+
+
+def test_queue_timeout(client, synthetic_tree, limits):
+    limits({"zcat": {"max_concurrent": 1, "max_queued": 1, "queue_timeout": 0.1}})
+    with admission._classes["zcat"].admit():
+        response = client.get(zcat_path(synthetic_tree))
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert admission.admission_status()["zcat"]["waiting"] == 0
+
+
+def test_classes_are_separate(client, synthetic_tree, limits):
+    limits({"spectra": {"max_concurrent": 1, "max_queued": 0, "queue_timeout": 5}})
+    with admission._classes["spectra"].admit():
+        assert client.get(zcat_path(synthetic_tree)).status_code == 200
+        spectra = client.get(f"/api/v1/spectra/download/{synthetic_tree.release}/targets/{synthetic_tree.target_ids[0]}")
+    assert spectra.status_code == 429
+
+
+def test_waiting_request_is_admitted():
+    limit = AdmissionClass("test", max_concurrent=1, max_queued=1, queue_timeout=5)
+    admitted = threading.Event()
+
+    def wait_for_slot():
+        with limit.admit():
+            admitted.set()
+
+    with limit.admit():
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        assert not admitted.wait(0.2)
+        assert limit.status()["waiting"] == 1
+    waiter.join(5)
+    assert admitted.is_set()
+    assert limit.status()["running"] == 0
+
+
+def test_retry_after_grows_with_queue():
+    limit = AdmissionClass("test", max_concurrent=2, max_queued=10, queue_timeout=5)
+    limit.average_duration = 10.0
+    assert limit.retry_after() == 5
+    limit.waiting = 5
+    assert limit.retry_after() == 30
+
+
+def test_refused_when_full():
+    limit = AdmissionClass("test", max_concurrent=2, max_queued=0, queue_timeout=5)
+    with limit.admit(), limit.admit():
+        with pytest.raises(ServerBusyException) as e:
+            with limit.admit():
+                pass
+    assert e.value.status == 429
+    assert e.value.retry_after >= 1
+    assert limit.status()["refused"] == 1
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import json
+from collections import Counter
+from urllib.parse import urlencode
+
+import numpy as np
+import pytest
+
+from desiapi.common import aggregate
+from desiapi.common.aggregate import handle_aggregate
+from desiapi.common.models import *
+
+# Aggregates must summarise exactly the rows the same zcat request returns
+
+AGGREGATES = {"group_by": "SURVEY,PROGRAM", "stats": "Z,TARGET_RA", "hist": "Z:0:4:8", "hist2d": "TARGET_RA:0:360:4,TARGET_DEC:-90:90:3"}
+COLUMNS = ["SURVEY", "PROGRAM", "Z", "TARGET_RA", "TARGET_DEC"]
+
+
+def endpoints(synthetic_tree) -> list:
+    tile, fibers = next(iter(synthetic_tree.tiles.items()))
+    ra, dec, radius = synthetic_tree.cluster_ra, synthetic_tree.cluster_dec, synthetic_tree.cluster_radius / 3600 * 3
+    return [
+        f"tile/{tile}/{','.join(map(str, fibers))}",
+        f"targets/{','.join(map(str, synthetic_tree.target_ids))}",
+        f"radec/{ra},{dec},{radius}",
+        "box/0,360,-90,90",
+    ]
+
+
+def zcat_rows(client, release: str, path: str, filters: dict) -> dict:
+    query = urlencode(dict(filters, filetype="json", **{column: "*" for column in COLUMNS if column not in filters}))
+    response = client.get(f"/api/v1/zcat/download/{release}/{path}?{query}")
+    assert response.status_code == 200
+    return {column: np.array([row[column] for row in response.json]) for column in COLUMNS}
+
+
+@pytest.mark.parametrize("filters", [{}, {"PROGRAM": "dark"}, {"Z": ">0.5"}])
+def test_aggregates_match_rows(client, synthetic_tree, filters):
+    for path in endpoints(synthetic_tree):
+        zcat = zcat_rows(client, synthetic_tree.release, path, filters)
+        response = client.get(f"/api/v1/aggregate/download/{synthetic_tree.release}/{path}?{urlencode(dict(filters, **AGGREGATES))}")
+        assert response.status_code == 200, path
+        result = json.loads(response.data)
+
+        assert result["count"] == len(zcat["Z"]), path
+        groups = {(group["SURVEY"], group["PROGRAM"]): group["count"] for group in result["groups"]}
+        assert groups == Counter(zip(zcat["SURVEY"].tolist(), zcat["PROGRAM"].tolist())), path
+
+        z = zcat["Z"][~np.isnan(zcat["Z"])]
+        if len(z):
+            assert result["stats"]["Z"]["min"] == z.min() and result["stats"]["Z"]["max"] == z.max(), path
+        assert result["stats"]["Z"]["count"] == len(z), path
+        assert result["histograms"]["Z"]["counts"] == np.histogram(z, 8, (0, 4))[0].tolist(), path
+        hist2d = np.histogram2d(zcat["TARGET_RA"], zcat["TARGET_DEC"], [4, 3], [[0, 360], [-90, 90]])[0]
+        assert result["hist2d"]["counts"] == hist2d.astype(int).tolist(), path
+
+
+def test_count_only(client, synthetic_tree):
+    response = client.get(f"/api/v1/aggregate/download/{synthetic_tree.release}/box/0,360,-90,90")
+    assert response.status_code == 200
+    result = json.loads(response.data)
+    zcat = zcat_rows(client, synthetic_tree.release, "box/0,360,-90,90", {})
+    assert result["count"] == len(zcat["Z"])
+    assert "groups" not in result and "stats" not in result
+
+
+def test_dense_and_sparse_groups(synthetic_tree, monkeypatch):
+    req = ApiRequest(
+        RequestedData.AGGREGATE, ResponseType.DOWNLOAD, synthetic_tree.release, Endpoint.BOX,
+        BoxParameters(0, 360, -90, 90), {"group_by": "ZCAT_PRIMARY,PROGRAM,SURVEY"},
+    )
+    dense = handle_aggregate(req)
+    monkeypatch.setattr(aggregate, "DENSE_GROUPS", 1)
+    assert handle_aggregate(req) == dense
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["stats=SURVEY", "hist=Z:1:0:3", "hist=Z:0:1", f"hist=Z:0:1:{MAX_HISTOGRAM_BINS + 1}", "hist2d=Z:0:1:3"],
+)
+def test_malformed_aggregates(client, synthetic_tree, query):
+    response = client.get(f"/api/v1/aggregate/download/{synthetic_tree.release}/box/0,360,-90,90?{query}")
+    assert response.status_code == 400
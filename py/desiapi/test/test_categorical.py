@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import numpy as np
+import pytest
+
+from desiapi.common.categorical import (
+    CODE_TYPE,
+    MAX_CATEGORIES,
+    CategoricalZcatalog,
+    CategoryEncoder,
+    decode_column,
+    encode_zcatalog,
+)
+
+ZCAT_DTYPE = np.dtype([("TARGETID", "i8"), ("SURVEY", "U7"), ("PROGRAM", "U6"), ("Z", "f8")])
+
+
+def zcatalog(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    data = np.empty(n, dtype=ZCAT_DTYPE)
+    data["TARGETID"] = np.arange(n)
+    data["SURVEY"] = rng.choice(["main", "sv1", "sv3", "special"], size=n)
+    data["PROGRAM"] = rng.choice(["dark", "bright", "backup"], size=n)
+    data["Z"] = rng.random(n)
+    return data
+
+
+def test_round_trip_in_blocks():
+    # Blocks that see the values in different orders must still share one set of codes
+    data = zcatalog(1000)
+    encoder = CategoryEncoder(data.dtype)
+    assert encoder.columns == ["SURVEY", "PROGRAM"]
+    assert encoder.dtype["SURVEY"] == CODE_TYPE
+    encoded = np.concatenate([encoder.encode(data[start : start + 77]) for start in range(0, len(data), 77)])
+    decoded = CategoricalZcatalog(encoded, encoder.categories())[:]
+    assert decoded.dtype == data.dtype
+    np.testing.assert_array_equal(decoded, data)
+
+
+def test_columns_and_rows():
+    data = zcatalog(100)
+    zcat = encode_zcatalog(data)
+    assert isinstance(zcat, CategoricalZcatalog)
+    # Columns come back as codes, rows decoded
+    assert zcat["SURVEY"].dtype == CODE_TYPE
+    np.testing.assert_array_equal(zcat.decode("SURVEY"), data["SURVEY"])
+    np.testing.assert_array_equal(decode_column(zcat["PROGRAM"], zcat.categories["PROGRAM"]), data["PROGRAM"])
+    rows = [5, 3, 99]
+    np.testing.assert_array_equal(zcat[rows], data[rows])
+    np.testing.assert_array_equal(zcat.encoded(rows)[:], data[rows])
+    np.testing.assert_array_equal(zcat.select(["TARGETID", "SURVEY"])[rows], data[["TARGETID", "SURVEY"]][rows])
+
+
+def test_code_for():
+    zcat = encode_zcatalog(zcatalog(100))
+    code = zcat.code_for("SURVEY", "sv3")
+    assert (zcat["SURVEY"] == code).sum() == (zcat.decode("SURVEY") == "sv3").sum()
+    assert zcat.code_for("SURVEY", "cmx") is None
+
+
+def test_nothing_to_encode():
+    data = zcatalog(10)[["TARGETID", "Z"]]
+    assert encode_zcatalog(data) is data
+
+
+def test_too_many_categories():
+    data = np.empty(MAX_CATEGORIES + 1, dtype=ZCAT_DTYPE)
+    data["SURVEY"] = [f"s{i}" for i in range(len(data))]
+    data["PROGRAM"] = "dark"
+    with pytest.raises(ValueError):
+        CategoryEncoder(data.dtype).encode(data)
+
+
+def test_responses_are_decoded(client, synthetic_tree):
+    target_ids = ",".join(map(str, synthetic_tree.target_ids[:10]))
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/targets/{target_ids}?filetype=json")
+    assert response.status_code == 200
+    for row in response.json:
+        assert isinstance(row["SURVEY"], str) and isinstance(row["PROGRAM"], str)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+import io
+import json
+
+import pytest
+from astropy.table import Table
+
+
+def radec_path(synthetic_tree, filetype: str = "json") -> str:
+    ra, dec, radius = synthetic_tree.cluster_ra, synthetic_tree.cluster_dec, synthetic_tree.cluster_radius / 3600
+    return f"/api/v1/zcat/download/{synthetic_tree.release}/radec/{ra},{dec},{radius}?filetype={filetype}"
+
+
+@pytest.mark.parametrize(
+    "query,columns",
+    [
+        ("&columns=TARGETID,Z", {"TARGETID", "Z"}),
+        ("&columns=TARGETID&Z=>0.5", {"TARGETID", "Z"}),
+        ("&columns=TARGETID&ZWARN=0&Z=>0.5|SPECTYPE:QSO", {"TARGETID", "ZWARN", "Z", "SPECTYPE"}),
+    ],
+)
+def test_projected_columns(client, synthetic_tree, query, columns):
+    path = radec_path(synthetic_tree)
+    response = client.get(path + query)
+    assert response.status_code == 200, response.data
+    rows = response.json
+    assert rows
+    assert all(set(row) == columns for row in rows)
+
+
+def test_projection_keeps_rows(client, synthetic_tree):
+    path = radec_path(synthetic_tree)
+    whole = client.get(path + "&Z=*").json
+    projected = client.get(path + "&columns=TARGETID,Z").json
+    assert projected == [{"TARGETID": row["TARGETID"], "Z": row["Z"]} for row in whole]
+
+
+def test_projected_fits(client, synthetic_tree):
+    response = client.get(radec_path(synthetic_tree, "fits") + "&columns=TARGETID,Z&SPECTYPE=GALAXY")
+    assert response.status_code == 200
+    table = Table.read(io.BytesIO(response.data))
+    assert set(table.colnames) == {"TARGETID", "Z", "SPECTYPE"}
+    assert len(table) and all(s.strip() == "GALAXY" for s in table["SPECTYPE"])
+
+
+def test_empty_columns(client, synthetic_tree):
+    response = client.get(radec_path(synthetic_tree) + "&columns=")
+    assert response.status_code == 400
+    assert "columns" in json.loads(response.data)["Error"]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import fitsio
+import numpy as np
+import pytest
+
+from desiapi.common.models import HDF5_INDEX_COLUMNS
+from desiapi.convert.hdf5 import Hdf5Writer, Hdf5Zcatalog
+from desiapi.convert.memmap import MemmapWriter, read_memmap
+from desiapi.convert.stream import ZCATALOG_HDU, fits_chunks, fits_layout
+
+# Conversions read the FITS a block of rows at a time. A block size that doesn't divide the catalog checks that the
+# blocks, and the HDF5 index runs sorted a block at a time, fit back together into the same catalog as one read
+
+CHUNK_ROWS = 3001
+
+
+def convert(fits_file: str, writer_type, *outputs, chunk_rows: int = CHUNK_ROWS):
+    nrows, dtype = fits_layout(fits_file)
+    extra = (chunk_rows,) if writer_type is Hdf5Writer else ()
+    with writer_type(*outputs, dtype, nrows, *extra) as writer:
+        for start, chunk in fits_chunks(fits_file, chunk_rows):
+            writer.write(start, chunk)
+
+
+def assert_same_column(converted, expected, column):
+    if expected.dtype.kind in "SU":
+        np.testing.assert_array_equal(np.char.strip(np.asarray(converted, dtype=str)), np.char.strip(expected.astype(str)))
+    else:
+        np.testing.assert_array_equal(converted, expected, err_msg=column)
+
+
+@pytest.fixture(params=["tile", "healpix"])
+def fits_file(request, release) -> str:
+    return release.tile_fits if request.param == "tile" else release.healpix_fits
+
+
+def test_chunks_cover_the_table(fits_file):
+    expected = fitsio.read(fits_file, ext=ZCATALOG_HDU)
+    starts, chunks = zip(*fits_chunks(fits_file, CHUNK_ROWS))
+    assert list(starts) == list(range(0, len(expected), CHUNK_ROWS))
+    np.testing.assert_array_equal(np.concatenate(chunks), expected)
+
+
+def test_memmap_matches_fits(fits_file, tmp_path):
+    convert(fits_file, MemmapWriter, str(tmp_path / "zcat.npy"), str(tmp_path / "zcat.dtype"))
+    expected = fitsio.read(fits_file, ext=ZCATALOG_HDU)
+    converted = read_memmap(str(tmp_path / "zcat.npy"), str(tmp_path / "zcat.dtype"))
+    assert len(converted) == len(expected)
+    rows = converted[:]
+    for column in expected.dtype.names:
+        assert_same_column(rows[column], expected[column], column)
+
+
+def test_hdf5_matches_fits(fits_file, tmp_path):
+    outfile = str(tmp_path / "zcat.h5")
+    convert(fits_file, Hdf5Writer, outfile)
+    expected = fitsio.read(fits_file, ext=ZCATALOG_HDU)
+    converted = Hdf5Zcatalog(outfile, list(expected.dtype.names))
+    assert len(converted) == len(expected)
+    rows = converted[np.arange(len(expected))]
+    for column in expected.dtype.names:
+        assert_same_column(rows[column], expected[column], column)
+
+
+def test_hdf5_index_matches_fits(fits_file, tmp_path):
+    outfile = str(tmp_path / "zcat.h5")
+    convert(fits_file, Hdf5Writer, outfile, chunk_rows=997)
+    expected = fitsio.read(fits_file, ext=ZCATALOG_HDU)
+    converted = Hdf5Zcatalog(outfile, list(expected.dtype.names))
+    rng = np.random.default_rng(0)
+    for column in HDF5_INDEX_COLUMNS:
+        if column not in expected.dtype.names:
+            continue
+        values = list(rng.choice(np.unique(expected[column]), size=20, replace=False)) + [-1]
+        rows = converted.lookup(column, values)
+        np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(np.isin(expected[column], values)), err_msg=column)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import json
+
+import pytest
+
+from desiapi.common.cost import configure_cost_limits
+from desiapi.common.models import COST_LIMITS
+
+
+@pytest.fixture
+def cost_limits():
+    """Set the server's cost limits for one test, removing them afterwards"""
+    yield configure_cost_limits
+    configure_cost_limits(None)
+
+
+def plan(client, path: str) -> dict:
+    response = client.get(f"{path}{'&' if '?' in path else '?'}plan=1")
+    assert response.status_code == 200, response.data
+    return json.loads(response.data)
+
+
+def targets_path(synthetic_tree, data: str, target_ids) -> str:
+    return f"/api/v1/{data}/download/{synthetic_tree.release}/targets/{','.join(map(str, target_ids))}"
+
+
+def test_zcat_plan(client, synthetic_tree, release):
+    ra, dec, radius = synthetic_tree.cluster_ra, synthetic_tree.cluster_dec, synthetic_tree.cluster_radius / 3600
+    path = f"/api/v1/zcat/download/{synthetic_tree.release}/radec/{ra},{dec},{radius}?filetype=json"
+    rows = client.get(path).json
+    planned = plan(client, path)
+    assert planned["release"] == release.name and planned["release_version"] == release.version
+    assert planned["endpoint"] == "radec"
+    assert planned["cost"]["rows"] == len(rows)
+    assert planned["limits"] is None and planned["within_limits"]
+
+    paged = plan(client, path + "&limit=5")
+    assert paged["cost"]["rows"] == len(rows)
+    assert paged["cost"]["bytes_returned"] == planned["cost"]["bytes_returned"] * 5 // len(rows)
+
+
+def test_spectra_plan(client, synthetic_tree, cost_limits):
+    cost_limits(COST_LIMITS)
+    target_ids = synthetic_tree.target_ids[:3]
+    path = targets_path(synthetic_tree, "spectra", target_ids)
+    cold = plan(client, path)
+    assert cold["cost"]["spectra"] == len(target_ids)
+    assert cold["cost"]["cached_spectra"] == 0
+    assert cold["cost"]["coadd_files"] >= 1 and cold["cost"]["missing_files"] == 0
+    assert cold["limits"] == COST_LIMITS and cold["within_limits"]
+
+    # Planning reads no spectra, fetching them caches them, after which they cost no coadd reads
+    assert plan(client, path)["cost"]["cached_spectra"] == 0
+    assert client.get(path).status_code == 200
+    warm = plan(client, path)
+    assert warm["cost"]["cached_spectra"] == len(target_ids)
+    assert warm["cost"]["coadd_files"] == 0
+    assert warm["cost"]["bytes_read"] < cold["cost"]["bytes_read"]
+
+
+def test_tile_plan(client, synthetic_tree):
+    tile = list(synthetic_tree.tiles)[0]
+    planned = plan(client, f"/api/v1/spectra/download/{synthetic_tree.release}/tile/{tile}/1,2,3,600")
+    # Fibers 1-3 are on petal 0, fiber 600 on petal 1
+    assert planned["cost"]["spectra"] == 4
+    assert planned["cost"]["coadd_files"] == 2 and planned["cost"]["redrock_files"] == 2
+
+
+def test_over_cost_limit(client, synthetic_tree, cost_limits):
+    cost_limits({"spectra": 2, "files": 1000, "bytes_read": 10**12})
+    tile = list(synthetic_tree.tiles)[0]
+    path = f"/api/v1/spectra/download/{synthetic_tree.release}/tile/{tile}/1,2,3,600"
+    planned = plan(client, path)
+    assert not planned["within_limits"]
+    response = client.get(path)
+    assert response.status_code == 413
+    body = json.loads(response.data)
+    assert "request is too large: 4 spectra (at most 2)" in body["Error"]
+    assert body["Cost"] == planned["cost"]
+    assert body["Limits"] == planned["limits"]
+
+    assert client.get(f"/api/v1/spectra/download/{synthetic_tree.release}/tile/{tile}/1,600").status_code == 200
+    # Zcat requests aren't limited by cost
+    assert client.get(targets_path(synthetic_tree, "zcat", synthetic_tree.target_ids)).status_code == 200
+
+
+def test_files_limit(client, synthetic_tree, cost_limits):
+    cost_limits({"files": 1})
+    response = client.get(targets_path(synthetic_tree, "spectra", synthetic_tree.target_ids[:3]))
+    assert response.status_code == 413
+    assert "files (at most 1)" in json.loads(response.data)["Error"]
+
+
+def test_downloads_bounded_by_cost(client, synthetic_tree, cost_limits):
+    # Spectra downloads aren't limited by the number of IDs they list, only by what they select
+    cost_limits(COST_LIMITS)
+    response = client.get(f"/api/v1/spectra/download/{synthetic_tree.release}/box/0,360,-90,90")
+    assert response.status_code == 413
+    body = json.loads(response.data)
+    assert body["Cost"]["spectra"] > COST_LIMITS["spectra"]
+    assert f"(at most {COST_LIMITS['spectra']})" in body["Error"]
+
+
+def test_xmatch_plan(client, synthetic_tree):
+    response = client.post(
+        f"/api/v1/xmatch/download/{synthetic_tree.release}?radius=0.01&plan=1",
+        data=f"{synthetic_tree.cluster_ra},{synthetic_tree.cluster_dec}",
+    )
+    assert response.status_code == 400
+    assert "can't be planned" in json.loads(response.data)["Error"]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import json
+import os
+
+import numpy as np
+import pytest
+
+from desiapi.common.build_spectra import handle_spectra
+from desiapi.common.models import *
+from desiapi.python.api import write_cache_file
+from desiapi.python.decode import spectra_from_bytes, zcat_from_bytes
+
+
+@pytest.fixture
+def spectra(synthetic_tree):
+    params = TargetParameters(synthetic_tree.target_ids[:4])
+    req = ApiRequest(RequestedData.SPECTRA, ResponseType.DOWNLOAD, synthetic_tree.release, Endpoint.TARGETS, params, dict())
+    return handle_spectra(req)
+
+
+def assert_same_table(a, b):
+    if a is None or b is None:
+        assert a is None and b is None
+        return
+    assert a.colnames == b.colnames
+    for column in a.colnames:
+        assert a[column].dtype == b[column].dtype, column
+        np.testing.assert_array_equal(a[column], b[column], err_msg=column)
+    assert dict(a.meta) == dict(b.meta)
+
+
+def assert_same_spectra(a, b):
+    assert a.bands == b.bands
+    for attribute in ["wave", "flux", "ivar", "mask", "resolution_data", "model"]:
+        a_values, b_values = getattr(a, attribute), getattr(b, attribute)
+        if a_values is None or b_values is None:
+            assert a_values is None and b_values is None, attribute
+            continue
+        for band in a.bands:
+            assert a_values[band].dtype == b_values[band].dtype, attribute
+            np.testing.assert_array_equal(a_values[band], b_values[band], err_msg=attribute)
+    assert (a.extra is None) == (b.extra is None)
+    for band, extra in (a.extra or dict()).items():
+        assert extra.keys() == b.extra[band].keys()
+        for kind, values in extra.items():
+            np.testing.assert_array_equal(values, b.extra[band][kind])
+    for table in ["fibermap", "exp_fibermap", "scores", "extra_catalog", "redshifts"]:
+        assert_same_table(getattr(a, table), getattr(b, table))
+    assert dict(a.meta) == dict(b.meta)
+
+
+def test_spectra_from_bytes(spectra, tmp_path):
+    import desispec.io
+
+    path = str(tmp_path / "response.spectra.fits")
+    desispec.io.write_spectra(path, spectra)
+    with open(path, "rb") as f:
+        decoded = spectra_from_bytes(f.read())
+    assert_same_spectra(decoded, desispec.io.read_spectra(path))
+
+
+def test_models_and_redshifts_ignored(spectra, tmp_path):
+    # read_spectra only reads the *_MODEL and REDSHIFTS HDUs when asked to, neither do we
+    import desispec.io
+    from astropy.table import Table
+
+    spectra.model = {band: np.ones_like(spectra.flux[band]) for band in spectra.bands}
+    spectra.redshifts = Table({"TARGETID": spectra.fibermap["TARGETID"], "Z": np.zeros(spectra.num_spectra())})
+    spectra.extra = {band: {"SKY": np.full_like(spectra.flux[band], 2.0)} for band in spectra.bands}
+    path = str(tmp_path / "response.spectra.fits")
+    desispec.io.write_spectra(path, spectra)
+    with open(path, "rb") as f:
+        decoded = spectra_from_bytes(f.read())
+    expected = desispec.io.read_spectra(path)
+    assert decoded.model is None and decoded.redshifts is None
+    assert set(decoded.extra[spectra.bands[0]]) == {"SKY"}
+    assert_same_spectra(decoded, expected)
+
+
+def test_zcat_from_bytes():
+    rows = [{"TARGETID": 39627000000000001, "Z": 0.5}, {"TARGETID": 2, "Z": 1.5}]
+    table = zcat_from_bytes(json.dumps(rows).encode(), "json")
+    assert list(table["TARGETID"]) == [39627000000000001, 2]
+    assert len(zcat_from_bytes(b"[]", "json")) == 0
+
+
+def test_write_cache_file(tmp_path):
+    import datetime
+
+    req = ApiRequest(RequestedData.ZCAT, ResponseType.DOWNLOAD, "synth", Endpoint.TARGETS, TargetParameters([1, 2]), {"filetype": "json"})
+    path = write_cache_file(str(tmp_path), req, datetime.datetime(2026, 1, 1), b"[]")
+    with open(path, "rb") as f:
+        assert f.read() == b"[]"
+    # Nothing but the finished file is left behind
+    assert [name for _, _, names in os.walk(tmp_path) for name in names] == [os.path.basename(path)]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import numpy as np
+import pytest
+
+from desiapi.common.categorical import encode_zcatalog
+from desiapi.common.errors import MalformedRequestException
+from desiapi.common.filters import compile_filters, filter_columns, parse_filter
+from desiapi.convert.hdf5 import Hdf5Writer, Hdf5Zcatalog
+
+ZCAT_DTYPE = np.dtype(
+    [("TARGETID", "i8"), ("TILEID", "i4"), ("SURVEY", "U7"), ("SPECTYPE", "U6"), ("Z", "f8"), ("ZWARN", "i8"), ("ZCAT_PRIMARY", "?")]
+)
+
+
+@pytest.fixture(scope="module")
+def zcat() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    n = 5000
+    data = np.empty(n, dtype=ZCAT_DTYPE)
+    data["TARGETID"] = rng.permutation(n) + 39627000000000000  # Too big to survive a round trip through float
+    data["TILEID"] = rng.integers(1000, 1020, n)
+    data["SURVEY"] = rng.choice(["main", "sv1", "sv3"], n)
+    data["SPECTYPE"] = rng.choice(["GALAXY", "QSO", "STAR"], n)
+    data["Z"] = rng.uniform(0, 4, n)
+    data["ZWARN"] = rng.choice([0, 4, 1024], n)
+    data["ZCAT_PRIMARY"] = rng.random(n) < 0.9
+    return data
+
+
+# Each filter and the mask it should give
+CASES = [
+    ({"Z": "*"}, lambda z: np.ones(len(z), dtype=bool)),
+    ({"SURVEY": "main"}, lambda z: z["SURVEY"] == "main"),
+    ({"survey": "=main,sv3"}, lambda z: np.isin(z["SURVEY"], ["main", "sv3"])),
+    ({"SURVEY": "!=main,sv3"}, lambda z: ~np.isin(z["SURVEY"], ["main", "sv3"])),
+    ({"SURVEY": "=cmx"}, lambda z: np.zeros(len(z), dtype=bool)),
+    ({"ZWARN": "!=0"}, lambda z: z["ZWARN"] != 0),
+    ({"Z": ">2"}, lambda z: z["Z"] > 2),
+    ({"Z": "<0.5"}, lambda z: z["Z"] < 0.5),
+    ({"Z": ">=1.5"}, lambda z: z["Z"] >= 1.5),
+    ({"Z": "<=1.5"}, lambda z: z["Z"] <= 1.5),
+    ({"Z": "1..2"}, lambda z: (z["Z"] >= 1) & (z["Z"] <= 2)),
+    ({"Z": "3.."}, lambda z: z["Z"] >= 3),
+    ({"Z": "..0.1"}, lambda z: z["Z"] <= 0.1),
+    ({"TILEID": "1003..1005"}, lambda z: (z["TILEID"] >= 1003) & (z["TILEID"] <= 1005)),
+    ({"Z": "<0.1|>3.9"}, lambda z: (z["Z"] < 0.1) | (z["Z"] > 3.9)),
+    ({"Z": ">2|SPECTYPE:QSO"}, lambda z: (z["Z"] > 2) | (z["SPECTYPE"] == "QSO")),
+    ({"SPECTYPE": "STAR|survey:=sv1,sv3|Z:..0.2"}, lambda z: (z["SPECTYPE"] == "STAR") | np.isin(z["SURVEY"], ["sv1", "sv3"]) | (z["Z"] <= 0.2)),
+    ({"ZCAT_PRIMARY": "true"}, lambda z: z["ZCAT_PRIMARY"]),
+    ({"ZCAT_PRIMARY": "0"}, lambda z: ~z["ZCAT_PRIMARY"]),
+    ({"SURVEY": "main", "Z": "1..2", "ZWARN": "0"}, lambda z: (z["SURVEY"] == "main") & (z["Z"] >= 1) & (z["Z"] <= 2) & (z["ZWARN"] == 0)),
+    ({"filetype": "json", "SURVEY": "sv1"}, lambda z: z["SURVEY"] == "sv1"),
+]
+
+
+@pytest.mark.parametrize("filters,expected", CASES)
+def test_filters_match_numpy(zcat, filters, expected):
+    predicate = compile_filters(filters)
+    mask = expected(zcat)
+    np.testing.assert_array_equal(predicate.evaluate(zcat), mask)
+    # Encoded columns are compared by code
+    np.testing.assert_array_equal(predicate.evaluate(encode_zcatalog(zcat)), mask)
+
+
+def test_large_ids(zcat):
+    target_ids = zcat["TARGETID"][[0, 17]]
+    predicate = compile_filters({"TARGETID": ",".join(map(str, target_ids))})
+    np.testing.assert_array_equal(np.flatnonzero(predicate.evaluate(zcat)), np.sort([0, 17]))
+    # One more than a real ID, which would compare equal to it as a float
+    predicate = compile_filters({"TARGETID": str(target_ids[0] + 1)})
+    assert np.count_nonzero(predicate.evaluate(zcat)) == np.count_nonzero(zcat["TARGETID"] == target_ids[0] + 1)
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [{"TARGETID": "=1,2,3"}, {"TARGETID": "!=1"}, {"TILEID": "1003..1005"}, {"TILEID": ">=1010|TARGETID:39627000000000007"}, {"TILEID": "..1001"}],
+)
+def test_index_rows_match_evaluate(zcat, tmp_path, filters):
+    outfile = str(tmp_path / "zcat.h5")
+    with Hdf5Writer(outfile, zcat.dtype, len(zcat), 1000) as writer:
+        writer.write(0, zcat)
+    hdf5 = Hdf5Zcatalog(outfile, list(zcat.dtype.names))
+    predicate = parse_filter(*next(iter(filters.items())))
+    rows = predicate.index_rows(hdf5)
+    if filters.get("TARGETID", "").startswith("!="):
+        assert rows is None  # Negations can't be answered from an index
+        return
+    np.testing.assert_array_equal(rows, np.flatnonzero(predicate.evaluate(zcat)))
+
+
+def test_filter_columns():
+    assert filter_columns({"z": ">2|SPECTYPE:QSO", "survey": "main", "limit": "10"}) == ["SPECTYPE", "SURVEY", "Z"]
+    assert compile_filters({"filetype": "fits"}) is None
+
+
+def test_parsed_once():
+    assert parse_filter("Z", "1..2") is parse_filter("Z", "1..2")
+
+
+@pytest.mark.parametrize("filters", [{"Z": ">high"}, {"ZCAT_PRIMARY": "maybe"}, {"TILEID": "a..b"}])
+def test_malformed_values(zcat, filters):
+    with pytest.raises(MalformedRequestException):
+        compile_filters(filters).evaluate(zcat)
+
+
+def test_filtered_response(client, synthetic_tree):
+    target_ids = ",".join(map(str, synthetic_tree.target_ids))
+    path = f"/api/v1/zcat/download/{synthetic_tree.release}/targets/{target_ids}?filetype=json"
+    everything = client.get(path + "&Z=*&SURVEY=*").json
+    filtered = client.get(path + "&Z=..0.5|SURVEY:sv1").json
+    expected = [row for row in everything if row["Z"] <= 0.5 or row["SURVEY"] == "sv1"]
+    assert 0 < len(filtered) < len(everything)
+    assert [row["TARGETID"] for row in filtered] == [row["TARGETID"] for row in expected]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import numpy as np
+
+from desiapi.common.build_spectra import get_target_zcatalog
+from desiapi.common.fragments import FRAGMENT_CACHE, assemble_fragments, fragment_key, read_target_spectra, split_spectra
+
+
+def assert_same_spectra(a, b):
+    assert list(a.fibermap["TARGETID"]) == list(b.fibermap["TARGETID"])
+    assert a.bands == b.bands
+    for band in a.bands:
+        np.testing.assert_array_equal(a.wave[band], b.wave[band])
+        np.testing.assert_array_equal(a.flux[band], b.flux[band])
+        np.testing.assert_array_equal(a.ivar[band], b.ivar[band])
+        np.testing.assert_array_equal(a.mask[band], b.mask[band])
+        np.testing.assert_array_equal(a.resolution_data[band], b.resolution_data[band])
+
+
+def test_split_and_assemble(release, synthetic_tree):
+    FRAGMENT_CACHE.clear()
+    targets = get_target_zcatalog(release, synthetic_tree.target_ids[:10], dict())
+    spectra = read_target_spectra(release, targets)
+    assert_same_spectra(assemble_fragments(split_spectra(spectra)), spectra)
+
+
+def test_partly_cached(release, synthetic_tree):
+    targets = get_target_zcatalog(release, synthetic_tree.target_ids[:20], dict())
+    FRAGMENT_CACHE.clear()
+    cold = read_target_spectra(release, targets)
+
+    # Cache every other target, then ask for all of them: the cached half comes from the cache
+    FRAGMENT_CACHE.clear()
+    read_target_spectra(release, targets[::2])
+    hits = FRAGMENT_CACHE.stats()["hits"]
+    mixed = read_target_spectra(release, targets)
+    assert FRAGMENT_CACHE.stats()["hits"] - hits == len(targets[::2])
+    assert_same_spectra(mixed, cold)
+
+    # Now all of them are cached
+    hits = FRAGMENT_CACHE.stats()["hits"]
+    warm = read_target_spectra(release, targets[::-1])
+    assert FRAGMENT_CACHE.stats()["hits"] - hits == len(targets)
+    assert list(warm.fibermap["TARGETID"]) == list(cold.fibermap["TARGETID"])[::-1]
+
+
+def test_cache_bounded():
+    from desiapi.common.fragments import FragmentCache
+
+    class Fragment:
+        nbytes = 100
+
+    cache = FragmentCache(max_bytes=250)
+    for i in range(3):
+        cache.put(("synth", "v", i), Fragment())
+    assert cache.get(("synth", "v", 0)) is None
+    assert cache.get(("synth", "v", 2)) is not None
+    assert cache.stats()["bytes"] == 200
+
+
+def test_survives_intermediate_rebuild(release, synthetic_tree):
+    # Rebuilding the memmap or HDF5 files changes the release's version, but not the coadds the fragments came from
+    import copy
+
+    targets = get_target_zcatalog(release, synthetic_tree.target_ids[:5], dict())
+    FRAGMENT_CACHE.clear()
+    read_target_spectra(release, targets)
+    rebuilt = copy.copy(release)
+    rebuilt.version = "rebuilt"
+    hits = FRAGMENT_CACHE.stats()["hits"]
+    read_target_spectra(rebuilt, targets)
+    assert FRAGMENT_CACHE.stats()["hits"] - hits == len(targets)
+
+    refitted = copy.copy(release)
+    refitted.fits_version = "refitted"
+    assert all(fragment_key(refitted, t) not in FRAGMENT_CACHE for t in targets["TARGETID"])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import json
+import os
+import subprocess
+import sys
+
+# Importing any of these takes around a second, so they should only be imported when a request actually needs them
+HEAVY_MODULES = [
+    "prospect.viewer",
+    "desispec.io",
+    "desispec.spectra",
+    "astropy.coordinates",
+    "astropy.table",
+    "numpyencoder",
+]
+IMPORT_BUDGET = 1.0  # seconds
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    """Import MODULE in a fresh interpreter, and report how long it took and which heavy modules it pulled in"""
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.run(
+        [sys.executable, "-c", MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    print(module, result)
+    return result
+
+
+def test_cli_import():
+    result = measure_import("desiapi.web.cli")
+    assert result["heavy"] == []
+    assert result["seconds"] < IMPORT_BUDGET
+
+
+def test_server_import():
+    result = measure_import("desiapi.web.server")
+    assert result["heavy"] == []
+    assert result["seconds"] < IMPORT_BUDGET
+
+
+def test_python_api_import():
+    result = measure_import("desiapi.python.api")
+    assert result["heavy"] == []
+    assert result["seconds"] < IMPORT_BUDGET
+
+
+if __name__ == "__main__":
+    test_cli_import()
+    test_server_import()
+    test_python_api_import()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import json
+
+from desiapi.common.paging import encode_cursor, query_key
+from desiapi.web.server import build_request
+
+
+def error(response) -> str:
+    return json.loads(response.data)["Error"]
+
+
+def zcat_path(synthetic_tree, target_ids) -> str:
+    return f"/api/v1/zcat/download/{synthetic_tree.release}/targets/{','.join(map(str, target_ids))}?filetype=json"
+
+
+def test_pages_make_up_the_whole(client, synthetic_tree):
+    path = zcat_path(synthetic_tree, synthetic_tree.target_ids[:12])
+    whole = client.get(path)
+    assert whole.status_code == 200
+    assert "X-Next-Cursor" not in whole.headers
+
+    rows, pages, cursor = [], 0, None
+    while True:
+        response = client.get(path + "&limit=5" + (f"&cursor={cursor}" if cursor else ""))
+        assert response.status_code == 200
+        assert response.headers["X-Total-Count"] == str(len(whole.json))
+        assert len(response.json) <= 5
+        rows += response.json
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert pages == 3
+    assert rows == whole.json
+
+
+def test_last_page_has_no_cursor(client, synthetic_tree):
+    response = client.get(zcat_path(synthetic_tree, synthetic_tree.target_ids[:3]) + "&limit=3")
+    assert response.status_code == 200
+    assert len(response.json) == 3
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_cursor_from_another_query(client, synthetic_tree):
+    first = client.get(zcat_path(synthetic_tree, synthetic_tree.target_ids[:12]) + "&limit=5")
+    cursor = first.headers["X-Next-Cursor"]
+    response = client.get(zcat_path(synthetic_tree, synthetic_tree.target_ids[:11]) + f"&limit=5&cursor={cursor}")
+    assert response.status_code == 400
+    assert "does not belong to this query" in error(response)
+
+
+def test_stale_cursor(client, synthetic_tree, release):
+    # A cursor issued for an older version of the release points at rows that no longer mean anything
+    target_ids = synthetic_tree.target_ids[:12]
+    req = build_request("zcat", "download", synthetic_tree.release, "targets", ",".join(map(str, target_ids)), dict())
+    key = query_key(req, release)
+    assert f"-{release.version}-" in key
+    stale = encode_cursor(key.replace(f"-{release.version}-", "-0-"), 5)
+    response = client.get(zcat_path(synthetic_tree, target_ids) + f"&limit=5&cursor={stale}")
+    assert response.status_code == 400
+    assert "does not belong to this query" in error(response)
+
+
+def test_invalid_paging_parameters(client, synthetic_tree):
+    path = zcat_path(synthetic_tree, synthetic_tree.target_ids[:12])
+    for query, message in {
+        "&cursor=garbage": "invalid cursor",
+        "&limit=0": "limit must be between",
+        "&limit=many": "limit must be an integer",
+    }.items():
+        response = client.get(path + query)
+        assert response.status_code == 400, query
+        assert message in error(response), query
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from desiapi.common import preload
+from desiapi.common.models import RELEASES, get_release
+from desiapi.common.preload import get_preloaded, preload_release, preload_status
+
+RELOAD_TIMEOUT = 60  # Seconds to wait for a background reload
+
+
+def wait_for_reload(name: str, fits_version: str):
+    """Wait for the background reload of release NAME to finish reading FITS_VERSION"""
+    deadline = time.monotonic() + RELOAD_TIMEOUT
+    while time.monotonic() < deadline:
+        status = preload_status()[name]
+        if status["state"] == "ready" and status["version"] == fits_version:
+            return
+        assert status["state"] != "failed", status["error"]
+        time.sleep(0.1)
+    pytest.fail(f"{name} wasn't reloaded within {RELOAD_TIMEOUT} seconds")
+
+
+def join_reloads():
+    for thread in threading.enumerate():
+        if thread.name == "desiapi-reload":
+            thread.join(RELOAD_TIMEOUT)
+
+
+@pytest.fixture
+def preloaded(synthetic_tree):
+    """Preload the synthetic release for one test, putting its FITS files and the preload back as they were afterwards"""
+    release = get_release(synthetic_tree.release)
+    files = [release.healpix_fits, release.tile_fits]
+    times = {f: (os.stat(f).st_atime_ns, os.stat(f).st_mtime_ns) for f in files}
+    preload_release(release.name)
+    yield release
+    join_reloads()
+    with preload._lock:
+        preload._progress.pop(release.name, None)
+        for f in preload._release_files.pop(release.name, []):
+            preload._preloaded.pop(f, None)
+            preload._unit_vectors.pop(f, None)
+    for f, ns in times.items():
+        os.utime(f, ns=ns)
+    RELEASES.refresh()
+
+
+def test_hot_reload(client, synthetic_tree, preloaded):
+    old = preloaded
+    assert preload_status()[old.name]["state"] == "ready"
+    assert get_preloaded(old.healpix_fits, old.fits_version) is not None
+
+    target_ids = synthetic_tree.target_ids[:12]
+    zcat_path = f"/api/v1/zcat/download/{old.name}/targets/{','.join(map(str, target_ids))}?filetype=json&limit=5"
+    cursor = client.get(zcat_path).headers["X-Next-Cursor"]
+    spectra_path = f"/api/v1/spectra/download/{old.name}/targets/{','.join(map(str, target_ids[:3]))}"
+    assert client.get(spectra_path).status_code == 200
+    assert json.loads(client.get(spectra_path + "?plan=1").data)["cost"]["cached_spectra"] == 3
+
+    # A new zcatalog is written, and the server told to look for it
+    stat = os.stat(old.healpix_fits)
+    os.utime(old.healpix_fits, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    response = client.post("/api/v1/releases/reload")
+    assert response.status_code == 200
+    assert old.name in response.json["releases"]
+
+    new = get_release(old.name)
+    assert new.version != old.version and new.fits_version != old.fits_version
+    wait_for_reload(new.name, new.fits_version)
+    assert get_preloaded(new.healpix_fits, new.fits_version) is not None
+    assert get_preloaded(new.healpix_fits, old.fits_version) is None
+
+    # Cursors and fragments from the old version are no longer used
+    response = client.get(zcat_path + f"&cursor={cursor}")
+    assert response.status_code == 400
+    assert "does not belong to this query" in json.loads(response.data)["Error"]
+    assert client.get(zcat_path).headers["X-Next-Cursor"] != cursor
+    assert json.loads(client.get(spectra_path + "?plan=1").data)["cost"]["cached_spectra"] == 0
+    assert client.get(spectra_path).status_code == 200
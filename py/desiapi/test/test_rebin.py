@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import os
+
+import numpy as np
+import pytest
+
+from desiapi.common.build_spectra import handle_spectra
+from desiapi.common.models import *
+from desiapi.common.rebin import rebin_model, rebin_spectra
+
+
+@pytest.fixture
+def spectra(synthetic_tree):
+    params = TargetParameters(synthetic_tree.target_ids[:4])
+    req = ApiRequest(RequestedData.SPECTRA, ResponseType.PLOT, synthetic_tree.release, Endpoint.TARGETS, params, dict())
+    return handle_spectra(req)
+
+
+def test_rebin_spectra(spectra):
+    factor = 4
+    rebinned = rebin_spectra(spectra, factor)
+    assert rebinned.resolution_data is None
+    assert list(rebinned.fibermap["TARGETID"]) == list(spectra.fibermap["TARGETID"])
+    for band in spectra.bands:
+        nbins = len(spectra.wave[band]) // factor
+        end = nbins * factor
+        assert rebinned.flux[band].shape == (spectra.num_spectra(), nbins)
+        np.testing.assert_allclose(rebinned.wave[band], spectra.wave[band][:end].reshape(nbins, factor).mean(axis=1))
+        weights = np.where(spectra.mask[band] == 0, spectra.ivar[band], 0)[:, :end].reshape(-1, nbins, factor)
+        np.testing.assert_allclose(rebinned.ivar[band], weights.sum(axis=2), rtol=1e-6)
+    assert rebin_spectra(spectra, 1) is spectra
+
+
+def test_rebin_model():
+    wave = np.arange(100, dtype=float)
+    flux = np.vstack([np.arange(100, dtype=float), np.ones(100)])
+    new_wave, new_flux = rebin_model((wave, flux), 4)
+    np.testing.assert_allclose(new_wave, wave.reshape(25, 4).mean(axis=1))
+    np.testing.assert_allclose(new_flux, flux.reshape(2, 25, 4).mean(axis=2))
+
+
+def test_plot_rebinned(spectra, tmp_path):
+    # Needs DESI's prospect, not the unrelated package of the same name
+    pytest.importorskip("prospect.viewer")
+    from desiapi.web.response_file import create_spectra_file
+
+    html = create_spectra_file(ResponseType.PLOT, spectra, str(tmp_path), "plot", rebin=4)
+    assert os.path.getsize(html) > 0
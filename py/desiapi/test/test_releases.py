@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import json
+
+import pytest
+
+from desiapi.common.errors import DataNotFoundException, MalformedRequestException
+from desiapi.common.models import RELEASES, ReleaseRegistry
+
+
+@pytest.fixture
+def allowed_releases(synthetic_tree):
+    """Only accept the synthetic release for one test, going back to the default configuration afterwards"""
+    RELEASES.configure({"allowed": [synthetic_tree.release], "aliases": {"latest": synthetic_tree.release}})
+    yield RELEASES
+    RELEASES.configure(dict())
+
+
+def test_resolved_once(synthetic_tree):
+    registry = ReleaseRegistry(aliases={"latest": synthetic_tree.release}, refresh_interval=0)
+    release = registry.get(synthetic_tree.release)
+    assert registry.get("latest") is release
+    assert registry.known() == [synthetic_tree.release]
+    # Nothing has changed on disk, so refreshing resolves the same version
+    registry.refresh()
+    assert registry.get(synthetic_tree.release).version == release.version
+
+
+def test_missing_release_after_refresh(synthetic_tree):
+    registry = ReleaseRegistry(refresh_interval=0)
+    registry.get(synthetic_tree.release)
+    with pytest.raises(DataNotFoundException):
+        registry.get("nosuchrelease")
+    registry.refresh()
+    registry.reload()
+    with pytest.raises(DataNotFoundException):
+        registry.get("nosuchrelease")
+    assert registry.known() == [synthetic_tree.release]
+
+
+def test_disallowed_release_after_refresh(synthetic_tree):
+    registry = ReleaseRegistry(allowed=[synthetic_tree.release], refresh_interval=0)
+    registry.get(synthetic_tree.release)
+    registry.refresh()
+    with pytest.raises(MalformedRequestException, match="unknown release"):
+        registry.get("nosuchrelease")
+    assert registry.known() == [synthetic_tree.release]
+
+
+def test_unknown_release_rejected_after_reload(client, synthetic_tree, allowed_releases):
+    path = "/api/v1/zcat/download/{}/targets/" + str(synthetic_tree.target_ids[0]) + "?filetype=json"
+    assert client.get(path.format("latest")).status_code == 200
+    assert client.post("/api/v1/releases/reload").status_code == 200
+    response = client.get(path.format("nosuchrelease"))
+    assert response.status_code == 400
+    assert "unknown release nosuchrelease" in json.loads(response.data)["Error"]
+    assert "nosuchrelease" not in client.post("/api/v1/releases/reload").json["releases"]
+    assert client.get(path.format(synthetic_tree.release)).status_code == 200
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import fitsio
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from desiapi.common.sky import cone_search, cone_search_vectors, unit_vectors
+
+# Cone searches are plain arithmetic on unit vectors, they should select exactly the rows SkyCoord.separation does
+
+
+def random_sky(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    return ra, dec
+
+
+def expected_rows(ra_column, dec_column, ra, dec, radius):
+    separation = SkyCoord(ra_column * u.deg, dec_column * u.deg).separation(SkyCoord(ra * u.deg, dec * u.deg)).deg
+    # Rows within rounding error of the edge could go either way
+    ambiguous = np.abs(separation - radius) < 1e-9
+    return np.flatnonzero((separation <= radius) & ~ambiguous), np.flatnonzero(ambiguous)
+
+
+@pytest.mark.parametrize(
+    "ra,dec,radius",
+    [
+        (150.0, 2.0, 5.0),
+        (0.5, -10.0, 3.0),  # Wraps through RA 0
+        (359.5, 30.0, 3.0),
+        (42.0, 89.0, 4.0),  # Over the pole
+        (200.0, -45.0, 1 / 3600),
+        (10.0, 10.0, 180.0),  # The whole sky
+    ],
+)
+def test_cone_search_matches_skycoord(ra, dec, radius):
+    ra_column, dec_column = random_sky(100_000)
+    # Some rows close to the centre, so small cones aren't empty
+    near_ra, near_dec = ra + np.linspace(-2, 2, 101) * radius, np.full(101, dec)
+    ra_column = np.concatenate([ra_column, np.mod(near_ra, 360)])
+    dec_column = np.concatenate([dec_column, near_dec])
+    expected, ambiguous = expected_rows(ra_column, dec_column, ra, dec, radius)
+    assert len(expected)
+
+    for rows in [
+        cone_search(ra_column, dec_column, ra, dec, radius, chunk_rows=4097),
+        cone_search_vectors(unit_vectors(ra_column, dec_column), ra, dec, radius, chunk_rows=4097),
+    ]:
+        assert np.all(np.diff(rows) > 0)
+        np.testing.assert_array_equal(np.setdiff1d(rows, ambiguous), expected)
+
+
+def test_empty_catalog():
+    assert len(cone_search(np.array([]), np.array([]), 10.0, 10.0, 1.0)) == 0
+
+
+def test_radec_matches_skycoord(client, synthetic_tree, release):
+    ra, dec, radius = synthetic_tree.cluster_ra, synthetic_tree.cluster_dec, synthetic_tree.cluster_radius / 3600
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/radec/{ra},{dec},{radius}?filetype=json")
+    assert response.status_code == 200
+
+    zcatalog = fitsio.read(release.healpix_fits, ext="ZCATALOG", columns=["TARGETID", "TARGET_RA", "TARGET_DEC", "ZCAT_PRIMARY"])
+    zcatalog = zcatalog[zcatalog["ZCAT_PRIMARY"]]
+    expected, ambiguous = expected_rows(zcatalog["TARGET_RA"], zcatalog["TARGET_DEC"], ra, dec, radius)
+    assert len(expected)
+    found = {row["TARGETID"] for row in response.json} - set(zcatalog["TARGETID"][ambiguous])
+    assert found == set(zcatalog["TARGETID"][expected])
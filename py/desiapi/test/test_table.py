@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import json
+import os
+import re
+from urllib.parse import unquote
+
+import numpy as np
+import pytest
+
+from desiapi.common.errors import DataNotFoundException, MalformedRequestException
+from desiapi.web.table import MAX_TABLE_PAGE, resolve_table, table_data_path, table_page, write_table_data
+
+TABLE_DTYPE = np.dtype([("TARGETID", "i8"), ("SPECTYPE", "U6"), ("Z", "f8"), ("COEFF", "f8", (3,))])
+
+
+@pytest.fixture
+def data_file(tmp_path) -> str:
+    zcat = np.zeros(50, dtype=TABLE_DTYPE)
+    zcat["TARGETID"] = 39627000000000000 + np.arange(50)[::-1]
+    zcat["SPECTYPE"] = ["GALAXY", "QSO", "STAR", "qso", "GALAXY"] * 10
+    zcat["Z"] = np.linspace(0, 4, 50)
+    zcat["Z"][7] = np.nan
+    html_file = str(tmp_path / "cache" / "request" / "zcat.html")
+    os.makedirs(os.path.dirname(html_file))
+    write_table_data(html_file, zcat)
+    return table_data_path(html_file)
+
+
+def columns(*names: str) -> dict:
+    return {f"columns[{i}][data]": name for i, name in enumerate(names)}
+
+
+def test_first_page(data_file):
+    page = table_page(data_file, {"draw": "3", "start": "0", "length": "10"})
+    assert page["draw"] == 3
+    assert page["recordsTotal"] == page["recordsFiltered"] == 50
+    assert len(page["data"]) == 10
+    first = page["data"][0]
+    # 64-bit IDs are sent as strings, NaNs as null and arrays as lists
+    assert first["TARGETID"] == str(39627000000000049)
+    assert page["data"][7]["Z"] is None
+    assert first["COEFF"] == [0.0, 0.0, 0.0]
+
+
+def test_paging(data_file):
+    seen = []
+    for start in range(0, 50, 15):
+        seen += [row["TARGETID"] for row in table_page(data_file, {"start": str(start), "length": "15"})["data"]]
+    assert len(seen) == len(set(seen)) == 50
+    assert len(table_page(data_file, {"length": "-1"})["data"]) == min(50, MAX_TABLE_PAGE)
+
+
+def test_search(data_file):
+    page = table_page(data_file, {"search[value]": "QsO", "length": "100"})
+    assert page["recordsTotal"] == 50 and page["recordsFiltered"] == 20
+    assert {row["SPECTYPE"] for row in page["data"]} == {"QSO", "qso"}
+    # Numbers match numeric columns exactly
+    assert table_page(data_file, {"search[value]": "4"})["recordsFiltered"] == 1
+    # Column searches only look at their own column
+    args = dict(columns("SPECTYPE", "Z"), **{"columns[0][search][value]": "star", "length": "100"})
+    assert {row["SPECTYPE"] for row in table_page(data_file, args)["data"]} == {"STAR"}
+
+
+def test_sort(data_file):
+    args = dict(columns("TARGETID", "SPECTYPE", "Z"), **{"order[0][column]": "0", "length": "100"})
+    ascending = [int(row["TARGETID"]) for row in table_page(data_file, args)["data"]]
+    assert ascending == sorted(ascending)
+    args["order[0][dir]"] = "desc"
+    descending = [int(row["TARGETID"]) for row in table_page(data_file, args)["data"]]
+    assert descending == ascending[::-1]
+    # Sorting a searched table keeps only the matching rows
+    args.update({"search[value]": "star", "order[0][column]": "2", "order[0][dir]": "asc"})
+    z = [row["Z"] for row in table_page(data_file, args)["data"]]
+    # NaNs sort last
+    assert len(z) == 10 and z[:-1] == sorted(z[:-1]) and z[-1] is None
+
+
+def test_bad_arguments(data_file):
+    with pytest.raises(MalformedRequestException):
+        table_page(data_file, {"start": "first"})
+
+
+def test_resolve_table(tmp_path, data_file):
+    cache_root = str(tmp_path / "cache")
+    assert resolve_table(cache_root, "request/zcat") == data_file
+    with pytest.raises(DataNotFoundException):
+        resolve_table(cache_root, "request/other")
+    (tmp_path / "secret.table.npy").write_bytes(b"")
+    for table_id in ["../secret", "request/../../secret", str(tmp_path / "secret"), "/etc/passwd"]:
+        with pytest.raises(MalformedRequestException):
+            resolve_table(cache_root, table_id)
+
+
+def test_table_endpoint(client, synthetic_tree):
+    target_ids = ",".join(map(str, synthetic_tree.target_ids[:30]))
+    response = client.get(f"/api/v1/zcat/plot/{synthetic_tree.release}/targets/{target_ids}")
+    assert response.status_code == 200
+    table_id = unquote(re.search(r"ajax: '/api/v1/table/([^']+)'", response.data.decode()).group(1))
+
+    page = client.get(f"/api/v1/table/{table_id}?draw=1&start=0&length=10")
+    assert page.status_code == 200
+    assert page.json["recordsTotal"] == 30 and len(page.json["data"]) == 10
+
+    assert client.get(f"/api/v1/table/{table_id}-missing").status_code == 404
+    response = client.get("/api/v1/table/../../etc/passwd")
+    assert response.status_code == 400
+    assert json.loads(response.data)["Error"] == "invalid table"
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import json
+
+import numpy as np
+import pytest
+
+from desiapi.common.errors import MalformedRequestException
+from desiapi.common.models import *
+
+# Requests over the server's limits are rejected with a 400 by `validate`, before any data is read. The limits on the
+# IDs a request lists only apply to spectra plots, spectra downloads are bounded by the cost limits (see test_cost.py)
+
+
+def error(response) -> str:
+    return json.loads(response.data)["Error"]
+
+
+def upload(n: int, ra: float, dec: float) -> bytes:
+    """A CSV of N positions around (RA, DEC)"""
+    offsets = np.linspace(0, 1e-3, n)
+    return "\n".join(f"{ra + o},{dec + o}" for o in offsets).encode()
+
+
+def test_xmatch_too_many_positions(client, synthetic_tree):
+    body = upload(MAX_XMATCH_POSITIONS + 1, synthetic_tree.cluster_ra, synthetic_tree.cluster_dec)
+    response = client.post(f"/api/v1/xmatch/download/{synthetic_tree.release}?radius=0.001&filetype=json", data=body)
+    assert response.status_code == 400
+    assert f"more than {MAX_XMATCH_POSITIONS} positions" in error(response)
+
+
+def test_xmatch_at_limit(client, synthetic_tree):
+    body = upload(MAX_XMATCH_POSITIONS, synthetic_tree.cluster_ra, synthetic_tree.cluster_dec)
+    response = client.post(f"/api/v1/xmatch/download/{synthetic_tree.release}?radius=0.001&filetype=json", data=body)
+    assert response.status_code == 200
+
+
+def tiles_path(tiles: dict) -> str:
+    return "/".join(f"{tile}/{','.join(map(str, fibers))}" for tile, fibers in tiles.items())
+
+
+def test_too_many_tiles(client, synthetic_tree):
+    tiles = {90000 + i: [0] for i in range(MAX_TILES + 1)}
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/tiles/{tiles_path(tiles)}?filetype=json")
+    assert response.status_code == 400
+    assert f"more than {MAX_TILES} tiles" in error(response)
+
+
+def test_too_many_fibers_across_tiles(client, synthetic_tree):
+    first, second = list(synthetic_tree.tiles)[:2]
+    tiles = {first: list(range(MAX_FIBERS)), second: [0]}
+    response = client.get(f"/api/v1/spectra/plot/{synthetic_tree.release}/tiles/{tiles_path(tiles)}")
+    assert response.status_code == 400
+    assert f"more than {MAX_FIBERS} fiber IDs" in error(response)
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/tiles/{tiles_path(tiles)}?filetype=json")
+    assert response.status_code == 200
+
+
+def test_tiles_within_limits(client, synthetic_tree):
+    response = client.get(
+        f"/api/v1/zcat/download/{synthetic_tree.release}/tiles/{tiles_path(synthetic_tree.tiles)}?filetype=json"
+    )
+    assert response.status_code == 200
+    assert len(response.json) == sum(len(fibers) for fibers in synthetic_tree.tiles.values())
+
+
+def test_malformed_regions(client, synthetic_tree):
+    release = synthetic_tree.release
+    cases = {
+        f"zcat/download/{release}/polygon/150,1.8,151.5,1.8": "at least 3 vertices",
+        f"zcat/download/{release}/polygon/150,0,151,0,152,0": "one great circle",
+        f"spectra/download/{release}/polygon/150,1,152,1,151,2,152,3,150,3": "convex",
+        f"aggregate/download/{release}/box/150,151,3,2": "smallest first",
+    }
+    for path, message in cases.items():
+        response = client.get(f"/api/v1/{path}")
+        assert response.status_code == 400, path
+        assert message in error(response), path
+
+
+def test_region_within_limits(client, synthetic_tree):
+    ra, dec = synthetic_tree.cluster_ra, synthetic_tree.cluster_dec
+    corners = f"{ra - 0.1},{dec - 0.1},{ra + 0.1},{dec - 0.1},{ra + 0.1},{dec + 0.1},{ra - 0.1},{dec + 0.1}"
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/polygon/{corners}?filetype=json")
+    assert response.status_code == 200
+    assert set(synthetic_tree.target_ids) <= {row["TARGETID"] for row in response.json}
+
+
+def test_too_many_target_ids(client, synthetic_tree):
+    known = synthetic_tree.target_ids
+    target_ids = ",".join(str(known[i % len(known)]) for i in range(MAX_TARGET_IDS + 1))
+    response = client.get(f"/api/v1/spectra/plot/{synthetic_tree.release}/targets/{target_ids}")
+    assert response.status_code == 400
+    assert f"more than {MAX_TARGET_IDS} target IDs" in error(response)
+    # Zcat and aggregate requests aren't limited
+    for data in ["zcat", "aggregate"]:
+        response = client.get(f"/api/v1/{data}/download/{synthetic_tree.release}/targets/{target_ids}")
+        assert response.status_code == 200, data
+
+
+def test_spectra_downloads_not_counted():
+    from desiapi.web.server import validate
+
+    for endpoint, params in [
+        (Endpoint.TARGETS, TargetParameters(list(range(1, 5001)))),
+        (Endpoint.TILE, TileParameters(80000, list(range(5000)))),
+    ]:
+        validate(ApiRequest(RequestedData.SPECTRA, ResponseType.DOWNLOAD, "synth", endpoint, params, dict()))
+
+
+def test_too_many_fibers(client, synthetic_tree):
+    tile = list(synthetic_tree.tiles)[0]
+    fibers = ",".join(map(str, range(MAX_FIBERS + 1)))
+    response = client.get(f"/api/v1/spectra/plot/{synthetic_tree.release}/tile/{tile}/{fibers}")
+    assert response.status_code == 400
+    assert f"more than {MAX_FIBERS} fiber IDs" in error(response)
+    response = client.get(f"/api/v1/zcat/download/{synthetic_tree.release}/tile/{tile}/{fibers}?filetype=json")
+    assert response.status_code == 200
+
+
+def test_client_splits_to_server_limits():
+    # Every chunk the Python client sends must pass the server's validation, even for plots, which have the lowest limits
+    from desiapi.python.transport import split_request
+    from desiapi.web.server import validate
+
+    n = 3 * MAX_TARGET_IDS + 1
+    positions = 2 * MAX_XMATCH_POSITIONS
+    oversized = [
+        (Endpoint.TARGETS, TargetParameters(list(range(1, n + 1)))),
+        (Endpoint.TILE, TileParameters(80000, list(range(n)))),
+        (Endpoint.TILES, MultiTileParameters({80000 + i: list(range(20)) for i in range(2 * MAX_TILES)})),
+        (Endpoint.XMATCH, CrossMatchParameters([1.0] * positions, [2.0] * positions, [0.001] * positions)),
+    ]
+    for endpoint, params in oversized:
+        if endpoint == Endpoint.XMATCH:
+            req = ApiRequest(RequestedData.ZCAT, ResponseType.DOWNLOAD, "synth", endpoint, params, dict())
+        else:
+            req = ApiRequest(RequestedData.SPECTRA, ResponseType.PLOT, "synth", endpoint, params, dict())
+        with pytest.raises(MalformedRequestException):
+            validate(req)
+        chunks = split_request(req)
+        assert len(chunks) > 1, endpoint
+        for chunk in chunks:
+            validate(chunk)
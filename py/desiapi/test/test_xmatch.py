@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import io
+
+import fitsio
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from desiapi.common.models import *
+from desiapi.common.sky import SkyTree
+from desiapi.python.transport import merge_responses, split_request
+
+
+def primary_rows(release):
+    zcatalog = fitsio.read(release.healpix_fits, ext="ZCATALOG", columns=["TARGETID", "TARGET_RA", "TARGET_DEC", "ZCAT_PRIMARY"])
+    return zcatalog[zcatalog["ZCAT_PRIMARY"]]
+
+
+def expected_matches(zcatalog, ra, dec, radius) -> dict:
+    """(input row, TARGETID) -> separation, for every primary row within RADIUS[i] of (RA[i], DEC[i])"""
+    catalog = SkyCoord(zcatalog["TARGET_RA"] * u.deg, zcatalog["TARGET_DEC"] * u.deg)
+    matches = dict()
+    for i, position in enumerate(SkyCoord(np.asarray(ra) * u.deg, np.asarray(dec) * u.deg)):
+        separation = catalog.separation(position).deg
+        for row in np.flatnonzero(separation <= radius[i]):
+            matches[(i, int(zcatalog["TARGETID"][row]))] = separation[row]
+    return matches
+
+
+def found_matches(rows) -> dict:
+    return {(int(row["INPUT_ROW"]), int(row["TARGETID"])): row["SEPARATION"] for row in rows}
+
+
+def assert_same_matches(found: dict, expected: dict):
+    assert found.keys() == expected.keys()
+    for key, separation in expected.items():
+        assert abs(found[key] - separation) < 1e-9, key
+
+
+def positions(synthetic_tree, zcatalog):
+    """Some positions on catalog rows, some near the cluster and one far from anything"""
+    ra = zcatalog["TARGET_RA"][:5].tolist() + [synthetic_tree.cluster_ra, synthetic_tree.cluster_ra + 0.01, 0.0]
+    dec = zcatalog["TARGET_DEC"][:5].tolist() + [synthetic_tree.cluster_dec, synthetic_tree.cluster_dec, -89.0]
+    radius = [1e-4] * 5 + [synthetic_tree.cluster_radius / 3600, 0.005, 1e-3]
+    return ra, dec, radius
+
+
+def test_sky_tree_matches_skycoord(release, synthetic_tree):
+    zcatalog = primary_rows(release)
+    ra, dec, radius = positions(synthetic_tree, zcatalog)
+    tree = SkyTree(zcatalog["TARGET_RA"], zcatalog["TARGET_DEC"], np.arange(len(zcatalog)))
+    position, rows, separation = tree.cross_match(np.array(ra), np.array(dec), np.array(radius))
+    found = {(int(p), int(zcatalog["TARGETID"][r])): s for p, r, s in zip(position, rows, separation)}
+    assert_same_matches(found, expected_matches(zcatalog, ra, dec, radius))
+    assert np.all(np.diff(position) >= 0)
+
+
+def test_xmatch_upload_formats(client, synthetic_tree, release):
+    zcatalog = primary_rows(release)
+    ra, dec, radius = positions(synthetic_tree, zcatalog)
+    expected = expected_matches(zcatalog, ra, dec, radius)
+    assert len(expected) > len(ra)
+
+    csv = "RA,Dec,Radius\n" + "\n".join(f"{r!r},{d!r},{s!r}" for r, d, s in zip(ra, dec, radius))
+    npy = io.BytesIO()
+    np.save(npy, np.rec.fromarrays([ra, dec, radius], names="ra,dec,radius"))
+    fits = io.BytesIO()
+    Table({"RA": ra, "DEC": dec, "RADIUS": radius}).write(fits, format="fits")
+    for upload in [csv.encode(), npy.getvalue(), fits.getvalue()]:
+        response = client.post(f"/api/v1/xmatch/download/{synthetic_tree.release}?filetype=json", data=upload)
+        assert response.status_code == 200
+        assert_same_matches(found_matches(response.json), expected)
+
+
+def test_xmatch_default_radius(client, synthetic_tree, release):
+    zcatalog = primary_rows(release)
+    ra, dec, _ = positions(synthetic_tree, zcatalog)
+    csv = "\n".join(f"{r!r},{d!r}" for r, d in zip(ra, dec))
+    response = client.post(f"/api/v1/xmatch/download/{synthetic_tree.release}?radius=0.002&filetype=json", data=csv)
+    assert response.status_code == 200
+    assert_same_matches(found_matches(response.json), expected_matches(zcatalog, ra, dec, [0.002] * len(ra)))
+
+
+def test_split_xmatch_numbers_positions(client, synthetic_tree, release):
+    # The client splits long position lists, the merged response numbers positions as they were given
+    zcatalog = primary_rows(release)
+    n = MAX_XMATCH_POSITIONS + 10
+    ra = np.resize(zcatalog["TARGET_RA"][:20], n).tolist()
+    dec = np.resize(zcatalog["TARGET_DEC"][:20], n).tolist()
+    radius = [1e-4] * n
+    req = ApiRequest(
+        RequestedData.ZCAT, ResponseType.DOWNLOAD, synthetic_tree.release, Endpoint.XMATCH,
+        CrossMatchParameters(ra, dec, radius), dict(),
+    )
+    responses = []
+    for chunk in split_request(req):
+        upload = "\n".join(f"{r!r},{d!r},{s!r}" for r, d, s in zip(chunk.params.ra, chunk.params.dec, chunk.params.radius))
+        response = client.post(f"/api/v1/xmatch/download/{synthetic_tree.release}?filetype=json", data=upload)
+        assert response.status_code == 200
+        responses.append(Table(rows=response.json))
+    assert len(responses) == 2
+    merged = merge_responses(req, responses)
+    found = {(int(p), int(t)) for p, t in zip(merged["INPUT_ROW"], merged["TARGETID"])}
+    assert {(i, int(zcatalog["TARGETID"][i % 20])) for i in range(n)} <= found
+    assert max(merged["INPUT_ROW"]) == n - 1
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Mapping
+
+from ..common.cost import wants_plan
+from ..common.errors import ServerBusyException
+from ..common.models import *
+from ..common.utils import log
+
+# Admission control. Requests are sorted into classes (zcat, spectra downloads, plots) that each have their own
+# limits, so a burst of slow requests of one class can't hold up the others:
+#   max_concurrent  requests of the class being built at once
+#   max_queued      requests allowed to wait for one of those slots, any more are refused straight away with 429
+#   queue_timeout   seconds a request may wait for a slot before giving up with 503
+# Refusals carry a Retry-After header, estimated from how long requests of the class have recently been taking.
+# Limits come from the [admission] section of the config file, with ADMISSION_LIMITS as the defaults.
+
+DURATION_SMOOTHING = 0.2  # Weight of the latest request in the running average of request durations
+
+
+class AdmissionClass:
+    """The limits and current load of one class of request"""
+
+    def __init__(self, name: str, max_concurrent: int, max_queued: int, queue_timeout: float) -> None:
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiting = 0
+        self.refused = 0
+        self.average_duration = 1.0  # seconds, until we have measured some requests
+        self._slots = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free for a new request, assuming everyone already waiting gets one first"""
+        with self._lock:
+            rounds = (self.waiting + 1) / self.max_concurrent
+            return max(1, math.ceil(rounds * self.average_duration))
+
+    def refuse(self, message: str, status: int) -> ServerBusyException:
+        with self._lock:
+            self.refused += 1
+        log(f"refusing {self.name} request:", message)
+        return ServerBusyException(message, status, self.retry_after())
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        """Hold one of the class's slots for the duration of the block, waiting for one if need be. Raises ServerBusyException if the queue is full or the wait is too long"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                full = self.waiting >= self.max_queued
+                if not full:
+                    self.waiting += 1
+            if full:
+                raise self.refuse(f"too many {self.name} requests queued, try again later", 429)
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                raise self.refuse(f"timed out waiting to start a {self.name} request, try again later", 503)
+        with self._lock:
+            self.running += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self._lock:
+                self.running -= 1
+                self.average_duration += DURATION_SMOOTHING * (duration - self.average_duration)
+            self._slots.release()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "refused": self.refused,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "queue_timeout": self.queue_timeout,
+                "average_duration": round(self.average_duration, 3),
+            }
+
+
+def build_classes(config: Mapping[str, Mapping]) -> Dict[str, AdmissionClass]:
+    """An AdmissionClass for each class in ADMISSION_LIMITS, with any limits CONFIG (the [admission] table) overrides"""
+    classes = dict()
+    for name, defaults in ADMISSION_LIMITS.items():
+        limits = dict(defaults, **config.get(name, dict()))
+        classes[name] = AdmissionClass(
+            name, int(limits["max_concurrent"]), int(limits["max_queued"]), float(limits["queue_timeout"])
+        )
+    return classes
+
+
+_classes: Dict[str, AdmissionClass] = build_classes(dict())
+
+
+def configure_admission(config: Mapping[str, Mapping]):
+    """Replace the admission limits with those in CONFIG. Requests already admitted finish under the old limits"""
+    global _classes
+    _classes = build_classes(config)
+
+
+def request_class(req: ApiRequest) -> str:
+    """Which class REQ is admitted under: plots, spectra downloads, or everything else (zcat, aggregates and plans)"""
+    if wants_plan(req):
+        return "zcat"
+    if req.response_type == ResponseType.PLOT:
+        return "plot"
+    if req.requested_data == RequestedData.SPECTRA:
+        return "spectra"
+    return "zcat"
+
+
+def admit(req: ApiRequest):
+    """Context manager holding a slot in REQ's class while it is built, see `AdmissionClass.admit`"""
+    return _classes[request_class(req)].admit()
+
+
+def admission_status() -> Dict[str, dict]:
+    """Current load and limits of every class"""
+    return {name: admission.status() for name, admission in _classes.items()}
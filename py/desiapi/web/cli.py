@@ -2,17 +2,33 @@
 import os
 import argparse
 from ..common import cache, utils
-from ..common.models import DEFAULT_CONF, USER_CONF
-from .server import run_app
+from ..common.models import CONVERT_CHUNK_ROWS, CONVERT_WORKERS, DEFAULT_CONF, PRELOAD_RELEASES, USER_CONF
 
 parser = argparse.ArgumentParser(prog="DESI API")
 
 parser.add_argument(
     "command",
-    choices=["clean_cache", "emergency_clean_cache", "server"],
+    choices=["clean_cache", "emergency_clean_cache", "server", "convert"],
     default="server",
 )
 
+# Options for `convert`
+parser.add_argument(
+    "--releases",
+    type=lambda s: s.split(","),
+    default=None,
+    help="Comma-separated releases to build intermediate files for (default: the releases preloaded by the server)",
+)
+parser.add_argument(
+    "--formats",
+    type=lambda s: s.split(","),
+    default=None,
+    help="Comma-separated intermediate formats to build: memmap, hdf5 (default: both)",
+)
+parser.add_argument("--workers", type=int, default=None, help="Catalogs converted in parallel")
+parser.add_argument("--force", action="store_true", help="Rebuild even if the files are up to date")
+parser.add_argument("--chunk-rows", type=int, default=None, help="Rows read from the FITS at a time while converting")
+
 # parser.add_argument("-c", "--config-file", default=DEFAULT_CONF)
 
 
@@ -38,6 +54,9 @@ def main():
     config = utils.get_config_map(config_file)
     utils.log("config", config)
     if args.command == "server":
+        # Only the server needs Flask and the data handling modules, the cache commands start faster without them
+        from .server import run_app
+
         run_app(config)
     elif args.command == "clean_cache":
         cache.clean_cache(config["cache"]["path"], config["cache"]["max_age"])
@@ -45,6 +64,16 @@ def main():
         cache.emergency_clean_cache(
             config["cache"]["path"], config["cache"]["max_size"]
         )
+    elif args.command == "convert":
+        from ..convert import build
+
+        build.build_intermediates(
+            releases=args.releases or config.get("releases", dict()).get("preload", PRELOAD_RELEASES),
+            formats=args.formats or build.FORMATS,
+            workers=args.workers or CONVERT_WORKERS,
+            force=args.force,
+            chunk_rows=args.chunk_rows or CONVERT_CHUNK_ROWS,
+        )
 
 
 if __name__ == "__main__":
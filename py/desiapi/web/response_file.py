@@ -1,19 +1,18 @@
+import dataclasses
 import datetime as dt
 import json
 import os
 
-import desispec.io
-import desispec.spectra
 import fitsio
 import numpy as np
-from flask import render_template
-from numpyencoder import NumpyEncoder
-from prospect.viewer import plotspectra
 
-from ..common.build_spectra import handle_spectra, handle_zcatalog
+from ..common.aggregate import handle_aggregate
+from ..common.build_spectra import handle_spectra, handle_zcatalog_page
 from ..common.cache import check_cache
 from ..common.errors import MalformedRequestException, ServerFailedException
 from ..common.models import *
+from ..common.rebin import rebin_factor, rebin_model, rebin_spectra
+from .table import write_table_data
 from ..common.utils import *
 
 
@@ -26,20 +25,30 @@ def build_response(
     :param request_time: The time the request was made, used for cache checks, etc.
     :returns: A complete path (including the file extension) to a created file that should be sent back as the response
     """
+    # Responses built from an older version of the release are never reused. The release is resolved once, so the
+    # response is built from the version it is cached under even if a new one appears meanwhile
+    release = get_release(req.release)
+    req = dataclasses.replace(req, release_version=release.version)
     cached = check_cache(req, request_time, cache_root, cache_max_age)
     if cached:
         return cached
     cache_path = f"{cache_root}/{req.get_cache_path()}"
 
     if req.requested_data == RequestedData.SPECTRA:
-        spectra = handle_spectra(req)
+        spectra = handle_spectra(req, release)
         log("handled spectra")
         resp_file_path = create_spectra_file(
-            req.response_type, spectra, cache_path, request_time.isoformat()
+            req.response_type,
+            spectra,
+            cache_path,
+            request_time.isoformat(),
+            rebin_factor(req.filters),
         )
         return resp_file_path
+    elif req.requested_data == RequestedData.AGGREGATE:
+        return create_aggregate_file(handle_aggregate(req, release), cache_path, request_time.isoformat())
     else:
-        zcatalog = handle_zcatalog(req)
+        zcatalog, next_cursor, total = handle_zcatalog_page(req, release)
         resp_file_path = create_zcat_file(
             req,
             zcatalog,
@@ -47,9 +56,30 @@ def build_response(
             request_time.isoformat(),
             req.filters,
         )
+        if total != len(zcatalog) or next_cursor:
+            write_page_meta(resp_file_path, next_cursor, total)
         return resp_file_path
 
 
+def page_meta_path(response_file: str) -> str:
+    """Paging information for a zcat page is kept next to the cached response, so that cache hits can report it too"""
+    return f"{os.path.dirname(response_file)}/{basename(response_file)}.meta"
+
+
+def write_page_meta(response_file: str, next_cursor: str | None, total: int):
+    with open(page_meta_path(response_file), "w") as f:
+        json.dump({"next_cursor": next_cursor, "total": total}, f)
+
+
+def read_page_meta(response_file: str) -> dict:
+    """Return the paging information recorded for RESPONSE_FILE, or an empty dict if it isn't a page of a larger result"""
+    meta_file = page_meta_path(response_file)
+    if not os.path.exists(meta_file):
+        return dict()
+    with open(meta_file) as f:
+        return json.load(f)
+
+
 def create_zcat_file(
     req: ApiRequest,
     zcat: Zcatalog,
@@ -102,22 +132,41 @@ def write_zcat_to_file(target_file: str, zcat: Zcatalog, filetype: str):
 def zcat_to_json_str(zcat: Zcatalog) -> str:
     """Jsonify the data in the Zcatalog object ZCAT and return the raw Json data."""
 
+    from numpyencoder import NumpyEncoder
+
     keys = zcat.dtype.names
     return json.dumps([dict(zip(keys, record)) for record in zcat], cls=NumpyEncoder)
 
 
+def create_aggregate_file(aggregates: dict, save_dir: str, file_name: str) -> str:
+    """Write the result of an aggregate request to a JSON file in SAVE_DIR, and return the path to it"""
+    os.makedirs(save_dir, exist_ok=True)
+    # NOTE: .aggregate.json is important internally
+    target_file = f"{save_dir}/{file_name}.aggregate.json"
+    with open(target_file, "w") as f:
+        json.dump(aggregates, f)
+    return target_file
+
+
 def create_spectra_file(
-    response_type: ResponseType, spectra: Spectra, save_dir: str, file_name: str
+    response_type: ResponseType,
+    spectra: Spectra,
+    save_dir: str,
+    file_name: str,
+    rebin: int = PLOT_REBIN_FACTOR,
 ) -> str:
     """Creates a file at SAVE_PATH.<ext> generated from data in SPECTRA. The type of file (FITS vs HTML currently) is determined by RESPONSE_TYPE.
 
     :param response_type: Response type from the request, one of DOWNLOAD or PLOT, defines whether the output is raw data or an HTML plot.
     :param spectra: The Spectra object to draw our data from
     :param save_path: The path (without an extension) to which we should save our file.
+    :param rebin: Number of pixels to combine into one for plots. Downloads are always full resolution
     :returns: The full path (including extension) to the file created
     """
     os.makedirs(save_dir, exist_ok=True)
     if response_type == ResponseType.DOWNLOAD:
+        import desispec.io
+
         # NOTE: .spectra.fits is important internally
         target_file = f"{save_dir}/{file_name}.spectra.fits"
         try:
@@ -126,7 +175,7 @@ def create_spectra_file(
         except Exception as e:
             raise ServerFailedException("unable to create spectra file")
     elif response_type == ResponseType.PLOT:
-        return spectra_to_html(spectra, save_dir, file_name)
+        return spectra_to_html(spectra, save_dir, file_name, rebin)
     else:
         raise MalformedRequestException(
             "invalid response_type (must be PLOT or DOWNLOAD)"
@@ -134,49 +183,61 @@ def create_spectra_file(
 
 
 def zcat_to_html(req: ApiRequest, zcat: Zcatalog, save_dir: str, file_name: str) -> str:
-    """Render ZCAT data to an interactive html table based on a template, and return the path to the filled-in html file
+    """Render ZCAT data to an interactive html table based on a template, and return the path to the filled-in html file.
+    The rows aren't part of the page, they are saved alongside it and served a page at a time by `/api/v1/table`, see `table.py`
+
     :param req: The ApiRequest (generates the title/description for the table)
     :param zcat: The Zcatalog metadata to generate a table from
-    :param save_dir:
-    :param file_name:
-    :returns:
+    :param save_dir: The cache directory for this request
+    :param file_name: Name (without extension) of the html file
+    :returns: Path to the html file
 
     """
 
+    from flask import render_template
+
     html_file = f"{save_dir}/{file_name}.html"
-    json_data = json.loads(zcat_to_json_str(zcat))
-    for record in json_data:
-        record["TARGETID"] = str(record["TARGETID"])
-    json_str = json.dumps(json_data)
+    write_table_data(html_file, zcat)
     with open(html_file, "w") as out:
         out.write(
             render_template(
-                "table.html", columns=zcat.dtype.names, json_data=json_str, request=req
+                "table.html",
+                columns=zcat.dtype.names,
+                table_id=f"{req.get_cache_path()}/{file_name}",
+                request=req,
             )
         )
     return html_file
 
 
-def spectra_to_html(spectra: Spectra, save_dir: str, file_name: str) -> str:
+def spectra_to_html(spectra: Spectra, save_dir: str, file_name: str, rebin: int = PLOT_REBIN_FACTOR) -> str:
     """Render Spectra data to an interactive html plot using the DESI Prosect library, and return the path to the html file.
+    The plot is of a copy rebinned by REBIN (see `rebin.py`), with redrock models built from the full-resolution spectra
 
-    :param spectra:
+    :param spectra: Full-resolution spectra, with their redrock catalog as extra_catalog
     :param save_dir:
     :param file_name:
+    :param rebin: Number of pixels to combine into one
     :returns:
 
     """
 
+    from prospect.utilities import create_model
+    from prospect.viewer import plotspectra
+
     try:
         print(spectra.extra_catalog)
+        model = rebin_model(create_model(spectra, spectra.extra_catalog), rebin)
         plotspectra(
-            spectra,
+            rebin_spectra(spectra, rebin),
             zcatalog=spectra.extra_catalog,
             html_dir=save_dir,
             title=file_name,
             with_vi_widgets=False,
             with_full_2ndfit=False,
             num_approx_fits=0,
+            model_from_zcat=False,
+            model=model,
         )
         return f"{save_dir}/{file_name}.html"
     except Exception as e:
@@ -7,12 +7,25 @@ from typing import List
 from flask import Flask, Response, abort, redirect, request, send_file
 from json import loads
 
-from ..common.build_spectra import preload_fits
-
-from ..common.errors import DesiApiException, MalformedRequestException
+from ..common.build_spectra import handle_plan
+from ..common.cost import configure_cost_limits, wants_plan
+from ..common.fragments import configure_fragment_cache
+from ..common.preload import preload_finished, preload_status, start_background_preload
+from ..common.sky import sky_region
+
+from ..common.errors import (
+    DataNotFoundException,
+    DesiApiException,
+    MalformedRequestException,
+    RequestTooLargeException,
+    ServerBusyException,
+)
 from ..common.models import *
 from ..common.utils import *
-from .response_file import build_response
+from .admission import admission_status, admit, configure_admission
+from .response_file import build_response, read_page_meta
+from .table import resolve_table, table_page
+from .xmatch import build_xmatch_params, read_positions
 
 DEBUG = True
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
@@ -30,6 +43,51 @@ def show_doc():
     return redirect(DOC_URL)
 
 
+@app.route("/healthz")
+def healthz() -> Response:
+    """Liveness check: the server is up and answering requests, regardless of how far preloading has got. Also reports how busy each class of request is"""
+    info = json.dumps({"status": "ok", "preload": preload_status(), "admission": admission_status()}, indent=4)
+    return Response(info, status=200, mimetype="application/json")
+
+
+@app.route("/readyz")
+def readyz() -> Response:
+    """Readiness check: 200 once every release has finished preloading (or failed to), 503 while any are still loading.
+    Requests are served either way, releases that aren't loaded yet just fall back to the slower memmap/HDF5 paths.
+    """
+    ready = preload_finished()
+    info = json.dumps(
+        {"status": "ready" if ready else "loading", "preload": preload_status()},
+        indent=4,
+    )
+    return Response(info, status=200 if ready else 503, mimetype="application/json")
+
+
+@app.route("/api/v1/releases/reload", methods=["POST"])
+def reload_releases() -> Response:
+    """Look up the files of every release again, for instance after a new zcatalog version has been written. Releases with a new version are preloaded again in the background"""
+    RELEASES.refresh()
+    info = json.dumps({"releases": RELEASES.known()}, indent=4)
+    return Response(info, status=200, mimetype="application/json")
+
+
+@app.route("/api/v1/table/<path:table_id>")
+def handle_table(table_id: str) -> Response:
+    """Serve one page of rows to an HTML zcat table (DataTables server-side processing)
+
+    :param table_id: Identifies the table, as embedded in the page by `zcat_to_html`
+    :returns: JSON with the requested rows, sorted and searched according to the query parameters
+    """
+    try:
+        data_file = resolve_table(app.config["cache"]["path"], table_id)
+        page = table_page(data_file, request.args.to_dict())
+    except DataNotFoundException as e:
+        return Response(json.dumps({"error": str(e)}), status=404, mimetype="application/json")
+    except DesiApiException as e:
+        return invalid_request_error(e)
+    return Response(json.dumps(page), status=200, mimetype="application/json")
+
+
 @app.route(
     "/api/v1/<requested_data>/<response_type>/<release>/<endpoint>/<path:endpoint_params>",
     methods=["GET"],
@@ -93,12 +151,34 @@ def handle_post():
         return process_request(req)
 
 
+@app.route("/api/v1/xmatch/<response_type>/<release>", methods=["POST"])
+def handle_xmatch(response_type: str, release: str) -> Response:
+    """Cross-match an uploaded list of positions against the zcatalog. The positions are either the body of the request, or a file named `file` in a multipart form (see `xmatch.py` for the formats accepted).
+    Query params are filters as usual, except `radius`, which is the radius for positions that don't have their own.
+
+    :param response_type: One of Download/Plot
+    :param release: The DESI release from which to draw data.
+    :returns: The zcat rows matching each position, tagged with INPUT_ROW and SEPARATION
+    """
+    filters = request.args.to_dict()
+    default_radius = filters.pop("radius", None)
+    try:
+        upload = request.files["file"].read() if "file" in request.files else request.get_data()
+        params = read_positions(upload, float(default_radius) if default_radius is not None else None)
+        req = build_request("zcat", response_type, release, "xmatch", params, filters)
+        validate(req)
+    except (DesiApiException, KeyError, ValueError) as e:
+        return invalid_request_error(e)
+    else:
+        return process_request(req)
+
+
 def build_request(
     requested_data: str,
     response_type: str,
     release: str,
     endpoint: str,
-    params: str | dict,
+    params: str | dict | Parameters,
     filters: dict,
 ) -> ApiRequest:
     """Parse an API request path into an ApiRequest object. The parameters represent the components of the request URL.
@@ -109,7 +189,7 @@ def build_request(
         requested_data_enum = RequestedData[requested_data.upper()]
     except KeyError:
         raise MalformedRequestException(
-            f"requested_data must be one of ZCAT or SPECTRA, not {requested_data}"
+            f"requested_data must be one of ZCAT, SPECTRA or AGGREGATE, not {requested_data}"
         )
 
     try:
@@ -118,21 +198,25 @@ def build_request(
         raise MalformedRequestException(
             f"response_type must be one of DOWNLOAD or PLOT, not {response_type}"
         )
+    if requested_data_enum == RequestedData.AGGREGATE and response_type_enum != ResponseType.DOWNLOAD:
+        raise MalformedRequestException("aggregates are only available as downloads")
 
     try:
         endpoint_enum = Endpoint[endpoint.upper()]
     except KeyError:
         raise MalformedRequestException(
-            f"endpoint must be one of TILE, TARGETS, RADEC, not {endpoint}"
+            f"endpoint must be one of TILE, TILES, TARGETS, RADEC, BOX, POLYGON, XMATCH, not {endpoint}"
         )
 
     release_canonised = release.lower()
+    canonise_release_name(release_canonised)  # Unknown releases are a malformed request, not a server error
 
-    formal_params = (
-        build_params_from_strings(endpoint_enum, params.split("/"))
-        if isinstance(params, str)
-        else build_params_from_dict(endpoint_enum, params)
-    )
+    if isinstance(params, Parameters):
+        formal_params = params
+    elif isinstance(params, str):
+        formal_params = build_params_from_strings(endpoint_enum, params.split("/"))
+    else:
+        formal_params = build_params_from_dict(endpoint_enum, params)
 
     return ApiRequest(
         requested_data=requested_data_enum,
@@ -145,24 +229,42 @@ def build_request(
 
 
 def validate(req: ApiRequest):
-    return True  # FIXME kept for testing
+    """Reject requests the server won't serve before starting on them. Regions and cross-match uploads are checked whatever is requested, and the number of tiles for everything but aggregates. There are no restrictions on the IDs zcat and aggregate requests list, and spectra downloads are bounded by the cost limits once their rows are known (see `cost.py`), so only spectra plots are limited to MAX_TARGET_IDS and MAX_FIBERS"""
     params = req.params
-    if req.requested_data == RequestedData.ZCAT:
-        return True  # no restrictions on zcat endpoint (for now)
+    if req.endpoint in (Endpoint.BOX, Endpoint.POLYGON):
+        sky_region(params)
+    elif req.endpoint == Endpoint.XMATCH:
+        validate_xmatch(params)
+    elif req.endpoint == Endpoint.TILES and req.requested_data != RequestedData.AGGREGATE:
+        validate_multi_tile(params)
+    if req.requested_data != RequestedData.SPECTRA:
+        return  # no restrictions on zcat endpoint (for now)
     if req.endpoint == Endpoint.RADEC:
         validate_radec(params)
-    elif req.endpoint == Endpoint.TARGETS:
+    if req.response_type != ResponseType.PLOT:
+        return
+    if req.endpoint == Endpoint.TARGETS:
         validate_target(params)
     elif req.endpoint == Endpoint.TILE:
         validate_tile(params)
-    else:
-        raise MalformedRequestException("invalid endpoint")
+    elif req.endpoint == Endpoint.TILES:
+        validate_fibers(sum(len(fibers) for fibers in params.tiles.values()))
 
 
 def process_request(req: ApiRequest) -> Response:
-    """A simple wrapper around handle_request that does some error-handling"""
+    """A simple wrapper around handle_request that does some error-handling, and only starts building the response once admission control lets it (see `admission.py`)"""
     try:
-        return exec_request(req)
+        with admit(req):
+            if wants_plan(req):
+                return exec_plan(req)
+            return exec_request(req)
+    except ServerBusyException as e:
+        return server_busy_error(e)
+    except RequestTooLargeException as e:
+        return request_too_large_error(e)
+    except MalformedRequestException as e:
+        # Some requests can only be found to be invalid (or too large) once we start on them
+        return invalid_request_error(e)
     except DesiApiException as e:
         info = json.dumps(
             {
@@ -192,14 +294,27 @@ def exec_request(req: ApiRequest) -> Response:
     )
 
     if mimetype(response_file) == ".html":
-        return send_file(response_file)
+        response = send_file(response_file)
     else:
         ext = mimetype(response_file)
         requested_data = req.requested_data.name.lower()
-        return send_file(
+        response = send_file(
             response_file,
             download_name=f"desi_api_{req_time.isoformat()}.{requested_data}{ext}",  # .spectra.fits or .zcat.fits
         )
+    page = read_page_meta(response_file)
+    if page:
+        response.headers["X-Total-Count"] = str(page["total"])
+        if page["next_cursor"]:
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
+    return response
+
+
+def exec_plan(req: ApiRequest) -> Response:
+    """Answer a request with `plan=1` with what it would cost, as JSON, instead of its data (see `cost.py`). Plans aren't cached, they depend on the fragment cache"""
+    log("planning: ", req.__repr__())
+    info = json.dumps(handle_plan(req), indent=4)
+    return Response(info, status=200, mimetype="application/json")
 
 
 # Validation Functions/Rules:
@@ -207,17 +322,31 @@ def exec_request(req: ApiRequest) -> Response:
 
 def validate_radec(params: RadecParameters):
     if params.radius > 60:
-        raise MalformedRequestException("radius must be <= 60 arcseconds")
+        raise MalformedRequestException("radius must be <= 60 degrees")
 
 
 def validate_tile(params: TileParameters):
-    if len(params.fibers) > 500:
-        raise MalformedRequestException("cannot have more than 500 fiber IDs")
+    validate_fibers(len(params.fibers))
+
+
+def validate_fibers(fibers: int):
+    if fibers > MAX_FIBERS:
+        raise MalformedRequestException(f"cannot have more than {MAX_FIBERS} fiber IDs")
+
+
+def validate_multi_tile(params: MultiTileParameters):
+    if len(params.tiles) > MAX_TILES:
+        raise MalformedRequestException(f"cannot have more than {MAX_TILES} tiles")
 
 
 def validate_target(params: TargetParameters):
-    if len(params.target_ids) > 500:
-        raise MalformedRequestException("cannot have more than 500 target IDs")
+    if len(params.target_ids) > MAX_TARGET_IDS:
+        raise MalformedRequestException(f"cannot have more than {MAX_TARGET_IDS} target IDs")
+
+
+def validate_xmatch(params: CrossMatchParameters):
+    if len(params.ra) > MAX_XMATCH_POSITIONS:
+        raise MalformedRequestException(f"cannot cross-match more than {MAX_XMATCH_POSITIONS} positions")
 
 
 # Helper Functions:
@@ -240,6 +369,22 @@ def build_params_from_dict(endpoint: Endpoint, params: dict) -> Parameters:
             return TargetParameters(params["target_ids"])
         elif endpoint == Endpoint.TILE:
             return TileParameters(int(params["tile"]), params["fibers"])
+        elif endpoint == Endpoint.TILES:
+            return MultiTileParameters(
+                {int(tile): [int(f) for f in fibers] for tile, fibers in params["tiles"].items()}
+            )
+        elif endpoint == Endpoint.BOX:
+            box = BoxParameters(*[float(params[key]) for key in ["ra_min", "ra_max", "dec_min", "dec_max"]])
+            sky_region(box)
+            return box
+        elif endpoint == Endpoint.POLYGON:
+            polygon = PolygonParameters([float(ra) for ra in params["ra"]], [float(dec) for dec in params["dec"]])
+            sky_region(polygon)
+            return polygon
+        elif endpoint == Endpoint.XMATCH:
+            return build_xmatch_params(params)
+    except MalformedRequestException:
+        raise
     except:
         raise MalformedRequestException(f"invalid endpoint parameters for {endpoint}")
 
@@ -248,7 +393,7 @@ def build_params_from_strings(endpoint: Endpoint, params: List[str]) -> Paramete
     """Build a Parameters object out of the API parameters (a list of arguments)
 
     :param endpoint: The type of the API request as an enum: One of Tile/Target/Radec
-    :param params: A list of strings representing parameters in the API request, such as ['80605', '10,234,2761,3951']
+    :param params: A list of strings representing parameters in the API request, such as ['80605', '10,234,2761,3951']. For multiple tiles, alternating tile IDs and fiber lists.
     :returns: A Parameters object representing the parameters specified in the request.
     """
     try:
@@ -259,6 +404,28 @@ def build_params_from_strings(endpoint: Endpoint, params: List[str]) -> Paramete
             return TargetParameters(parse_list_int(params[0]))
         elif endpoint == Endpoint.TILE:
             return TileParameters(int(params[0]), parse_list_int(params[1]))
+        elif endpoint == Endpoint.BOX:
+            ra_min, ra_max, dec_min, dec_max = parse_list_float(params[0])
+            box = BoxParameters(ra_min, ra_max, dec_min, dec_max)
+            sky_region(box)
+            return box
+        elif endpoint == Endpoint.POLYGON:
+            coords = parse_list_float(params[0])
+            if len(coords) % 2:
+                raise MalformedRequestException("every polygon vertex must have an ra and a dec")
+            polygon = PolygonParameters(coords[::2], coords[1::2])
+            sky_region(polygon)
+            return polygon
+        elif endpoint == Endpoint.XMATCH:
+            raise MalformedRequestException("cross-match positions must be uploaded, see /api/v1/xmatch")
+        elif endpoint == Endpoint.TILES:
+            if len(params) % 2:
+                raise MalformedRequestException("every tile must have a list of fibers")
+            return MultiTileParameters(
+                {int(tile): parse_list_int(fibers) for tile, fibers in zip(params[::2], params[1::2])}
+            )
+    except MalformedRequestException:
+        raise
     except:
         raise MalformedRequestException(f"invalid endpoint parameters for {endpoint}")
 
@@ -272,6 +439,26 @@ def invalid_request_error(e: Exception) -> Response:
     return Response(info, status=400)
 
 
+def request_too_large_error(e: RequestTooLargeException) -> Response:
+    """Tell the client its request is over the cost limits (413), with what it would cost, so it can tell a request that is too large from a malformed one"""
+    info = json.dumps(
+        {"Error": str(e), "Cost": e.cost, "Limits": e.limits, "Help": f"See {DOC_URL} for an overview of request syntax"},
+        indent=4,
+    )
+    return Response(info, status=413, mimetype="application/json")
+
+
+def server_busy_error(e: ServerBusyException) -> Response:
+    """Tell the client to come back later: 429 if its request's queue is full, 503 if it waited too long for its turn"""
+    info = json.dumps(
+        {"Error": str(e), "Retry-After": e.retry_after},
+        indent=4,
+    )
+    response = Response(info, status=e.status, mimetype="application/json")
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
 def run_app(config: dict):
     """Load the configuration values from CONFIG into the app's internal config and start the server
 
@@ -280,6 +467,14 @@ def run_app(config: dict):
 
     """
     app.config.update(config)
-    # Doesn't save the results anywhere, but calling it should cause the value to be cached if functools does its job
-    preload_fits(PRELOAD_RELEASES) # FIXME should use app.config preloads, not constant. But then the later calls don't match, and cause a re-run which takes forever
+    if "fragment_cache" in config:
+        configure_fragment_cache(config["fragment_cache"]["max_size"])
+    configure_admission(config.get("admission", dict()))
+    configure_cost_limits(dict(COST_LIMITS, **config.get("cost_limits", dict())))
+    RELEASES.configure(config.get("releases", dict()))
+    RELEASES.resolve_all(RELEASES.allowed or RELEASES.preload)
+    # Look for new versions of releases in the background, so they are preloaded before requests ask for them
+    RELEASES.start_watcher()
+    # Start listening straight away, requests use the preloaded data for each release as soon as it is ready
+    start_background_preload(RELEASES.preload)
     app.run(host="0.0.0", debug=True, use_reloader=False)
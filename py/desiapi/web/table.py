@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import os
+from typing import List, Mapping
+
+import numpy as np
+
+from ..common.errors import DataNotFoundException, MalformedRequestException
+from ..common.models import *
+
+# The zcat HTML table is a DataTables page in "server-side processing" mode: instead of inlining every row in the
+# page, the result is saved next to the page as a .table.npy file and the table asks `/api/v1/table/...` for one
+# page of rows at a time, with sorting and searching done here. So the HTML is the same size however many rows
+# there are. See https://datatables.net/manual/server-side for the request/response format.
+
+TABLE_SUFFIX = ".table.npy"
+MAX_TABLE_PAGE = 1000  # Rows returned per draw, regardless of what the client asks for
+
+
+def table_data_path(html_file: str) -> str:
+    """The file holding the rows behind the table in HTML_FILE"""
+    return f"{os.path.splitext(html_file)[0]}{TABLE_SUFFIX}"
+
+
+def write_table_data(html_file: str, zcat: Zcatalog):
+    np.save(table_data_path(html_file), np.asarray(zcat), allow_pickle=False)
+
+
+def resolve_table(cache_root: str, table_id: str) -> str:
+    """Find the table data for TABLE_ID (the table's path relative to the cache, without suffix), refusing anything outside the cache"""
+    root = os.path.realpath(cache_root)
+    path = os.path.realpath(os.path.join(root, table_id + TABLE_SUFFIX))
+    if not path.startswith(root + os.sep):
+        raise MalformedRequestException("invalid table")
+    if not os.path.exists(path):
+        raise DataNotFoundException("table has expired from the cache, reload the page")
+    return path
+
+
+def text_column(values: np.ndarray) -> np.ndarray:
+    """Lower-case string form of a column, for searching"""
+    if values.dtype.kind == "S":
+        values = np.char.decode(values, "ascii", "replace")
+    return np.char.lower(values.astype(str))
+
+
+def search_mask(zcat: np.ndarray, columns: List[str], value: str) -> np.ndarray:
+    """Rows where any of COLUMNS matches VALUE. String columns match on a case-insensitive substring, numeric ones on equality"""
+    value = value.strip().lower()
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    keep = np.zeros(len(zcat), dtype=bool)
+    for column in columns:
+        values = zcat[column]
+        if values.ndim > 1:
+            continue
+        if values.dtype.kind in "SU":
+            keep |= np.char.find(text_column(values), value) >= 0
+        elif number is not None and values.dtype.kind in "iufb":
+            keep |= values == number
+    return keep
+
+
+def json_value(value):
+    """Make a single cell JSON-friendly. TARGETIDs and other 64-bit integers don't fit in a javascript number, so they are sent as strings"""
+    if isinstance(value, np.ndarray):
+        return [json_value(v) for v in value.tolist()]
+    if isinstance(value, bytes):
+        return value.decode("ascii", "replace").strip()
+    if isinstance(value, int) and abs(value) >= 2**53:
+        return str(value)
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def table_page(data_file: str, args: Mapping[str, str]) -> dict:
+    """Answer a single DataTables server-side request, given its query ARGS, from the rows in DATA_FILE
+
+    :param data_file: A .table.npy file written by `write_table_data`
+    :param args: The query parameters DataTables sent (draw, start, length, search[value], order[0][column], ...)
+    :returns: The response DataTables expects: draw, recordsTotal, recordsFiltered and the rows of the page
+    """
+    zcat = np.load(data_file, mmap_mode="r", allow_pickle=False)
+    names = list(zcat.dtype.names)
+    try:
+        draw = int(args.get("draw", 0))
+        start = max(int(args.get("start", 0)), 0)
+        length = int(args.get("length", 10))
+    except ValueError:
+        raise MalformedRequestException("draw, start and length must be integers")
+    length = MAX_TABLE_PAGE if length < 0 else min(length, MAX_TABLE_PAGE)
+
+    rows = np.arange(len(zcat))
+    search = args.get("search[value]", "")
+    if search:
+        rows = rows[search_mask(zcat[rows], names, search)]
+    i = 0
+    while f"columns[{i}][data]" in args:
+        column = args[f"columns[{i}][data]"]
+        column_search = args.get(f"columns[{i}][search][value]", "")
+        if column_search and column in names:
+            rows = rows[search_mask(zcat[rows], [column], column_search)]
+        i += 1
+
+    order = args.get("order[0][column]")
+    if order is not None:
+        column = args.get(f"columns[{order}][data]", names[int(order)] if order.isdigit() and int(order) < len(names) else None)
+        if column in names and zcat[column].ndim == 1:
+            permutation = np.argsort(zcat[column][rows], kind="stable")
+            if args.get("order[0][dir]", "asc") == "desc":
+                permutation = permutation[::-1]
+            rows = rows[permutation]
+
+    page = zcat[rows[start : start + length]]
+    data = [
+        {name: json_value(value) for name, value in zip(names, record)}
+        for record in page.tolist()
+    ]
+    return {
+        "draw": draw,
+        "recordsTotal": len(zcat),
+        "recordsFiltered": len(rows),
+        "data": data,
+    }
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import io
+from typing import Mapping, Sequence
+
+import numpy as np
+
+from ..common.errors import MalformedRequestException
+from ..common.models import *
+
+# Positions for a cross-match are uploaded as a file rather than put in the URL. We accept:
+# - CSV, with a header naming the ra, dec and (optionally) radius columns, or with no header and the columns in that order
+# - FITS, a binary table in the first extension with RA, DEC and optionally RADIUS columns
+# - A numpy .npy array, either structured with those fields, or a plain (n, 2) or (n, 3) float array
+# Any column name case works. Positions without a radius of their own use the `radius` query param.
+
+FITS_MAGIC = b"SIMPLE"
+NPY_MAGIC = b"\x93NUMPY"
+POSITION_COLUMNS = ["ra", "dec", "radius"]
+
+
+def upload_format(data: bytes) -> str:
+    """Recognise the format of an uploaded position list from its first bytes"""
+    if data.startswith(FITS_MAGIC):
+        return "fits"
+    if data.startswith(NPY_MAGIC):
+        return "npy"
+    return "csv"
+
+
+def read_fits_positions(data: bytes) -> Mapping[str, np.ndarray]:
+    from astropy.io import fits
+
+    with fits.open(io.BytesIO(data), memmap=False) as hdus:
+        table = next((hdu.data for hdu in hdus[1:] if hdu.data is not None), None)
+        if table is None:
+            raise MalformedRequestException("the FITS file has no table of positions")
+        return {name.lower(): np.asarray(table[name]) for name in table.names}
+
+
+def read_npy_positions(data: bytes) -> Mapping[str, np.ndarray]:
+    arr = np.load(io.BytesIO(data), allow_pickle=False)
+    if arr.dtype.names:
+        return {name.lower(): arr[name] for name in arr.dtype.names}
+    return plain_positions(arr)
+
+
+def read_csv_positions(data: bytes) -> Mapping[str, np.ndarray]:
+    text = data.decode("utf-8", "replace").strip()
+    if not text:
+        return {"ra": np.array([]), "dec": np.array([])}
+    first = text.splitlines()[0].split(",")
+    try:
+        [float(value) for value in first]
+        has_header = False
+    except ValueError:
+        has_header = True
+    try:
+        arr = np.genfromtxt(io.StringIO(text), delimiter=",", names=True if has_header else None, dtype=np.float64)
+    except ValueError as e:
+        raise MalformedRequestException(f"unable to read the CSV positions: {e}")
+    if has_header:
+        arr = np.atleast_1d(arr)
+        return {name.lower(): arr[name] for name in arr.dtype.names}
+    return plain_positions(np.atleast_2d(arr))
+
+
+def plain_positions(arr: np.ndarray) -> Mapping[str, np.ndarray]:
+    """Columns of a plain (n, 2) or (n, 3) array, in the order ra, dec, radius"""
+    if arr.ndim != 2 or arr.shape[1] not in (2, 3):
+        raise MalformedRequestException("positions must have 2 or 3 columns: ra, dec and radius")
+    return dict(zip(POSITION_COLUMNS, arr.T))
+
+
+def build_xmatch_params(columns: Mapping[str, Sequence], default_radius: float | None = None) -> CrossMatchParameters:
+    """Check a set of position COLUMNS (ra, dec and optionally radius) and turn them into CrossMatchParameters
+
+    :param columns: Mapping of lower-case column names to values
+    :param default_radius: Radius for every position, if COLUMNS doesn't have one per position
+    :returns: The parameters for a cross-match request
+    """
+    if "ra" not in columns or "dec" not in columns:
+        raise MalformedRequestException("positions must have ra and dec columns")
+    try:
+        ra = np.asarray(columns["ra"], dtype=np.float64).ravel()
+        dec = np.asarray(columns["dec"], dtype=np.float64).ravel()
+        if "radius" in columns:
+            radius = np.broadcast_to(np.asarray(columns["radius"], dtype=np.float64), ra.shape)
+        elif default_radius is not None:
+            radius = np.full(ra.shape, float(default_radius))
+        else:
+            raise MalformedRequestException("positions need a radius column, or a radius query param")
+    except ValueError:
+        raise MalformedRequestException("ra, dec and radius must be numbers of the same length")
+    if len(ra) != len(dec):
+        raise MalformedRequestException("ra and dec must be the same length")
+    if not (np.isfinite(ra).all() and np.isfinite(dec).all() and np.isfinite(radius).all()):
+        raise MalformedRequestException("positions must be finite")
+    if (np.abs(dec) > 90).any() or (radius < 0).any():
+        raise MalformedRequestException("dec must be within [-90, 90] and radius can't be negative")
+    return CrossMatchParameters(ra.tolist(), dec.tolist(), radius.tolist())
+
+
+def read_positions(data: bytes, default_radius: float | None = None) -> CrossMatchParameters:
+    """Parse an uploaded position list (CSV, FITS or .npy, see above) into CrossMatchParameters"""
+    readers = {"fits": read_fits_positions, "npy": read_npy_positions, "csv": read_csv_positions}
+    try:
+        columns = readers[upload_format(data)](data)
+    except MalformedRequestException:
+        raise
+    except Exception as e:
+        raise MalformedRequestException(f"unable to read the uploaded positions: {e}")
+    return build_xmatch_params(columns, default_radius)